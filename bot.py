@@ -1,21 +1,39 @@
 # bot.py
+import time
+STARTED = time.perf_counter()  # для замеров фаз старта (см. startup_phase)
 import os
+import sys
+import hmac
+import secrets
 import json
-import time
+import marshal
+import atexit
 import random
+import asyncio
 import logging
+import signal
+import sqlite3
+import io
+import bisect
+import heapq
+import itertools
 import threading
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from dotenv import load_dotenv
-from flask import Flask, send_file
-from io import BytesIO
 
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile,
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters, ConversationHandler
+    ContextTypes, filters, ConversationHandler, TypeHandler,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor
 )
+from telegram.error import BadRequest, Conflict, Forbidden, InvalidToken, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # -------------------------
 # Настройка и загрузка TOKEN
@@ -31,137 +49,2781 @@ if not TOKEN:
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# -------------------------
-# Flask (для Render)
-# -------------------------
-flask_app = Flask(__name__)
+# -------------------------
+# Замеры старта
+# -------------------------
+# Фазы: imports (импорт и настройки), storage (загрузка данных), application
+# (сборка Application), initialize (getMe, восстановление состояния, фоновые задачи).
+# Итог пишется в лог, в /healthz и в метрику bot_startup_seconds.
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "5"))  # секунд; дольше — предупреждение в логе
+STARTUP_PHASES = []  # [(фаза, секунды)]
+_phase_mark = STARTED
+
+def startup_phase(name):
+    """Закрывает фазу старта name: время с конца предыдущей фазы"""
+    global _phase_mark
+    now = time.perf_counter()
+    STARTUP_PHASES.append((name, now - _phase_mark))
+    _phase_mark = now
+
+def log_startup():
+    total = sum(seconds for _, seconds in STARTUP_PHASES)
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in STARTUP_PHASES)
+    logger.info(f"Startup: {phases}, total {total:.2f}s")
+    if total > STARTUP_BUDGET:
+        logger.warning(f"Startup took {total:.2f}s (budget {STARTUP_BUDGET:.0f}s); "
+                       f"with a large data set STORAGE_BACKEND=sqlite starts without loading users")
+
+# -------------------------
+# HTTP (Flask, для Render)
+# -------------------------
+# Flask импортируется только в run_flask(): его импорт заметно удлиняет старт, а
+# обработке обновлений он не нужен. Маршруты собираются декоратором http_route
+# и подключаются к приложению Flask при его создании.
+HTTP_ROUTES = []  # (путь, функция, методы)
+
+def http_route(path, methods=("GET",)):
+    def register(view):
+        HTTP_ROUTES.append((path, view, list(methods)))
+        return view
+    return register
+
+@http_route("/")
+def index():
+    return "✅ Telegram bot is running!"
+
+# -------------------------
+# Константы / состояния
+# -------------------------
+STATE_WAIT_ADMIN_USERNAME = "WAIT_ADMIN_USERNAME"
+STATE_WAIT_REMOVE_ADMIN = "WAIT_REMOVE_ADMIN"
+STATE_WAIT_PERMS_USERNAME = "WAIT_PERMS_USERNAME"
+STATE_WAIT_MUTE = "WAIT_MUTE"
+STATE_WAIT_IMPERSONATE = "WAIT_IMPERSONATE"
+STATE_WAIT_BROADCAST = "WAIT_BROADCAST"
+STATE_WAIT_ADMIN_SEARCH = "WAIT_ADMIN_SEARCH"
+STATE_WAIT_PERM_TOGGLE = "WAIT_PERM_TOGGLE"  # internal message state for toggles (not used for message handler)
+STATE_USER_SEND = "USER_SEND"
+
+# список доступных прав
+ALL_PERMS = ["broadcast", "impersonate", "manage_perms", "stats", "mute", "export", "admin_chat"]
+
+# -------------------------
+# Файл данных
+# -------------------------
+# data.json — снимок (snapshot) всего состояния в прежнем формате, его по-прежнему
+# можно читать/экспортировать как раньше. Все изменения между снимками дописываются
+# мелкими записями в журнал DATA_JOURNAL (JSON Lines). При старте читаем снимок и
+# проигрываем журнал; когда журнал разрастается — сжимаем его в новый снимок в фоне.
+DATA_FILE = "data.json"
+# поля записи пользователя (для sqlite — колонки таблицы users, для data.snap — колонки снимка)
+USER_FIELDS = ("username", "anon", "muted_until", "active")
+USER_FIELDS_SET = frozenset(USER_FIELDS)
+DATA_JOURNAL = "data.journal"
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "5000"))
+JOURNAL_FLUSH_MS = int(os.getenv("JOURNAL_FLUSH_MS", "200"))  # окно склейки записей журнала
+
+def empty_data():
+    # базовая структура
+    return {
+        "users": {},         # str(user_id) -> {"username": str|None, "anon": int, "muted_until": 0}
+        "admins": [],        # list of "@username"
+        "banned": [],        # list of "@username"
+        "permissions": {},   # "@username" -> {perm: bool, ...}
+        "user_state": {},    # str(user_id) -> context.user_data (незаконченные диалоги)
+        "message_count": 0,
+        "admin_chat_enabled": False
+    }
+
+def apply_record(data, rec):
+    """Применяет одну запись журнала к data.
+    Все операции идемпотентны (хранят итоговое значение, а не дельту),
+    поэтому повторное проигрывание уже учтённой в снимке записи безопасно."""
+    op = rec.get("op")
+    if op == "user":
+        data["users"][rec["uid"]] = dict(rec["info"])
+    elif op == "user_set":
+        info = data["users"].get(rec["uid"])
+        if info is not None:
+            info[rec["field"]] = rec["value"]
+    elif op == "admin_add":
+        if rec["username"] not in data["admins"]:
+            data["admins"].append(rec["username"])
+    elif op == "admin_del":
+        if rec["username"] in data["admins"]:
+            data["admins"].remove(rec["username"])
+    elif op == "ban_add":
+        if rec["username"] not in data["banned"]:
+            data["banned"].append(rec["username"])
+    elif op == "ban_del":
+        if rec["username"] in data["banned"]:
+            data["banned"].remove(rec["username"])
+    elif op == "perms":
+        data["permissions"][rec["username"]] = dict(rec["perms"])
+    elif op == "perms_del":
+        data["permissions"].pop(rec["username"], None)
+    elif op == "perm":
+        perms = data["permissions"].setdefault(rec["username"], {p: False for p in ALL_PERMS})
+        perms[rec["perm"]] = rec["value"]
+    elif op == "user_state":
+        if rec["data"]:
+            data["user_state"][rec["uid"]] = dict(rec["data"])
+        else:
+            data["user_state"].pop(rec["uid"], None)
+    elif op == "set":
+        data[rec["key"]] = rec["value"]
+    else:
+        logger.warning(f"Unknown journal record: {rec}")
+
+def replay_journal(data, path):
+    """Проигрывает журнал path поверх data, возвращает число применённых записей"""
+    count = 0
+    try:
+        f = open(path, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return 0
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # хвост, оборванный падением посреди записи
+                logger.warning(f"Skipping corrupt journal line in {path}")
+                continue
+            apply_record(data, rec)
+            count += 1
+    return count
+
+def read_snapshot(path=DATA_FILE):
+    data = read_binary_snapshot(path)
+    if data is None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            data = {}
+        data["users"] = UserTable.from_items(data.get("users", {}).items())
+    for k, v in empty_data().items():
+        data.setdefault(k, v)
+    return data
+
+def atomic_write(path, write, mode="w"):
+    """tmp-файл + fsync + os.replace: при падении остаётся прежний файл, а не обрезанный"""
+    tmp = path + ".tmp"
+    with open(tmp, mode, **({"encoding": "utf-8"} if "b" not in mode else {})) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def write_snapshot(data, path=DATA_FILE):
+    """Атомарно записывает снимок data.json и его двоичную копию для быстрого старта"""
+    json_data = {**data, "users": data["users"].to_dict()}
+    atomic_write(path, lambda f: json.dump(json_data, f, ensure_ascii=False, indent=2))
+    write_binary_snapshot(data, path)
+
+# -------------------------
+# Пользователи в памяти (компактно)
+# -------------------------
+# JsonStorage держит пользователей не словарём словарей, а колонками в порядке
+# регистрации: uid, anon, muted_until — array('q'), username — список
+# интернированных строк, флаги (замьючен, неактивен, забанен) — битовые множества
+# по номеру строки. Позиция по uid — словарь int -> номер строки. Снаружи UserTable
+# выглядит как прежний dict str(uid) -> запись, а запись — как dict (UserView
+# читает и пишет колонки), так что остальной код не меняется.
+NO_ANON = -1  # anon не выдан (в колонке array('q') нет None)
+
+class Bitset:
+    """Множество номеров строк: бит на строку в bytearray"""
+
+    __slots__ = ("bits",)
+
+    def __init__(self, bits=b""):
+        self.bits = bytearray(bits)
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (i & 7)
+
+    def discard(self, i):
+        byte = i >> 3
+        if byte < len(self.bits):
+            self.bits[byte] &= ~(1 << (i & 7)) & 0xFF
+
+    def set(self, i, value):
+        if value:
+            self.add(i)
+        else:
+            self.discard(i)
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and self.bits[byte] >> (i & 7) & 1 == 1
+
+    def __iter__(self):
+        for byte, b in enumerate(self.bits):
+            if b:
+                for bit in range(8):
+                    if b >> bit & 1:
+                        yield byte * 8 + bit
+
+    def __len__(self):
+        return bin(int.from_bytes(self.bits, "little")).count("1")
+
+    def __or__(self, other):
+        n = max(len(self.bits), len(other.bits))
+        merged = int.from_bytes(self.bits, "little") | int.from_bytes(other.bits, "little")
+        return Bitset(merged.to_bytes(n, "little"))
+
+class UserView(MutableMapping):
+    """Запись пользователя в UserTable: dict-подобное окно в колонки строки row"""
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, field):
+        return self._table.get_field(self._row, field)
+
+    def __setitem__(self, field, value):
+        self._table.set_field(self._row, field, value)
+
+    def __delitem__(self, field):
+        self._table.del_field(self._row, field)
+
+    def __iter__(self):
+        yield from USER_FIELDS
+        yield from self._table.extra.get(self._row, ())
+
+    def __len__(self):
+        return len(USER_FIELDS) + len(self._table.extra.get(self._row, ()))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class UserTable(MutableMapping):
+    """str(uid) -> UserView. Поля записи — USER_FIELDS (active по умолчанию True);
+    редкие прочие поля хранятся в extra: номер строки -> {поле: значение}"""
+
+    def __init__(self):
+        self.pos = {}                  # int(uid) -> номер строки
+        self.uids = array("q")
+        self.usernames = []
+        self.anons = array("q")
+        self.muted_until = array("q")
+        self.muted = Bitset()          # muted_until > 0
+        self.inactive = Bitset()       # active = False
+        self.banned = Bitset()         # @username в списке банов (ведёт Index)
+        self.extra = {}
+
+    @classmethod
+    def from_items(cls, items):
+        table = cls()
+        pos, uids, usernames, anons, muted_until = table.pos, table.uids, table.usernames, table.anons, table.muted_until
+        for uid, info in items:
+            key = int(uid)
+            if key in pos or not info.keys() <= USER_FIELDS_SET:
+                # повторы и записи с лишними полями — общим путём
+                table[uid] = info
+                continue
+            row = len(uids)
+            username = info.get("username")
+            usernames.append(sys.intern(username) if username else username)
+            anon = info.get("anon")
+            anons.append(NO_ANON if anon is None else anon)
+            until = info.get("muted_until") or 0
+            muted_until.append(until)
+            if until:
+                table.muted.add(row)
+            if info.get("active") is False:
+                table.inactive.add(row)
+            uids.append(key)
+            pos[key] = row
+        return table
+
+    # --- dict-фасад ---
+    def _row(self, uid):
+        try:
+            return self.pos[int(uid)]
+        except (ValueError, TypeError):
+            raise KeyError(uid) from None
+
+    def __getitem__(self, uid):
+        return UserView(self, self._row(uid))
+
+    def __contains__(self, uid):
+        try:
+            return int(uid) in self.pos
+        except (ValueError, TypeError):
+            return False
+
+    def __setitem__(self, uid, info):
+        key = int(uid)
+        info = dict(info)
+        row = self.pos.get(key)
+        if row is None:
+            row = len(self.uids)
+            # uid — последним: по длине self.uids читатель из другого потока (copy)
+            # видит только строки, уже записанные во все колонки
+            self.usernames.append(None)
+            self.anons.append(NO_ANON)
+            self.muted_until.append(0)
+            self.uids.append(key)
+            self.pos[key] = row
+        self.extra.pop(row, None)
+        self.set_field(row, "username", info.pop("username", None))
+        self.set_field(row, "anon", info.pop("anon", None))
+        self.set_field(row, "muted_until", info.pop("muted_until", 0))
+        self.set_field(row, "active", info.pop("active", True))
+        if info:
+            self.extra[row] = info
+
+    def __delitem__(self, uid):
+        # пользователей не удаляют; поддержано ради полноты фасада — перестройкой, O(n)
+        row = self._row(uid)
+        items = [(u, dict(info)) for u, info in self.items() if self.pos[int(u)] != row]
+        # банов нет в записях — переносим биты отдельно
+        banned = [str(self.uids[r]) for r in self.banned if r != row]
+        table = UserTable.from_items(items)
+        for u in banned:
+            table.set_banned(u, True)
+        self.__dict__.update(table.__dict__)
+
+    def __iter__(self):
+        return map(str, self.uids)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def items(self):
+        return self.items_range()
+
+    # --- поля ---
+    def get_field(self, row, field):
+        if field == "username":
+            return self.usernames[row]
+        if field == "anon":
+            anon = self.anons[row]
+            return None if anon == NO_ANON else anon
+        if field == "muted_until":
+            return self.muted_until[row]
+        if field == "active":
+            return row not in self.inactive
+        return self.extra.get(row, {})[field]
+
+    def set_field(self, row, field, value):
+        if field == "username":
+            self.usernames[row] = sys.intern(value) if value else value
+        elif field == "anon":
+            self.anons[row] = NO_ANON if value is None else value
+        elif field == "muted_until":
+            self.muted_until[row] = value or 0
+            self.muted.set(row, value)
+        elif field == "active":
+            self.inactive.set(row, value is False)
+        else:
+            self.extra.setdefault(row, {})[field] = value
+
+    def del_field(self, row, field):
+        if field in USER_FIELDS_SET:
+            raise KeyError(f"{field} нельзя удалить")
+        del self.extra.get(row, {})[field]
+
+    # --- быстрые проходы без UserView ---
+    def items_range(self, start=0, stop=None):
+        """(uid, запись) в порядке регистрации, позиции [start, stop) — по числу строк на момент вызова"""
+        end = len(self.uids) if stop is None else min(stop, len(self.uids))
+        uids = self.uids
+        for row in range(start, end):
+            yield str(uids[row]), UserView(self, row)
+
+    def scan(self, fields):
+        """(uid, *значения fields) по всем пользователям"""
+        n = len(self.uids)
+        cols = []
+        for field in fields:
+            if field == "username":
+                cols.append(self.usernames[:n])
+            elif field == "anon":
+                cols.append([None if a == NO_ANON else a for a in self.anons[:n]])
+            elif field == "muted_until":
+                cols.append(self.muted_until[:n])
+            else:
+                cols.append([self.get_field(row, field) for row in range(n)])
+        return zip(map(str, self.uids[:n]), *cols)
+
+    def muted_rows(self):
+        """[(uid, muted_until)] — только по битам muted, без прохода по всем"""
+        return [(str(self.uids[row]), self.muted_until[row]) for row in self.muted]
+
+    def set_banned(self, uid, value):
+        row = self.pos.get(int(uid))
+        if row is not None:
+            self.banned.set(row, value)
+
+    def deliverable(self):
+        """uid активных незабаненных пользователей в порядке регистрации"""
+        n = len(self.uids)
+        skip = (self.inactive | self.banned).bits
+        uids = self.uids
+        for row in range(n):
+            byte = row >> 3
+            if byte < len(skip) and skip[byte] >> (row & 7) & 1:
+                continue
+            yield str(uids[row])
+
+    def copy(self):
+        """Копия для чтения из другого потока; строки, дописанные во время копирования, не попадают"""
+        n = len(self.uids)
+        table = UserTable.__new__(UserTable)
+        table.uids = self.uids[:n]
+        table.usernames = self.usernames[:n]
+        table.anons = self.anons[:n]
+        table.muted_until = self.muted_until[:n]
+        table.muted = Bitset(self.muted.bits)
+        table.inactive = Bitset(self.inactive.bits)
+        table.banned = Bitset(self.banned.bits)
+        table.extra = {row: dict(info) for row, info in list(self.extra.items()) if row < n}
+        table.pos = dict(zip(table.uids, range(n)))
+        return table
+
+    def to_dict(self):
+        return {uid: dict(info) for uid, info in self.items_range()}
+
+    # --- двоичный снимок ---
+    def state(self):
+        return (self.uids.tobytes(), self.usernames, self.anons.tobytes(), self.muted_until.tobytes(),
+                bytes(self.inactive.bits), self.extra)
+
+    @classmethod
+    def from_state(cls, state):
+        uids, usernames, anons, muted_until, inactive, extra = state
+        table = cls()
+        table.uids.frombytes(uids)
+        table.usernames = [sys.intern(u) if u else u for u in usernames]
+        table.anons.frombytes(anons)
+        table.muted_until.frombytes(muted_until)
+        table.inactive = Bitset(inactive)
+        table.extra = extra
+        if not len(table.uids) == len(table.usernames) == len(table.anons) == len(table.muted_until):
+            raise ValueError("broken user table")
+        table.muted = Bitset()
+        for row, until in enumerate(table.muted_until):
+            if until:
+                table.muted.add(row)
+        table.pos = dict(zip(table.uids, range(len(table.uids))))
+        return table
+
+def scan_users(users, *fields):
+    """(uid, *значения fields) по всем пользователям; у UserTable — по колонкам"""
+    if isinstance(users, UserTable):
+        return users.scan(fields)
+    return ((uid, *(info.get(f) for f in fields)) for uid, info in users.items())
+
+# -------------------------
+# Двоичный снимок (быстрый старт)
+# -------------------------
+# Рядом с data.json пишется data.snap (marshal): колонки UserTable как байты
+# array('q') и список username, остальные ключи как есть. Загрузка — копирование
+# байтов в массивы и построение словаря позиций, в разы быстрее json.load.
+# Копия действительна, только пока data.json тот же (размер и mtime записаны
+# в неё), иначе читается data.json.
+SNAPSHOT_BIN_VERSION = (2, sys.byteorder)
+
+def binary_snapshot_path(path):
+    return os.path.splitext(path)[0] + ".snap"
+
+def file_stamp(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+def write_binary_snapshot(data, path):
+    rest = {k: v for k, v in data.items() if k != "users"}
+    blob = marshal.dumps((SNAPSHOT_BIN_VERSION, file_stamp(path), data["users"].state(), rest))
+    atomic_write(binary_snapshot_path(path), lambda f: f.write(blob), mode="wb")
+
+def read_binary_snapshot(path):
+    """data из data.snap или None, если его нет, он устарел или повреждён"""
+    try:
+        with open(binary_snapshot_path(path), "rb") as f:
+            # marshal.loads(bytes) на порядок быстрее marshal.load(файл)
+            version, stamp, users, data = marshal.loads(f.read())
+        if tuple(version) != SNAPSHOT_BIN_VERSION or tuple(stamp) != file_stamp(path):
+            return None
+        data["users"] = UserTable.from_state(users)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return data
+
+def load_data():
+    data = read_snapshot()
+    # .old остаётся, если процесс упал во время сжатия
+    replay_journal(data, DATA_JOURNAL + ".old")
+    replay_journal(data, DATA_JOURNAL)
+    return data
+
+class Journal:
+    """Журнал изменений (append-only) с отложенной записью и сжатием в снимок.
+
+    append() только ставит строку в очередь и сразу возвращается: запись на диск,
+    fsync и ротацию делает отдельный поток-писатель, собирая все изменения за
+    JOURNAL_FLUSH_MS в одну запись. flush() синхронно дожидается, пока всё
+    поставленное в очередь окажется на диске.
+
+    Сжатие не трогает живой DATA: текущий журнал переименовывается в .old,
+    новые записи идут в свежий файл, а фоновый поток читает старый снимок,
+    проигрывает .old и атомарно записывает новый data.json.
+    """
+
+    def __init__(self, path=DATA_JOURNAL, snapshot_path=DATA_FILE,
+                 compact_every=JOURNAL_COMPACT_EVERY, flush_interval=JOURNAL_FLUSH_MS / 1000):
+        self.path = path
+        self.old_path = path + ".old"
+        self.snapshot_path = snapshot_path
+        self.compact_every = compact_every
+        self.flush_interval = flush_interval
+        self._pending = []        # строки, ещё не записанные на диск
+        self._queued = 0          # номер последней поставленной в очередь записи
+        self._flushed = 0         # номер последней записи, дошедшей до диска
+        self._urgent = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()  # файл журнала и ротация
+        self._compactor = None
+        # записи, уже лежащие в журнале с прошлых запусков, тоже идут в счёт compact_every
+        self.records = self._repair_tail()
+        self._f = open(self.path, "a", encoding="utf-8")
+        if os.path.exists(self.old_path):
+            # недоделанное сжатие с прошлого запуска
+            self._start_compaction()
+        self._writer = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._writer.start()
+
+    def _repair_tail(self):
+        """Отрезает строку, оборванную падением посреди записи: без этого следующая
+        запись допишется в её конец, и replay_journal выбросит обе.
+        Возвращает число целых строк в журнале"""
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return 0
+        with f:
+            content = f.read()
+            end = content.rfind(b"\n") + 1
+            if end < len(content):
+                logger.warning(f"Dropping {len(content) - end} bytes of torn tail in {self.path}")
+                f.truncate(end)
+            return content.count(b"\n")
+
+    def append(self, rec):
+        line = json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+        with self._cond:
+            self._pending.append(line)
+            self._queued += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Блокирует до записи (с fsync) всего, что уже поставлено в очередь"""
+        with self._cond:
+            target = self._queued
+            self._urgent = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._flushed >= target or not self._writer.is_alive(), timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing)
+                if not self._pending:
+                    return
+                # окно склейки: ждём ещё изменений, если нас не торопят
+                deadline = time.monotonic() + self.flush_interval
+                while not (self._urgent or self._closing):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                lines, self._pending = self._pending, []
+                upto = self._queued
+                self._urgent = False
+            try:
+                with self._io_lock:
+                    self._f.write("\n".join(lines) + "\n")
+                    self._f.flush()
+                    os.fsync(self._f.fileno())
+                    self.records += len(lines)
+                    if self.records >= self.compact_every:
+                        self._rotate()
+            except Exception as e:
+                logger.error(f"Journal write failed: {e}")
+            with self._cond:
+                self._flushed = upto
+                self._cond.notify_all()
+
+    def _rotate(self):
+        # вызывается под self._io_lock
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        if os.path.exists(self.old_path):
+            # .old ещё не влит (ошибка прошлого сжатия) — пробуем снова, не перезаписывая
+            self._start_compaction()
+            return
+        self._f.close()
+        os.replace(self.path, self.old_path)
+        self._f = open(self.path, "a", encoding="utf-8")
+        self.records = 0
+        self._start_compaction()
+
+    def _start_compaction(self):
+        self._compactor = threading.Thread(target=self._compact, name="journal-compactor", daemon=True)
+        self._compactor.start()
+
+    def _compact(self):
+        started = time.monotonic()
+        try:
+            data = read_snapshot(self.snapshot_path)
+            n = replay_journal(data, self.old_path)
+            write_snapshot(data, self.snapshot_path)
+            os.remove(self.old_path)
+            logger.info(f"Journal compacted: {n} records in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Journal compaction failed: {e}")
+
+    def compact(self):
+        """Принудительное сжатие всего записанного (например, при остановке)"""
+        self.flush()
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._io_lock:
+            self._rotate()
+        if self._compactor is not None:
+            self._compactor.join()
+
+    def close(self):
+        """Дописывает очередь и останавливает поток-писатель"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._writer.join()
+        with self._io_lock:
+            self._f.close()
+
+# -------------------------
+# Индексы (в памяти)
+# -------------------------
+class Index:
+    """O(1)-поиск поверх DATA: @username -> uid, anon -> uid, множества админов и банов.
+    Строится из DATA при загрузке и обновляется в JsonStorage.apply() на каждой мутации."""
+
+    ANON_MIN_DIGITS = 4
+
+    def __init__(self, data):
+        self.by_username = {}   # "@username" -> str(uid)
+        self.by_anon = {}       # anon (int) -> str(uid)
+        self.anon_digits = {}   # число цифр -> сколько anon такой длины занято
+        self.admins = set(data["admins"])
+        self.banned = set(data["banned"])
+        self.users = data["users"]
+        for uid, username, anon in scan_users(self.users, "username", "anon"):
+            self.link(uid, username, anon)
+
+    def link_user(self, uid):
+        info = self.users.get(uid)
+        if info:
+            self.link(uid, info.get("username"), info.get("anon"))
+
+    def link(self, uid, username, anon):
+        if username:
+            key = f"@{username}"
+            self.by_username[key] = uid
+            if key in self.banned:
+                self.users.set_banned(uid, True)
+        if anon is not None:
+            if anon in self.by_anon and self.by_anon[anon] != uid:
+                # старые данные: randint мог выдать один номер двоим
+                logger.warning(f"Duplicate anon id {anon} for users {self.by_anon[anon]} and {uid}")
+                return
+            self.by_anon[anon] = uid
+            digits = len(str(anon))
+            self.anon_digits[digits] = self.anon_digits.get(digits, 0) + 1
+
+    def unlink_user(self, uid):
+        info = self.users.get(uid)
+        if not info:
+            return
+        if info.get("username") and self.by_username.get(f"@{info['username']}") == uid:
+            del self.by_username[f"@{info['username']}"]
+        self.users.set_banned(uid, False)
+        anon = info.get("anon")
+        if anon is not None and self.by_anon.get(anon) == uid:
+            del self.by_anon[anon]
+            self.anon_digits[len(str(anon))] -= 1
+
+    def forget(self, rec):
+        """вызывается до применения записи"""
+        if rec["op"] in ("user", "user_set"):
+            self.unlink_user(rec["uid"])
+
+    def learn(self, rec):
+        """вызывается после применения записи"""
+        op = rec["op"]
+        if op in ("user", "user_set"):
+            self.link_user(rec["uid"])
+        elif op == "admin_add":
+            self.admins.add(rec["username"])
+        elif op == "admin_del":
+            self.admins.discard(rec["username"])
+        elif op == "ban_add":
+            self.banned.add(rec["username"])
+            self.mark_banned(rec["username"], True)
+        elif op == "ban_del":
+            self.banned.discard(rec["username"])
+            self.mark_banned(rec["username"], False)
+
+    def mark_banned(self, username, value):
+        uid = self.by_username.get(username)
+        if uid is not None:
+            self.users.set_banned(uid, value)
+
+    def allocate_anon(self):
+        """Свободный anon без коллизий. Пока 4-значные номера заняты меньше чем наполовину —
+        выдаём их (как раньше), дальше переходим на 5-значные и т.д.
+        Случайный выбор с отбраковкой: в среднем не больше двух попыток."""
+        digits = self.ANON_MIN_DIGITS
+        while self.anon_digits.get(digits, 0) * 2 >= 9 * 10 ** (digits - 1):
+            digits += 1
+        lo, hi = 10 ** (digits - 1), 10 ** digits - 1
+        while True:
+            anon = random.randint(lo, hi)
+            if anon not in self.by_anon:
+                return anon
+
+# -------------------------
+# Хранилище
+# -------------------------
+# Весь доступ к состоянию идёт через STORE. Изменения — записи record(op, ...)
+# (те же, что в журнале), чтение — методы хранилища. Бэкенд выбирается
+# переменной STORAGE_BACKEND: "json" (DATA в памяти + журнал, по умолчанию)
+# или "sqlite" (WAL, индексированные таблицы, ничего не держит целиком в памяти).
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data.sqlite3")
+SQLITE_BATCH = 500  # записей в одной транзакции, не больше
+SQLITE_BUSY_TIMEOUT = 10.0
+
+
+class JsonStorage:
+    """DATA в памяти + индексы + журнал с фоновой записью"""
+
+    name = "json"
+
+    def __init__(self):
+        self.data = load_data()
+        self.index = Index(self.data)
+        self.journal = Journal()
+
+    def apply(self, rec):
+        self.index.forget(rec)
+        apply_record(self.data, rec)
+        self.index.learn(rec)
+        self.journal.append(rec)
+
+    # --- пользователи ---
+    def get_user(self, uid):
+        return self.data["users"].get(uid)
+
+    def count_users(self):
+        return len(self.data["users"])
+
+    def iter_users(self, start=0, stop=None):
+        """(uid, info) в порядке регистрации, позиции [start, stop)"""
+        return self.data["users"].items_range(start, stop)
+
+    def users_page(self, start, stop):
+        return list(self.data["users"].items_range(start, stop))
+
+    def deliverable_users(self):
+        """uid активных незабаненных пользователей (получатели пересылки)"""
+        return self.data["users"].deliverable()
+
+    def muted_users(self):
+        """[(uid, muted_until)] для всех, у кого muted_until выставлен"""
+        return self.data["users"].muted_rows()
+
+    def count_inactive(self):
+        """Сколько пользователей помечено недоступными (active=False)"""
+        return len(self.data["users"].inactive)
+
+    def user_states(self):
+        """[(uid, user_data)] — сохранённое состояние диалогов"""
+        return list(self.data["user_state"].items())
+
+    def user_id_by_username(self, username):
+        return self.index.by_username.get(username)
+
+    def user_id_by_anon(self, anon):
+        return self.index.by_anon.get(anon)
+
+    def allocate_anon(self):
+        return self.index.allocate_anon()
+
+    # --- админы / баны / права ---
+    def is_admin(self, username):
+        return username in self.index.admins
+
+    def is_banned(self, username):
+        return username in self.index.banned
+
+    def admins(self):
+        return list(self.data["admins"])
+
+    def banned(self):
+        return list(self.data["banned"])
+
+    def count_admins(self):
+        return len(self.index.admins)
+
+    def count_banned(self):
+        return len(self.index.banned)
+
+    def get_perms(self, username):
+        return self.data["permissions"].get(username)
+
+    # --- прочее ---
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def reader(self):
+        """Копия для чтения из другого потока (экспорт)"""
+        return JsonReader(self.data)
+
+    def commit_pending(self):
+        # запись на диск и так идёт в фоне (Journal)
+        pass
+
+    def flush(self):
+        self.journal.flush()
+
+    def snapshot(self):
+        self.journal.compact()
+
+    def disk_bytes(self):
+        paths = (self.journal.snapshot_path, self.journal.path, self.journal.old_path)
+        return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    def close(self):
+        self.journal.close()
+
+class JsonReader:
+    """Неизменяемый срез DATA для чтения вне цикла событий.
+    Копирование словарей/списков атомарно под GIL, поэтому безопасно из потока."""
+
+    def __init__(self, data):
+        self.users = data["users"].copy()
+        self._admins = list(data["admins"])
+        self._banned = list(data["banned"])
+        self.permissions = dict(data["permissions"])
+        self.settings = {k: v for k, v in list(data.items()) if not isinstance(v, (dict, list))}
+
+    def iter_users(self):
+        return iter(self.users.items())
+
+    def admins(self):
+        return self._admins
+
+    def banned(self):
+        return self._banned
+
+    def get_perms(self, username):
+        perms = self.permissions.get(username)
+        return dict(perms) if perms is not None else None
+
+    def get(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def close(self):
+        pass
+
+class SqliteStorage:
+    """SQLite (WAL) с индексами по username/anon. Изменения копятся в открытой
+    транзакции и коммитятся пачкой: каждые batch записей, раз в
+    JOURNAL_FLUSH_MS (commit_pending из фоновой задачи) или по flush()."""
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL UNIQUE,
+            username TEXT,
+            anon INTEGER UNIQUE,
+            muted_until INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS users_username ON users(username);
+        CREATE INDEX IF NOT EXISTS users_muted ON users(muted_until) WHERE muted_until > 0;
+        CREATE INDEX IF NOT EXISTS users_inactive ON users(active) WHERE active = 0;
+        CREATE TABLE IF NOT EXISTS admins (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS banned (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS permissions (
+            username TEXT NOT NULL,
+            perm TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (username, perm)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_state (
+            uid TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            body TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    # SQL собран заранее: sqlite3 кэширует подготовленные выражения по тексту запроса
+    SQL_USER_UPSERT = (
+        "INSERT INTO users (uid, username, anon, muted_until, active) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(uid) DO UPDATE SET username=excluded.username, anon=excluded.anon, "
+        "muted_until=excluded.muted_until, active=excluded.active"
+    )
+    SQL_USER_SET = {f: f"UPDATE users SET {f} = ? WHERE uid = ?" for f in USER_FIELDS}
+    SQL_USER_GET = "SELECT username, anon, muted_until, active FROM users WHERE uid = ?"
+    SQL_USER_PAGE = "SELECT seq, uid, username, anon, muted_until, active FROM users WHERE seq > ? ORDER BY seq LIMIT ?"
+    SQL_DELIVERABLE_PAGE = (
+        "SELECT seq, uid FROM users WHERE seq > ? AND active = 1 "
+        "AND (username IS NULL OR '@' || username NOT IN (SELECT username FROM banned)) ORDER BY seq LIMIT ?"
+    )
+    SQL_PERM_UPSERT = (
+        "INSERT INTO permissions (username, perm, value) VALUES (?, ?, ?) "
+        "ON CONFLICT(username, perm) DO UPDATE SET value=excluded.value"
+    )
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        # timeout — ожидание блокировки записи, когда пишут несколько процессов (WORKERS > 1)
+        self.db = sqlite3.connect(path, cached_statements=256, timeout=SQLITE_BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._dirty = 0
+        self._last_commit = time.monotonic()
+        self.batch = SQLITE_BATCH
+        if self.needs_migration():
+            migrate_json_to_sqlite(self)
+        # сколько anon каждой длины занято — для allocate_anon
+        self.anon_digits = dict(self.db.execute(
+            "SELECT length(anon), COUNT(*) FROM users WHERE anon IS NOT NULL GROUP BY length(anon)"))
+
+    def needs_migration(self):
+        """Есть data.json/журнал, а перенос ещё не состоялся. Признак — ключ "migrated" в kv
+        (пишется в транзакции переноса); базы, заполненные до него, узнаём по непустым таблицам."""
+        if not (os.path.exists(DATA_FILE) or os.path.exists(DATA_JOURNAL)):
+            return False
+        if self.get("migrated") is not None:
+            return False
+        return not self.db.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM admins)").fetchone()[0]
+
+    @staticmethod
+    def _user_row(row):
+        username, anon, muted_until, active = row
+        info = {"username": username, "anon": anon, "muted_until": muted_until}
+        if not active:
+            info["active"] = False
+        return info
+
+    def apply(self, rec):
+        op = rec["op"]
+        db = self.db
+        if op == "user":
+            info = rec["info"]
+            anon = info.get("anon")
+            old = db.execute("SELECT anon FROM users WHERE uid = ?", (rec["uid"],)).fetchone()
+            try:
+                db.execute(self.SQL_USER_UPSERT, (
+                    rec["uid"], info.get("username"), anon,
+                    info.get("muted_until", 0), int(info.get("active", True))))
+            except sqlite3.IntegrityError:
+                if old is not None:
+                    raise
+                # тот же anon только что выдал другой процесс — берём другой
+                info["anon"] = self.allocate_anon()
+                return self.apply(rec)
+            if old is None and anon is not None:
+                digits = len(str(anon))
+                self.anon_digits[digits] = self.anon_digits.get(digits, 0) + 1
+        elif op == "user_set":
+            value = rec["value"]
+            if rec["field"] == "active":
+                value = int(value)
+            db.execute(self.SQL_USER_SET[rec["field"]], (value, rec["uid"]))
+        elif op == "admin_add":
+            db.execute("INSERT OR IGNORE INTO admins (username) VALUES (?)", (rec["username"],))
+        elif op == "admin_del":
+            db.execute("DELETE FROM admins WHERE username = ?", (rec["username"],))
+        elif op == "ban_add":
+            db.execute("INSERT OR IGNORE INTO banned (username) VALUES (?)", (rec["username"],))
+        elif op == "ban_del":
+            db.execute("DELETE FROM banned WHERE username = ?", (rec["username"],))
+        elif op == "perms":
+            db.execute("DELETE FROM permissions WHERE username = ?", (rec["username"],))
+            db.executemany(self.SQL_PERM_UPSERT,
+                           [(rec["username"], p, int(v)) for p, v in rec["perms"].items()])
+        elif op == "perms_del":
+            db.execute("DELETE FROM permissions WHERE username = ?", (rec["username"],))
+        elif op == "perm":
+            db.execute(self.SQL_PERM_UPSERT, (rec["username"], rec["perm"], int(rec["value"])))
+        elif op == "user_state":
+            if rec["data"]:
+                db.execute("INSERT OR REPLACE INTO user_state (uid, data) VALUES (?, ?)",
+                           (rec["uid"], json.dumps(rec["data"], ensure_ascii=False)))
+            else:
+                db.execute("DELETE FROM user_state WHERE uid = ?", (rec["uid"],))
+        elif op == "set":
+            db.execute("INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                       (rec["key"], json.dumps(rec["value"], ensure_ascii=False)))
+        else:
+            logger.warning(f"Unknown storage record: {rec}")
+            return
+        self._wrote()
+
+    def _wrote(self):
+        self._dirty += 1
+        if self._dirty >= self.batch:
+            self.commit_pending()
+
+    # --- пользователи ---
+    def get_user(self, uid):
+        row = self.db.execute(self.SQL_USER_GET, (uid,)).fetchone()
+        return self._user_row(row) if row else None
+
+    def count_users(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def iter_users(self, start=0, stop=None, page=1000):
+        """(uid, info) в порядке регистрации, позиции [start, stop); страницами по seq"""
+        pos = 0
+        last_seq = 0
+        if start:
+            row = self.db.execute("SELECT seq FROM users ORDER BY seq LIMIT 1 OFFSET ?", (start - 1,)).fetchone()
+            if row is None:
+                return
+            last_seq, pos = row[0], start
+        while stop is None or pos < stop:
+            rows = self.db.execute(self.SQL_USER_PAGE, (last_seq, page)).fetchall()
+            if not rows:
+                return
+            for seq, uid, *rest in rows:
+                if stop is not None and pos >= stop:
+                    return
+                yield uid, self._user_row(rest)
+                pos += 1
+            last_seq = rows[-1][0]
+
+    def users_page(self, start, stop):
+        return list(self.iter_users(start, stop))
+
+    def deliverable_users(self, page=1000):
+        last_seq = 0
+        while True:
+            rows = self.db.execute(self.SQL_DELIVERABLE_PAGE, (last_seq, page)).fetchall()
+            if not rows:
+                return
+            for seq, uid in rows:
+                yield uid
+            last_seq = rows[-1][0]
+
+    def count_inactive(self):
+        return self.db.execute("SELECT COUNT(*) FROM users WHERE active = 0").fetchone()[0]
+
+    def muted_users(self):
+        return self.db.execute("SELECT uid, muted_until FROM users WHERE muted_until > 0").fetchall()
+
+    def user_states(self):
+        return [(uid, json.loads(data)) for uid, data in self.db.execute("SELECT uid, data FROM user_state")]
+
+    def user_id_by_username(self, username):
+        if not username or not username.startswith("@"):
+            return None
+        row = self.db.execute("SELECT uid FROM users WHERE username = ?", (username[1:],)).fetchone()
+        return row[0] if row else None
+
+    def user_id_by_anon(self, anon):
+        row = self.db.execute("SELECT uid FROM users WHERE anon = ?", (anon,)).fetchone()
+        return row[0] if row else None
+
+    def allocate_anon(self):
+        # та же схема, что в Index.allocate_anon
+        digits = Index.ANON_MIN_DIGITS
+        while self.anon_digits.get(digits, 0) * 2 >= 9 * 10 ** (digits - 1):
+            digits += 1
+        lo, hi = 10 ** (digits - 1), 10 ** digits - 1
+        while True:
+            anon = random.randint(lo, hi)
+            if self.user_id_by_anon(anon) is None:
+                return anon
+
+    # --- админы / баны / права ---
+    def is_admin(self, username):
+        return self.db.execute("SELECT 1 FROM admins WHERE username = ?", (username,)).fetchone() is not None
+
+    def is_banned(self, username):
+        return self.db.execute("SELECT 1 FROM banned WHERE username = ?", (username,)).fetchone() is not None
+
+    def admins(self):
+        return [r[0] for r in self.db.execute("SELECT username FROM admins ORDER BY seq")]
+
+    def banned(self):
+        return [r[0] for r in self.db.execute("SELECT username FROM banned ORDER BY seq")]
+
+    def count_admins(self):
+        return self.db.execute("SELECT COUNT(*) FROM admins").fetchone()[0]
+
+    def count_banned(self):
+        return self.db.execute("SELECT COUNT(*) FROM banned").fetchone()[0]
+
+    def get_perms(self, username):
+        rows = self.db.execute("SELECT perm, value FROM permissions WHERE username = ?", (username,)).fetchall()
+        return {p: bool(v) for p, v in rows} if rows else None
+
+    # --- прочее ---
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    # --- общие для нескольких процессов (WORKERS > 1) ---
+    def bump_epoch(self, cache):
+        """Счётчик изменений кэша cache (roles, listings, mutes), по которому другие процессы его сбрасывают"""
+        self.db.execute("INSERT INTO kv (key, value) VALUES (?, 1) "
+                        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", (f"epoch.{cache}",))
+        self._wrote()
+
+    def epochs(self):
+        """{кэш: счётчик изменений}"""
+        rows = self.db.execute("SELECT key, value FROM kv WHERE key >= 'epoch.' AND key < 'epoch/'")
+        return {key[len("epoch."):]: int(value) for key, value in rows}
+
+    def outbox_put(self, sender, body):
+        """Анонимное сообщение в общую очередь: его разошлют все воркеры, каждый своим получателям"""
+        self.db.execute("INSERT INTO outbox (sender, body, created) VALUES (?, ?, ?)",
+                        (sender, json.dumps(body, ensure_ascii=False), time.time()))
+        self.commit_pending(force=True)
+
+    def outbox_last_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM outbox").fetchone()[0]
+
+    def outbox_since(self, last_id):
+        rows = self.db.execute("SELECT id, sender, body, created FROM outbox WHERE id > ? ORDER BY id",
+                               (last_id,)).fetchall()
+        return [(row_id, sender, json.loads(body), created) for row_id, sender, body, created in rows]
+
+    def outbox_trim(self, before):
+        self.db.execute("DELETE FROM outbox WHERE created < ?", (before,))
+        self._wrote()
+
+    def reader(self):
+        """Отдельное read-only соединение — для чтения из другого потока (экспорт)"""
+        reader = SqliteStorage.__new__(SqliteStorage)
+        reader.path = self.path
+        reader.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        reader._dirty = 0
+        return reader
+
+    def commit_pending(self, force=False):
+        if self._dirty or force:
+            self.db.commit()
+            self._dirty = 0
+            self._last_commit = time.monotonic()
+
+    def flush(self):
+        self.commit_pending()
+
+    def snapshot(self):
+        self.commit_pending()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def disk_bytes(self):
+        paths = (self.path, self.path + "-wal")
+        return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    def close(self):
+        self.commit_pending()
+        self.db.close()
+
+def migrate_json_to_sqlite(store):
+    """Одноразовый перенос data.json (+ журнал) в SQLite одной транзакцией: при ошибке
+    откатывается целиком, и следующий запуск пробует снова (см. needs_migration)"""
+    started = time.monotonic()
+    data = load_data()
+    db = store.db
+    # старый randint мог выдать один anon двоим, а в SQLite anon UNIQUE — повторам выдаём новые
+    index = Index(data)
+    users = []
+    for uid, info in data["users"].items():
+        anon = info.get("anon")
+        if anon is not None and index.by_anon.get(anon) != uid:
+            anon = index.allocate_anon()
+            index.link(uid, None, anon)
+            logger.warning(f"Migration: duplicate anon of user {uid} replaced with {anon}")
+        users.append((uid, info.get("username"), anon, info.get("muted_until", 0), int(info.get("active", True))))
+    try:
+        migrate_rows(store, data, users)
+    except Exception:
+        db.rollback()
+        raise
+    logger.info(f"Migrated {len(data['users'])} users from {DATA_FILE} to {store.path} "
+                f"in {time.monotonic() - started:.2f}s")
+
+def migrate_rows(store, data, users):
+    db = store.db
+    db.executemany(store.SQL_USER_UPSERT, users)
+    db.executemany("INSERT OR IGNORE INTO admins (username) VALUES (?)", ((a,) for a in data["admins"]))
+    db.executemany("INSERT OR IGNORE INTO banned (username) VALUES (?)", ((b,) for b in data["banned"]))
+    db.executemany(store.SQL_PERM_UPSERT, (
+        (username, p, int(v)) for username, perms in data["permissions"].items() for p, v in perms.items()
+    ))
+    db.executemany("INSERT OR REPLACE INTO user_state (uid, data) VALUES (?, ?)", (
+        (uid, json.dumps(state, ensure_ascii=False)) for uid, state in data["user_state"].items()
+    ))
+    for key, value in data.items():
+        if key not in ("users", "admins", "banned", "permissions", "user_state"):
+            db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                       (key, json.dumps(value, ensure_ascii=False)))
+    db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('migrated', ?)", (json.dumps(time.time()),))
+    db.commit()
+
+def open_storage(backend=STORAGE_BACKEND):
+    if backend == "sqlite":
+        return SqliteStorage()
+    if backend != "json":
+        raise RuntimeError(f"Неизвестный STORAGE_BACKEND: {backend}")
+    return JsonStorage()
+
+startup_phase("imports")
+STORE = open_storage()
+startup_phase("storage")
+# дописать/закоммитить изменения при любом завершении процесса
+atexit.register(STORE.close)
+
+def record(op, **fields):
+    """Единая точка изменения состояния: запись применяется к хранилищу (и попадает в журнал)"""
+    rec = {"op": op, **fields}
+    STORE.apply(rec)
+    shared = []  # какие кэши других процессов устарели
+    if rec["op"] in ROLE_OPS:
+        ROLES.invalidate(rec.get("username"))
+        shared.append("roles")
+    if rec["op"] == "user_set" and rec["field"] == "muted_until":
+        MUTES.changed(rec["uid"], rec["value"])
+        shared.append("mutes")
+    if listing_changed(rec):
+        LISTINGS.bump()
+        shared.append("listings")
+    if WORKERS > 1:
+        # остальные процессы увидят новый epoch и сбросят только эти кэши
+        for cache in shared:
+            STORE.bump_epoch(cache)
+
+def flush_data():
+    """Синхронно сохраняет изменения на диск — для критичных изменений (админы)"""
+    STORE.flush()
+
+def save_data():
+    """Полный снимок (data.json / checkpoint SQLite) — экспорт и остановка"""
+    started = time.perf_counter()
+    STORE.snapshot()
+    if METRICS_ENABLED:
+        METRICS.observe("bot_save_data_seconds", time.perf_counter() - started)
+        METRICS.set("bot_save_data_bytes", STORE.disk_bytes())
+
+# -------------------------
+# Несколько процессов
+# -------------------------
+# WORKERS > 1: главный процесс получает обновления (getUpdates или webhook) и
+# раздаёт их воркерам-процессам по id пользователя, так что обновления одного
+# пользователя обрабатываются одним воркером по порядку. Общее состояние —
+# в STORE (нужен бэкенд, доступный нескольким процессам: sqlite; другой — например,
+# поверх Redis — должен реализовать те же методы, включая bump_epoch/epochs и outbox_*).
+# Получатели рассылок и пересылки делятся между воркерами так же, по id.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))  # выставляется главным процессом для воркеров
+
+if WORKERS > 1:
+    if STORE.name == "json":
+        raise RuntimeError("WORKERS > 1 требует общего хранилища: STORAGE_BACKEND=sqlite")
+    # пока открыта транзакция, запись остальных воркеров синхронно ждёт блокировку
+    # (в своём цикле событий), поэтому каждая запись коммитится сразу
+    STORE.batch = 1
+
+def worker_for(user_id):
+    return abs(int(user_id)) % WORKERS
+
+def owns(user_id):
+    """Этот процесс отвечает за пользователя (при WORKERS=1 — за всех)"""
+    return WORKERS == 1 or worker_for(user_id) == WORKER_ID
+
+def is_leader():
+    """Общие для всех задачи (сжатие, отложенные рассылки) выполняет один воркер"""
+    return WORKER_ID == 0
+
+# -------------------------
+# Вспомогательные функции
+# -------------------------
+def ensure_user_registered(user):
+    """Добавляем пользователя в хранилище, если нет"""
+    uid = str(user.id)
+    info = STORE.get_user(uid)
+    if info is None:
+        anon = STORE.allocate_anon()
+        record("user", uid=uid, info={
+            "username": user.username if user.username else None,
+            "anon": anon,
+            "muted_until": 0
+        })
+    elif info.get("active") is False:
+        # раз пишет нам — снова доступен для пересылки
+        record("user_set", uid=uid, field="active", value=True)
+
+def get_anon_display(uid):
+    """возвращает 'Аноним#1234' для user_id строкой"""
+    info = STORE.get_user(str(uid))
+    if not info:
+        return "Аноним"
+    return f"Аноним#{info['anon']}"
+
+def is_banned_username(username):
+    if not username:
+        return False
+    return username.startswith("@") and STORE.is_banned(username)
+
+def is_admin_username(username):
+    return ROLES.get(username).is_admin
+
+def user_id_by_username(username):
+    """'@joe' -> str(user_id) или None"""
+    return STORE.user_id_by_username(username)
+
+def user_id_by_anon(anon):
+    """1234 -> str(user_id) или None"""
+    return STORE.user_id_by_anon(anon)
+
+def username_of_user_id(uid):
+    info = STORE.get_user(str(uid))
+    return info.get("username") if info else None
+
+def check_permission(username, perm):
+    """username like '@mellfreezy'"""
+    return perm in ROLES.get(username).perms
+
+def init_admin_if_none(admin_username):
+    """Если нет ни одного админа, добавляем заданного (используется при первом старте)"""
+    if not is_admin_username(admin_username):
+        record("admin_add", username=admin_username)
+    if STORE.get_perms(admin_username) is None:
+        # по умолчанию даём все права основателю
+        record("perms", username=admin_username, perms={p: True for p in ALL_PERMS})
+    flush_data()
+
+# -------------------------
+# Роли и права (кэш)
+# -------------------------
+# Роль пользователя (админ ли он и какие права включены) собирается из хранилища
+# один раз и кэшируется по @username. record() сбрасывает запись при изменении
+# админов или прав этого username.
+ROLE_CACHE_SIZE = 4096
+ROLE_OPS = {"admin_add", "admin_del", "perms", "perms_del", "perm"}
+
+class Role:
+    __slots__ = ("username", "is_admin", "perms")
+
+    def __init__(self, username, is_admin=False, perms=frozenset()):
+        self.username = username
+        self.is_admin = is_admin
+        self.perms = perms  # frozenset включённых прав
+
+    def can(self, perm):
+        """Админ с правом perm (perm=None — просто админ)"""
+        return self.is_admin and (perm is None or perm in self.perms)
+
+NOBODY = Role(None)
+
+class RoleCache:
+    def __init__(self, size=ROLE_CACHE_SIZE):
+        self.size = size
+        self._roles = OrderedDict()  # username -> Role
+
+    def get(self, username):
+        if not username or not username.startswith("@"):
+            return NOBODY
+        role = self._roles.get(username)
+        if role is not None:
+            self._roles.move_to_end(username)
+            return role
+        perms = STORE.get_perms(username) or {}
+        role = Role(username, STORE.is_admin(username), frozenset(p for p, v in perms.items() if v))
+        self._roles[username] = role
+        if len(self._roles) > self.size:
+            self._roles.popitem(last=False)
+        return role
+
+    def invalidate(self, username=None):
+        if username is None:
+            self._roles.clear()
+        else:
+            self._roles.pop(username, None)
+
+ROLES = RoleCache()
+
+# -------------------------
+# Списки для админ-панели (постранично, с кэшем)
+# -------------------------
+# Страницы рендерятся на сервере и кэшируются. Любая мутация пользователей,
+# банов, админов или прав увеличивает версию — закэшированные страницы
+# старой версии при следующем обращении перерисовываются.
+USERS_PAGE_SIZE = 50
+ADMINS_PAGE_SIZE = 20
+LISTING_CACHE_SIZE = 256
+TG_MESSAGE_LIMIT = 4096
+ADMIN_SEARCH_BYTES = 32  # префикс поиска в callback_data "ADMINS|страница|префикс"
+LISTING_OPS = {"user", "admin_add", "admin_del", "ban_add", "ban_del", "perms", "perms_del", "perm"}
+
+class ListingCache:
+    def __init__(self, size=LISTING_CACHE_SIZE):
+        self.size = size
+        self.version = 0
+        self._pages = OrderedDict()  # key -> (version, (text, keyboard))
+
+    def bump(self):
+        self.version += 1
+
+    def get(self, key, render):
+        entry = self._pages.get(key)
+        if entry is not None and entry[0] == self.version:
+            self._pages.move_to_end(key)
+            return entry[1]
+        page = render()
+        self._pages[key] = (self.version, page)
+        self._pages.move_to_end(key)
+        if len(self._pages) > self.size:
+            self._pages.popitem(last=False)
+        return page
+
+LISTINGS = ListingCache()
+
+def listing_changed(rec):
+    """Меняет ли запись то, что показывают списки"""
+    if rec["op"] == "user_set":
+        return rec["field"] in ("username", "anon")
+    return rec["op"] in LISTING_OPS
+
+def pager_keyboard(prefix, page, pages, suffix="", extra=None):
+    """Кнопки ⏮ ◀ n/N ▶ ⏭ (+ переход на 10 страниц) для callback вида PREFIX|page[|suffix]"""
+    def cb(p):
+        return f"{prefix}|{p}|{suffix}" if suffix else f"{prefix}|{p}"
+    nav = []
+    if page > 0:
+        nav += [InlineKeyboardButton("⏮", callback_data=cb(0)), InlineKeyboardButton("◀", callback_data=cb(page - 1))]
+    nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="NOOP"))
+    if page < pages - 1:
+        nav += [InlineKeyboardButton("▶", callback_data=cb(page + 1)), InlineKeyboardButton("⏭", callback_data=cb(pages - 1))]
+    rows = [nav]
+    if pages > 10:
+        rows.append([InlineKeyboardButton("-10", callback_data=cb(max(0, page - 10))),
+                     InlineKeyboardButton("+10", callback_data=cb(min(pages - 1, page + 10)))])
+    if extra:
+        rows.append(extra)
+    rows.append([InlineKeyboardButton("Назад", callback_data="ADMIN_PANEL")])
+    return InlineKeyboardMarkup(rows)
+
+def clamp_page(page, total, size):
+    pages = max(1, -(-total // size))
+    return min(max(page, 0), pages - 1), pages
+
+def render_users_page(page):
+    page, pages = clamp_page(page, STORE.count_users(), USERS_PAGE_SIZE)
+    lines = []
+    for uid, info in STORE.users_page(page * USERS_PAGE_SIZE, (page + 1) * USERS_PAGE_SIZE):
+        username = f"@{info['username']}" if info.get("username") else "(без username)"
+        if is_banned_username(username):
+            lines.append(f"Забанен — {username}")
+        else:
+            lines.append(f"Аноним#{info['anon']} — {username}")
+    text = "👥 Пользователи:\n" + ("\n".join(lines) if lines else "— нет пользователей —")
+    return text[:TG_MESSAGE_LIMIT], pager_keyboard("USERS", page, pages)
+
+def render_admins_page(page, prefix=""):
+    admins = STORE.admins()
+    if prefix:
+        admins = [a for a in admins if a.lower().startswith(prefix.lower())]
+    page, pages = clamp_page(page, len(admins), ADMINS_PAGE_SIZE)
+    lines = []
+    for a in admins[page * ADMINS_PAGE_SIZE:(page + 1) * ADMINS_PAGE_SIZE]:
+        perms = STORE.get_perms(a) or {}
+        perms_str = ", ".join(f"{k}:{'✅' if perms.get(k) else '❌'}" for k in ALL_PERMS)
+        lines.append(f"{a} — {perms_str}")
+    head = f"🧑‍💼 Администраторы ({prefix}…):\n" if prefix else "🧑‍💼 Администраторы:\n"
+    text = head + ("\n".join(lines) if lines else "— нет админов —")
+    search = [InlineKeyboardButton("🔍 Поиск", callback_data="ADMINS_SEARCH")]
+    return text[:TG_MESSAGE_LIMIT], pager_keyboard("ADMINS", page, pages, prefix, extra=search)
+
+def users_listing(page):
+    return LISTINGS.get(("users", page), lambda: render_users_page(page))
+
+def admins_listing(page, prefix=""):
+    if prefix and not prefix.startswith("@"):
+        prefix = "@" + prefix
+    # callback_data ограничен 64 байтами UTF-8 (не символами: кириллица — по два), "|" — разделитель
+    prefix = prefix.replace("|", "").encode()[:ADMIN_SEARCH_BYTES].decode("utf-8", "ignore")
+    return LISTINGS.get(("admins", page, prefix), lambda: render_admins_page(page, prefix))
+
+# -------------------------
+# UI helpers
+# -------------------------
+def perms_to_keyboard_for_user(target_username):
+    """Возвращает InlineKeyboard с кнопками для переключения прав для target_username"""
+    perms = STORE.get_perms(target_username) or {p: False for p in ALL_PERMS}
+    rows = []
+    for p in ALL_PERMS:
+        mark = "✅" if perms.get(p, False) else "❌"
+        # callback пример: "TOGGLE|@user|perm"
+        rows.append([InlineKeyboardButton(f"{mark} {p}", callback_data=f"TOGGLE|{target_username}|{p}")])
+    # кнопка назад
+    rows.append([InlineKeyboardButton("Назад", callback_data="ADMIN_PANEL")])
+    return InlineKeyboardMarkup(rows)
+
+def admin_panel_keyboard():
+    kb = [
+        [InlineKeyboardButton("👥 Пользователи", callback_data="SHOW_USERS")],
+        [InlineKeyboardButton("🚫 Забаненные", callback_data="SHOW_BANNED")],
+        [InlineKeyboardButton("🧑‍💼 Администраторы", callback_data="SHOW_ADMINS")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="SHOW_STATS")],
+        [InlineKeyboardButton("➕ Добавить админа", callback_data="ADD_ADMIN"),
+         InlineKeyboardButton("➖ Удалить админа", callback_data="REMOVE_ADMIN")],
+        [InlineKeyboardButton("⚙️ Установить разрешения", callback_data="SET_PERMS"),
+         InlineKeyboardButton("⏱️ Тайм-аут / Мут", callback_data="MUTE_USER")],
+        [InlineKeyboardButton("📤 Экспорт данных", callback_data="EXPORT_DATA"),
+         InlineKeyboardButton("📢 Рассылка", callback_data="BROADCAST")],
+        [InlineKeyboardButton("🧑‍💬 Писать от имени", callback_data="IMPERSONATE"),
+         InlineKeyboardButton("💬 Режим только админов", callback_data="TOGGLE_ADMIN_CHAT")],
+    ]
+    return InlineKeyboardMarkup(kb)
+
+# -------------------------
+# Экспорт (потоковый)
+# -------------------------
+# Записи выгружаются генератором построчно (JSON Lines или CSV, по желанию gzip)
+# во временные файлы в отдельном потоке. Если файл дорастает до EXPORT_PART_LIMIT,
+# начинается следующая часть — у Telegram лимит 50 МБ на документ от бота.
+EXPORT_PART_LIMIT = int(os.getenv("EXPORT_PART_LIMIT", str(45 * 1024 * 1024)))
+EXPORT_FILTERS = ("all", "users", "muted", "admins", "banned")
+EXPORT_FORMATS = ("jsonl", "jsonl.gz", "csv", "csv.gz")
+EXPORT_CSV_FIELDS = ("type", "uid", "username", "anon", "muted_until", "active", "perms", "key", "value")
+EXPORT_SETTINGS = ("message_count", "admin_chat_enabled")
+
+def export_rows(reader, what, now=None):
+    """Строки экспорта для фильтра what (см. EXPORT_FILTERS)"""
+    now = now or time.time()
+    if what in ("all", "users", "muted"):
+        for uid, info in reader.iter_users():
+            info = dict(info)
+            if what == "muted" and info.get("muted_until", 0) <= now:
+                continue
+            yield {
+                "type": "user",
+                "uid": uid,
+                "username": info.get("username"),
+                "anon": info.get("anon"),
+                "muted_until": info.get("muted_until", 0),
+                "active": info.get("active", True),
+            }
+    if what in ("all", "admins"):
+        for username in reader.admins():
+            perms = reader.get_perms(username) or {}
+            yield {"type": "admin", "username": username, "perms": [p for p in ALL_PERMS if perms.get(p)]}
+    if what in ("all", "banned"):
+        for username in reader.banned():
+            yield {"type": "banned", "username": username}
+    if what == "all":
+        defaults = empty_data()
+        for key in EXPORT_SETTINGS:
+            yield {"type": "setting", "key": key, "value": reader.get(key, defaults[key])}
+
+class ExportWriter:
+    """Пишет строки экспорта в части (временные файлы) не больше limit байт"""
+
+    def __init__(self, fmt, basename, limit=EXPORT_PART_LIMIT):
+        self.csv = fmt.startswith("csv")
+        self.gzip = fmt.endswith(".gz")
+        self.ext = fmt
+        self.basename = basename
+        self.limit = limit
+        self.parts = []  # [(имя файла, файловый объект с начала)]
+        self.raw = None
+
+    def _open_part(self):
+        # модули нужны только экспорту — не импортируем их при старте
+        import csv, gzip, tempfile
+        self.raw = tempfile.TemporaryFile()
+        self.out = gzip.GzipFile(fileobj=self.raw, mode="wb") if self.gzip else self.raw
+        self.text = io.TextIOWrapper(self.out, encoding="utf-8", newline="")
+        if self.csv:
+            self.writer = csv.DictWriter(self.text, fieldnames=EXPORT_CSV_FIELDS, extrasaction="ignore")
+            self.writer.writeheader()
+
+    def _close_part(self):
+        self.text.flush()
+        self.text.detach()
+        if self.gzip:
+            self.out.close()  # дописывает хвост gzip, сам raw не закрывает
+        self.raw.seek(0)
+        self.parts.append((f"{self.basename}.part{len(self.parts) + 1}.{self.ext}", self.raw))
+        self.raw = None
+
+    def write(self, row):
+        if self.raw is None:
+            self._open_part()
+        elif self.raw.tell() >= self.limit:
+            self._close_part()
+            self._open_part()
+        if self.csv:
+            if "perms" in row:
+                row = {**row, "perms": ",".join(row["perms"])}
+            self.writer.writerow(row)
+        else:
+            self.text.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.raw is None:
+            self._open_part()
+        self._close_part()
+        if len(self.parts) == 1:
+            # одна часть — без суффикса .part1
+            self.parts = [(f"{self.basename}.{self.ext}", self.parts[0][1])]
+        return self.parts
+
+def build_export(what, fmt):
+    """Собирает экспорт; вызывается вне цикла событий (asyncio.to_thread)"""
+    started = time.monotonic()
+    reader = STORE.reader()
+    writer = ExportWriter(fmt, f"export-{what}-{time.strftime('%Y%m%d-%H%M%S')}")
+    rows = 0
+    try:
+        for row in export_rows(reader, what):
+            writer.write(row)
+            rows += 1
+        parts = writer.close()
+    finally:
+        reader.close()
+    logger.info(f"Export {what}/{fmt}: {rows} rows, {len(parts)} part(s) in {time.monotonic() - started:.2f}s")
+    return parts
+
+def export_keyboard():
+    kb = [
+        [InlineKeyboardButton("📦 Всё (JSONL.gz)", callback_data="EXPORT|all|jsonl.gz")],
+        [InlineKeyboardButton("👥 Пользователи (CSV)", callback_data="EXPORT|users|csv.gz")],
+        [InlineKeyboardButton("⏱️ Замьюченные (CSV)", callback_data="EXPORT|muted|csv")],
+        [InlineKeyboardButton("🧑‍💼 Админы (JSONL)", callback_data="EXPORT|admins|jsonl"),
+         InlineKeyboardButton("🚫 Забаненные (CSV)", callback_data="EXPORT|banned|csv")],
+        [InlineKeyboardButton("Назад", callback_data="ADMIN_PANEL")],
+    ]
+    return InlineKeyboardMarkup(kb)
+
+# -------------------------
+# Метрики (Prometheus)
+# -------------------------
+# Счётчики и гистограммы живут в обычных словарях: пишет их цикл событий, а
+# /metrics из потока Flask только читает (копии под GIL). METRICS_ENABLED=0
+# выключает маршрут /metrics и все обёртки на горячем пути.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 1.0  # секунд между замерами задержки цикла событий
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+class Metrics:
+    """Реестр метрик. Серия — (имя, labels), labels — кортеж пар (ключ, значение)"""
+
+    def __init__(self):
+        self.meta = {}    # имя -> (тип, описание)
+        self.series = {}  # имя -> {labels: число | Histogram}
+        self.funcs = {}   # имя -> функция () -> {labels: число}, вычисляется при выдаче
+
+    def define(self, name, kind, text, func=None):
+        self.meta[name] = (kind, text)
+        if func is None:
+            self.series.setdefault(name, {})
+        else:
+            self.funcs[name] = func
+
+    def inc(self, name, labels=(), value=1):
+        series = self.series[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=()):
+        self.series[name][labels] = value
+
+    def histogram(self, name, labels=()):
+        series = self.series[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram()
+        return hist
+
+    def observe(self, name, value, labels=()):
+        self.histogram(name, labels).observe(value)
+
+    def render(self):
+        """Text exposition format 0.0.4"""
+        out = []
+        for name, (kind, text) in list(self.meta.items()):
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            func = self.funcs.get(name)
+            samples = func() if func else dict(self.series[name])
+            for labels, value in samples.items():
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, n in zip((*value.bounds, "+Inf"), list(value.counts)):
+                        cumulative += n
+                        out.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                    out.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                    out.append(f"{name}_count{format_labels(labels)} {value.count}")
+                else:
+                    out.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.define("bot_updates_total", "counter", "Updates received, by type")
+METRICS.define("bot_handler_seconds", "histogram", "Handler latency, by handler")
+METRICS.define("bot_handler_errors_total", "counter", "Handler exceptions, by handler")
+METRICS.define("bot_callback_seconds", "histogram", "Callback route latency, by route")
+METRICS.define("bot_api_seconds", "histogram", "Bot API call latency, by method")
+METRICS.define("bot_api_calls_total", "counter", "Bot API calls, by method")
+METRICS.define("bot_api_errors_total", "counter", "Bot API errors, by method and HTTP code (429 = flood limit)")
+METRICS.define("bot_save_data_seconds", "histogram", "save_data() duration")
+METRICS.define("bot_save_data_bytes", "gauge", "Size on disk after the last save_data()")
+METRICS.define("bot_event_loop_lag_seconds", "histogram", "Event loop scheduling lag")
+METRICS.define("bot_startup_seconds", "gauge", "Startup duration, by phase",
+               lambda: {(("phase", name),): seconds for name, seconds in STARTUP_PHASES})
+
+# для /healthz: отметки времени (monotonic) — работают и при выключенных метриках
+HEALTH = {"started": time.monotonic(), "loop_beat": None, "loop_lag": 0.0, "last_update": None}
+
+def metered(name, handler):
+    """Оборачивает хендлер PTB: длительность и исключения с label handler=name"""
+    if not METRICS_ENABLED:
+        return handler
+    labels = (("handler", name),)
+
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            METRICS.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            METRICS.observe("bot_handler_seconds", time.perf_counter() - started, labels)
+    return wrapper
+
+async def count_update(update, context):
+    """TypeHandler в группе -1: считает все обновления по типу до остальных хендлеров"""
+    HEALTH["last_update"] = time.monotonic()
+    kind = next((t for t in Update.ALL_TYPES if getattr(update, t, None) is not None), "other")
+    METRICS.inc("bot_updates_total", (("type", kind),))
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, считающий вызовы Bot API, их длительность и ошибки по методу"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            METRICS.inc("bot_api_errors_total", labels + (("code", "network"),))
+            raise
+        finally:
+            METRICS.observe("bot_api_seconds", time.perf_counter() - started, labels)
+        METRICS.inc("bot_api_calls_total", labels)
+        if code >= 400:
+            METRICS.inc("bot_api_errors_total", labels + (("code", str(code)),))
+        return code, payload
+
+async def loop_monitor():
+    # задержка: насколько позже заказанного просыпается sleep() — время, когда цикл занят
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        now = time.monotonic()
+        lag = max(0.0, now - started - LOOP_LAG_INTERVAL)
+        HEALTH["loop_beat"], HEALTH["loop_lag"] = now, lag
+        if METRICS_ENABLED:
+            METRICS.observe("bot_event_loop_lag_seconds", lag)
+
+# -------------------------
+# Ограничение скорости Bot API
+# -------------------------
+# Telegram: около 30 сообщений в секунду на бота и не чаще 1 сообщения в секунду в один чат.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_PER_CHAT_INTERVAL = float(os.getenv("TG_PER_CHAT_INTERVAL", "1.0"))
+TG_MAX_RETRIES = 3
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """RetryAfter от Telegram относится ко всему боту — придерживаем всех"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class ChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат"""
+
+    def __init__(self, interval, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next = {}  # chat_id -> monotonic time следующей разрешённой отправки
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        at = self._next.get(chat_id, 0.0)
+        self._next[chat_id] = max(at, now) + self.interval
+        if len(self._next) > self.max_chats:
+            self._next = {c: t for c, t in self._next.items() if t > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+
+# лимит Telegram общий на бота — делим поровну между процессами
+GLOBAL_LIMITER = TokenBucket(TG_GLOBAL_RATE / WORKERS)
+CHAT_LIMITER = ChatLimiter(TG_PER_CHAT_INTERVAL)
+
+def retry_after_seconds(e):
+    # в новых версиях PTB retry_after может быть timedelta
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+async def call_limited(limit_chat_id, func, /, *args, **kwargs):
+    """Вызов Bot API в чат limit_chat_id с учётом лимитов и повтором после RetryAfter"""
+    for attempt in range(TG_MAX_RETRIES + 1):
+        await CHAT_LIMITER.acquire(limit_chat_id)
+        await GLOBAL_LIMITER.acquire()
+        try:
+            return await func(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == TG_MAX_RETRIES:
+                raise
+            delay = retry_after_seconds(e)
+            logger.warning(f"Flood limit hit, retry after {delay}s")
+            GLOBAL_LIMITER.pause(delay)
+
+async def send_limited(bot, chat_id, text, **kwargs):
+    return await call_limited(chat_id, bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+# -------------------------
+# Результаты доставки
+# -------------------------
+# Каждая доставка пересылки и рассылки заканчивается одним из исходов:
+#   ok          — доставлено;
+#   forbidden   — бот заблокирован или аккаунт удалён: чат мёртв сразу;
+#   not_found   — chat not found: мёртв после DELIVERY_NOT_FOUND_STREAK неудач подряд;
+#   retry_after — флуд-лимит не отпустил за TG_MAX_RETRIES повторов;
+#   transient   — сеть, таймауты, прочие ошибки: только считаем.
+# Мёртвый чат помечается active=False: пересылка и рассылки его пропускают, пока
+# пользователь сам не напишет боту (ensure_user_registered вернёт active).
+DELIVERY_NOT_FOUND_STREAK = int(os.getenv("DELIVERY_NOT_FOUND_STREAK", "2"))
+# потолок числа отслеживаемых серий: у получателя с одними временными ошибками серия
+# не кончается ни успехом, ни пометкой — при переполнении забываем самые давние
+DELIVERY_STREAKS_MAX = int(os.getenv("DELIVERY_STREAKS_MAX", "10000"))
+DELIVERY_OUTCOMES = ("ok", "forbidden", "not_found", "retry_after", "transient")
+NOT_FOUND_ERRORS = ("chat not found", "user not found", "peer_id_invalid")
+
+def classify_delivery_error(e):
+    if isinstance(e, Forbidden):
+        return "forbidden"
+    if isinstance(e, RetryAfter):
+        return "retry_after"
+    if isinstance(e, BadRequest) and any(m in str(e).lower() for m in NOT_FOUND_ERRORS):
+        return "not_found"
+    return "transient"
+
+class DeliveryTracker:
+    def __init__(self):
+        self.counts = dict.fromkeys(DELIVERY_OUTCOMES, 0)
+        # uid -> неудач подряд, свежие в конце; запись удаляют успех и пометка недоступным
+        self.streaks = OrderedDict()
+        self.marked_dead = 0
+
+    def success(self, uid):
+        self.counts["ok"] += 1
+        if self.streaks:
+            self.streaks.pop(uid, None)
+
+    def failure(self, uid, e):
+        """Учитывает ошибку доставки в uid; True — чат мёртв и помечен недоступным"""
+        outcome = classify_delivery_error(e)
+        self.counts[outcome] += 1
+        streak = self.streaks.pop(uid, 0) + 1
+        if outcome == "forbidden" or (outcome == "not_found" and streak >= DELIVERY_NOT_FOUND_STREAK):
+            self.mark_dead(uid, e)
+            return True
+        self.streaks[uid] = streak
+        if len(self.streaks) > DELIVERY_STREAKS_MAX:
+            self.streaks.popitem(last=False)
+        logger.warning(f"Delivery to {uid} failed ({outcome}, {streak} in a row): {e}")
+        return False
+
+    def mark_dead(self, uid, e):
+        info = STORE.get_user(uid)
+        if info is not None and info.get("active", True):
+            record("user_set", uid=uid, field="active", value=False)
+            self.marked_dead += 1
+            logger.info(f"Recipient {uid} marked inactive: {e}")
+
+DELIVERY = DeliveryTracker()
+METRICS.define("bot_delivery_total", "counter", "Delivery outcomes (ok, forbidden, not_found, retry_after, transient)",
+               lambda: {(("outcome", k),): v for k, v in DELIVERY.counts.items()})
+METRICS.define("bot_delivery_failing_recipients", "gauge", "Recipients with a current failure streak",
+               lambda: {(): len(DELIVERY.streaks)})
+METRICS.define("bot_delivery_marked_dead_total", "counter", "Recipients marked inactive after delivery errors",
+               lambda: {(): DELIVERY.marked_dead})
+
+# -------------------------
+# Вложения (фото, видео, голосовые, альбомы)
+# -------------------------
+# Файл уже лежит у Telegram, поэтому вложение пересылается по file_id: каждому
+# получателю — один вызов send_photo/send_video/… без скачивания и загрузки.
+# copy_message не подходит: отправитель может удалить исходное сообщение раньше,
+# чем пересылка дойдёт до всех, а рассылка ещё и переживает перезапуск.
+# Вложение описывается словарём (его можно положить в outbox и в STORE["broadcast"]):
+#   {"type": "photo", "file_id": ..., "caption": ...}
+#   {"type": "album", "items": [{"type": ..., "file_id": ..., "caption": ...}, ...]}
+# Альбом приходит отдельными апдейтами с общим media_group_id: ALBUMS собирает
+# части и отдаёт альбом целиком, когда ALBUM_WAIT секунд не было новых, —
+# получатели получают его одним send_media_group.
+MEDIA_TYPES = ("photo", "video", "animation", "audio", "voice", "document")  # у GIF заполнен и document
+MEDIA_FILTER = (filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.AUDIO | filters.VOICE
+                | filters.Document.ALL)
+ALBUM_INPUT = {"photo": InputMediaPhoto, "video": InputMediaVideo, "audio": InputMediaAudio,
+               "document": InputMediaDocument}
+CAPTION_LIMIT = 1024
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "1.0"))
+
+def message_media(message):
+    """Вложение сообщения или None, если это просто текст"""
+    for kind in MEDIA_TYPES:
+        obj = getattr(message, kind, None)
+        if obj:
+            if kind == "photo":
+                obj = obj[-1]  # самый крупный размер
+            return {"type": kind, "file_id": obj.file_id, "caption": message.caption or ""}
+    return None
+
+def clip_text(text, limit):
+    """text не длиннее limit в единицах UTF-16 — так длину считает Telegram (эмодзи — две)"""
+    if len(text) * 2 <= limit:
+        return text
+    encoded = text.encode("utf-16-le")
+    if len(encoded) <= limit * 2:
+        return text
+    return encoded[:limit * 2].decode("utf-16-le", "ignore")
+
+def media_caption(media):
+    return (media["items"][0] if media["type"] == "album" else media).get("caption", "")
+
+def with_caption(media, caption):
+    """Копия media с подписью caption (у альбома — на первой части)"""
+    caption = clip_text(caption, CAPTION_LIMIT)
+    if media["type"] == "album":
+        items = [dict(i) for i in media["items"]]
+        items[0]["caption"] = caption
+        return {"type": "album", "items": items}
+    return dict(media, caption=caption)
+
+def resolve_body(bot, body):
+    """(метод Bot API, аргументы без chat_id) для текста или вложения. Собирается один
+    раз на сообщение или рассылку и переиспользуется для всех получателей."""
+    if isinstance(body, str):
+        return bot.send_message, {"text": body}
+    kind = body["type"]
+    if kind == "album":
+        media = [ALBUM_INPUT[i["type"]](i["file_id"], caption=i.get("caption") or None) for i in body["items"]]
+        return bot.send_media_group, {"media": media}
+    return getattr(bot, f"send_{kind}"), {kind: body["file_id"], "caption": body.get("caption") or None}
+
+async def send_resolved(chat_id, call):
+    func, kwargs = call
+    return await call_limited(chat_id, func, chat_id=chat_id, **kwargs)
+
+class Albums:
+    def __init__(self):
+        self.pending = {}  # media_group_id -> {"items": [...], "deliver": func(text, media) или None}
+
+    def add(self, group_id, media):
+        """Копит часть альбома; True — это первая часть (по ней и решается судьба альбома)"""
+        album = self.pending.get(group_id)
+        first = album is None
+        if first:
+            album = self.pending[group_id] = {"items": [], "deliver": None}
+        album["items"].append(media)
+        SCHEDULER.at(time.time() + ALBUM_WAIT, self.flush, group_id, key=("album", group_id))
+        return first
+
+    async def deliver(self, group_id, text, media, func):
+        """func(text, media) сразу или, для альбома, когда соберутся все части.
+        Альбом, для которого deliver не вызвали, при сборке просто выбрасывается."""
+        if group_id:
+            self.pending[group_id]["deliver"] = func
+            return
+        result = func(text, media)
+        if asyncio.iscoroutine(result):
+            await result
+
+    def flush(self, group_id):
+        album = self.pending.pop(group_id, None)
+        if not album or not album["deliver"]:
+            return None
+        items = album["items"]
+        media = items[0] if len(items) == 1 else {"type": "album", "items": items}
+        return album["deliver"](media_caption(media).strip(), media)
+
+ALBUMS = Albums()
+
+# -------------------------
+# Фоновые задачи
+# -------------------------
+# Бесконечные циклы (воркеры, периодические задачи) нельзя запускать через
+# application.create_task: Application.stop() ждёт такие задачи. Поэтому свои
+# задачи держим отдельно и отменяем в post_stop.
+BACKGROUND_TASKS = set()
+
+def spawn(coro, name=None):
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    task.add_done_callback(log_task_failure)
+    return task
+
+def log_task_failure(task):
+    # исключение фоновой задачи иначе всплыло бы только при сборке мусора, если вообще
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        logger.error(f"Background task {task.get_name()} crashed: {e!r}", exc_info=e)
+
+async def stop_background():
+    tasks = list(BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# -------------------------
+# Рассылка (фоновая задача)
+# -------------------------
+# Состояние активной рассылки хранится в STORE под ключом "broadcast" (через журнал), поэтому
+# прерванная перезапуском рассылка продолжается с сохранённого курсора.
+# Курсор — число подряд обработанных пользователей в порядке регистрации
+# (порядок пользователей в хранилище стабилен: они только добавляются).
+# После перезапуска возможны повторы для тех, кто был «в полёте» (не больше BROADCAST_CONCURRENCY).
+# При WORKERS > 1 рассылку ведут все воркеры, каждый — своим получателям (owns) со своим
+# курсором под ключом "broadcast.<WORKER_ID>"; сообщение с прогрессом обновляет и
+# рассылку завершает ведущий воркер, когда закончат все.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_PROGRESS_EVERY = 3.0  # секунд между обновлениями сообщения с прогрессом
+
+BROADCAST_TASK = None
+BROADCAST_LAUNCHING = False  # launch_broadcast между проверкой и записью состояния (там есть await)
+BROADCAST_JOB = None  # текущая BroadcastJob — для /metrics и /healthz
+
+def broadcast_part_key(worker_id=None):
+    if WORKERS == 1:
+        return "broadcast"
+    return f"broadcast.{WORKER_ID if worker_id is None else worker_id}"
+
+def broadcast_part(state, worker_id=None):
+    """Доля воркера в рассылке state (пустая, если он её ещё не начинал)"""
+    part = STORE.get(broadcast_part_key(worker_id)) or {}
+    return part if part.get("id") == state.get("id") else {}
+
+class BroadcastJob:
+    def __init__(self, bot, state):
+        self.bot = bot
+        self.state = dict(state)
+        if WORKERS > 1:
+            part = broadcast_part(state)
+            self.state.update(cursor=part.get("cursor", 0), sent=part.get("sent", 0), failed=part.get("failed", 0))
+        self.total = self.state["total"]
+        self.cursor = self.state["cursor"]
+        self.sent = self.state["sent"]
+        self.failed = self.state["failed"]
+        self._done = set()
+        body = f"📢 Рассылка:\n\n{self.state['text']}".rstrip()
+        media = self.state.get("media")
+        self.call = resolve_body(bot, with_caption(media, body) if media else clip_text(body, TG_MESSAGE_LIMIT))
+
+    @property
+    def remaining(self):
+        return self.total - self.cursor
+
+    def totals(self):
+        """(отправлено, ошибок, осталось) — при WORKERS > 1 по всем воркерам"""
+        if WORKERS == 1:
+            return self.sent, self.failed, self.remaining
+        sent, failed, left = self.sent, self.failed, self.remaining
+        for w in range(WORKERS):
+            if w != WORKER_ID:
+                part = broadcast_part(self.state, w)
+                sent += part.get("sent", 0)
+                failed += part.get("failed", 0)
+                left += self.total - part.get("cursor", 0)
+        # каждый воркер проходит всех, но шлёт только своей доле
+        return sent, failed, left // WORKERS
+
+    def progress_text(self, finished=False):
+        sent, failed, left = self.totals()
+        head = "✅ Рассылка завершена." if finished else "📢 Рассылка идёт…"
+        return f"{head}\nОтправлено: {sent}\nОшибок: {failed}\nОсталось: {left}"
+
+    def save_cursor(self, done=False):
+        self.state.update(cursor=self.cursor, sent=self.sent, failed=self.failed)
+        if WORKERS == 1:
+            record("set", key="broadcast", value=dict(self.state))
+        else:
+            record("set", key=broadcast_part_key(), value={
+                "id": self.state.get("id"), "cursor": self.cursor, "sent": self.sent,
+                "failed": self.failed, "done": done})
+
+    def parts_done(self):
+        return all(broadcast_part(self.state, w).get("done") for w in range(WORKERS))
+
+    async def update_progress(self, finished=False):
+        if not is_leader():
+            return
+        chat_id = self.state.get("chat_id")
+        message_id = self.state.get("message_id")
+        if not chat_id or not message_id:
+            return
+        try:
+            await call_limited(chat_id, self.bot.edit_message_text, chat_id=chat_id,
+                               message_id=message_id, text=self.progress_text(finished))
+        except BadRequest:
+            # "message is not modified" и удалённое сообщение с прогрессом
+            pass
+        except Exception as e:
+            logger.warning(f"Broadcast progress update failed: {e}")
+
+    async def _producer(self, queue):
+        # получатели читаются из хранилища постранично, а не списком целиком
+        for i, (uid, info) in enumerate(STORE.iter_users(self.cursor, self.total), self.cursor):
+            await queue.put((i, uid, info))
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)
+
+    async def _worker(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            i, uid, info = item
+            username = info.get("username")
+            if (owns(uid) and info.get("active", True)
+                    and not (username and is_banned_username(f"@{username}"))):
+                try:
+                    await send_resolved(int(uid), self.call)
+                    self.sent += 1
+                    DELIVERY.success(uid)
+                except Exception as e:
+                    self.failed += 1
+                    DELIVERY.failure(uid, e)
+            self._done.add(i)
+            while self.cursor in self._done:
+                self._done.discard(self.cursor)
+                self.cursor += 1
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_EVERY)
+            self.save_cursor()
+            await self.update_progress()
+
+    async def run(self):
+        reporter = asyncio.create_task(self._reporter())
+        queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 4)
+        try:
+            await asyncio.gather(self._producer(queue),
+                                 *(self._worker(queue) for _ in range(BROADCAST_CONCURRENCY)))
+        except asyncio.CancelledError:
+            # остановка бота: курсор сохранён, после перезапуска продолжим
+            self.save_cursor()
+            raise
+        finally:
+            reporter.cancel()
+        if WORKERS > 1:
+            self.save_cursor(done=True)
+            if not is_leader():
+                logger.info(f"Broadcast part finished: sent={self.sent} failed={self.failed}")
+                return
+            while not self.parts_done():
+                await self.update_progress()
+                await asyncio.sleep(BROADCAST_PROGRESS_EVERY)
+        else:
+            self.save_cursor()
+        sent, failed, _ = self.totals()
+        record("set", key="broadcast", value=None)
+        await self.update_progress(finished=True)
+        # доли стираем после итогового прогресса — он их суммирует
+        for w in range(WORKERS if WORKERS > 1 else 0):
+            record("set", key=broadcast_part_key(w), value=None)
+        logger.info(f"Broadcast finished: sent={sent} failed={failed}")
+
+def broadcast_running():
+    return BROADCAST_TASK is not None and not BROADCAST_TASK.done()
+
+def broadcast_busy():
+    """Новую рассылку начинать нельзя: идёт, запускается или сохранена (её ведёт другой воркер)"""
+    return BROADCAST_LAUNCHING or broadcast_running() or bool(STORE.get("broadcast"))
+
+def start_broadcast(application):
+    """Запускает (или продолжает) рассылку из STORE["broadcast"] фоновой задачей"""
+    global BROADCAST_TASK, BROADCAST_JOB
+    state = STORE.get("broadcast")
+    if not state or broadcast_running():
+        return
+    if not is_leader() and broadcast_part(state).get("done"):
+        return
+    BROADCAST_JOB = BroadcastJob(application.bot, state)
+    BROADCAST_TASK = spawn(BROADCAST_JOB.run(), "broadcast")
+
+METRICS.define("bot_broadcast_remaining", "gauge", "Users left in the running broadcast",
+               lambda: {(): BROADCAST_JOB.remaining if broadcast_running() else 0})
+
+# -------------------------
+# Анонимная пересылка (fan-out)
+# -------------------------
+# publish() только кладёт сообщение в очередь и сразу возвращается. Диспетчер
+# раскладывает его по очередям получателей (FIFO на каждого — порядок сохраняется),
+# а пул воркеров доставляет через общие лимиты Bot API. Чат в очереди готовых
+# бывает не больше одного раза, поэтому один получатель обслуживается одним воркером.
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "16"))
+FANOUT_EXPAND_BATCH = 1000  # получателей между уступками циклу событий
+
+class FanoutMessage:
+    __slots__ = ("sender_uid", "body", "created", "call")
+
+    def __init__(self, sender_uid, body, created=None):
+        self.sender_uid = str(sender_uid)
+        self.body = body  # текст или вложение (см. resolve_body)
+        self.created = time.monotonic() if created is None else created
+        self.call = None  # resolve_body(), собирается при первой доставке
+
+class Fanout:
+    def __init__(self, workers=FANOUT_WORKERS):
+        self.workers = workers
+        self.incoming = None   # asyncio.Queue[FanoutMessage], создаётся в start()
+        self.ready = None      # asyncio.Queue[chat_id] чатов с непустой очередью
+        self.queues = {}       # chat_id -> deque[FanoutMessage]
+        self._backlog = []     # опубликовано до start()
+        self._tasks = []
+        self.depth = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.lag_last = 0.0
+        self.lag_avg = 0.0
+        self.lag_max = 0.0
+
+    def start(self, bot):
+        self.incoming = asyncio.Queue()
+        self.ready = asyncio.Queue()
+        for msg in self._backlog:
+            self.incoming.put_nowait(msg)
+        self._backlog = []
+        self._tasks.append(spawn(self._dispatcher(), "fanout-dispatcher"))
+        for i in range(self.workers):
+            self._tasks.append(spawn(self._worker(bot), f"fanout-worker-{i}"))
+
+    def publish(self, sender_uid, text, media=None):
+        """Ставит анонимное сообщение (текст или вложение с подписью text) от sender_uid в очередь рассылки всем"""
+        # префикс удлиняет сообщение: без обрезки текст предельной длины не дойдёт ни до кого
+        body = f"💬 {get_anon_display(sender_uid)}:\n{text}".rstrip()
+        body = with_caption(media, body) if media else clip_text(body, TG_MESSAGE_LIMIT)
+        if WORKERS > 1:
+            # через общую очередь: каждый воркер доставит своей доле получателей
+            STORE.outbox_put(str(sender_uid), body)
+            return
+        self.enqueue(FanoutMessage(sender_uid, body))
+
+    def enqueue(self, msg):
+        if self.incoming is None:
+            self._backlog.append(msg)
+        else:
+            self.incoming.put_nowait(msg)
+
+    def recipients(self, sender_uid):
+        for uid in STORE.deliverable_users():
+            if uid != sender_uid and owns(uid):
+                yield uid
+
+    def _push(self, chat_id, msg):
+        q = self.queues.get(chat_id)
+        if q is None:
+            q = self.queues[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        q.append(msg)
+        self.depth += 1
+
+    async def _dispatcher(self):
+        while True:
+            msg = await self.incoming.get()
+            try:
+                for i, uid in enumerate(self.recipients(msg.sender_uid), 1):
+                    self._push(uid, msg)
+                    if i % FANOUT_EXPAND_BATCH == 0:
+                        await asyncio.sleep(0)
+            except Exception as e:
+                logger.error(f"Fanout dispatch of message from {msg.sender_uid} failed: {e!r}", exc_info=e)
+
+    def drop(self, chat_id):
+        """Чат мёртв (DELIVERY пометил его недоступным) — остаток его очереди выбрасываем"""
+        q = self.queues.get(chat_id)
+        if q:
+            self.depth -= len(q)
+            q.clear()
+        self.dropped += 1
+
+    def _observe_lag(self, msg):
+        lag = time.monotonic() - msg.created
+        self.lag_last = lag
+        self.lag_avg = lag if not self.delivered else self.lag_avg * 0.95 + lag * 0.05
+        self.lag_max = max(self.lag_max, lag)
+
+    async def _worker(self, bot):
+        while True:
+            chat_id = await self.ready.get()
+            q = self.queues.get(chat_id)
+            if q:
+                msg = q.popleft()
+                self.depth -= 1
+                try:
+                    if msg.call is None:
+                        msg.call = resolve_body(bot, msg.body)
+                    await send_resolved(int(chat_id), msg.call)
+                    self._observe_lag(msg)
+                    self.delivered += 1
+                    DELIVERY.success(chat_id)
+                except Exception as e:
+                    if DELIVERY.failure(chat_id, e):
+                        self.drop(chat_id)
+                    else:
+                        self.failed += 1
+            if q:
+                # остальное — в конец очереди готовых, чтобы не держать воркер на одном чате
+                self.ready.put_nowait(chat_id)
+            else:
+                self.queues.pop(chat_id, None)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "pending_messages": self.incoming.qsize() if self.incoming else len(self._backlog),
+            "chats_waiting": len(self.queues),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "lag_last": self.lag_last,
+            "lag_avg": self.lag_avg,
+            "lag_max": self.lag_max,
+        }
+
+FANOUT = Fanout()
+
+def fanout_metric(key):
+    return lambda: {(): FANOUT.stats()[key]}
+
+METRICS.define("bot_fanout_queue_depth", "gauge", "Fan-out deliveries queued", fanout_metric("depth"))
+METRICS.define("bot_fanout_pending_messages", "gauge", "Messages waiting to be expanded", fanout_metric("pending_messages"))
+METRICS.define("bot_fanout_delivered_total", "counter", "Fan-out deliveries sent", fanout_metric("delivered"))
+METRICS.define("bot_fanout_failed_total", "counter", "Fan-out deliveries failed", fanout_metric("failed"))
+METRICS.define("bot_fanout_dropped_total", "counter", "Recipients dropped (chat dead)", fanout_metric("dropped"))
+METRICS.define("bot_fanout_lag_seconds", "gauge", "Delivery lag of the last fan-out message", fanout_metric("lag_last"))
+
+# -------------------------
+# Планировщик (отложенные задачи)
+# -------------------------
+# Куча (heapq) задач по времени срабатывания (epoch seconds) и одна фоновая
+# задача, которая спит до ближайшей. Задача с ключом key заменяет прежнюю с тем
+# же ключом: старая запись остаётся в куче, но при срабатывании пропускается.
+# Здесь живут истечения мутов, отложенные рассылки и периодическое сжатие.
+COMPACT_INTERVAL_MIN = int(os.getenv("COMPACT_INTERVAL_MIN", "60"))  # 0 — не сжимать по таймеру
+SCHEDULED_BROADCAST_RETRY = 60  # секунд: отложенная рассылка ждёт, пока идёт другая
+SCHEDULER_COMPACT_MIN = 1000  # устаревших записей, после которых кучу стоит пересобрать
+
+class Scheduler:
+    def __init__(self):
+        self.app = None
+        self._heap = []          # (when, seq, key, func, args)
+        self._seq = itertools.count()
+        self._keys = {}          # key -> seq актуальной постановки
+        self._stale = 0          # заменённых и отменённых записей в куче
+        self._wake = None        # asyncio.Event, создаётся в start()
+
+    def start(self, application):
+        self.app = application
+        self._wake = asyncio.Event()
+        spawn(self._run(), "scheduler")
+
+    def at(self, when, func, *args, key=None):
+        """func(*args) в момент when; корутины запускаются фоновой задачей"""
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (when, seq, key, func, args))
+        if key is not None:
+            if key in self._keys:
+                self._stale += 1
+            self._keys[key] = seq
+            self._compact()
+        if self._wake is not None and self._heap[0][1] == seq:
+            self._wake.set()
+
+    def cancel(self, key):
+        if self._keys.pop(key, None) is not None:
+            self._stale += 1
+            self._compact()
+
+    def _compact(self):
+        # устаревшие записи иначе лежат в куче до своего времени (мут — до суток)
+        if self._stale > SCHEDULER_COMPACT_MIN and self._stale * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if e[2] is None or self._keys.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def every(self, interval, func, key):
+        async def tick():
+            try:
+                result = func()
+                if asyncio.iscoroutine(result):
+                    await result
+            finally:
+                self.at(time.time() + interval, tick, key=key)
+        self.at(time.time() + interval, tick, key=key)
+
+    def __len__(self):
+        return len(self._keys)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.time()
+            try:
+                while self._heap and self._heap[0][0] <= now:
+                    when, seq, key, func, args = heapq.heappop(self._heap)
+                    if key is not None:
+                        if self._keys.get(key) != seq:
+                            self._stale = max(0, self._stale - 1)
+                            continue  # заменена или отменена
+                        del self._keys[key]
+                    self._fire(func, args)
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {e!r}", exc_info=e)
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, func, args):
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                spawn(self._guard(result), getattr(func, "__name__", "job"))
+        except Exception as e:
+            logger.error(f"Scheduled job {func} failed: {e}")
+
+    async def _guard(self, coro):
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"Scheduled job failed: {e}")
+
+SCHEDULER = Scheduler()
+METRICS.define("bot_scheduler_jobs", "gauge", "Pending scheduled jobs with a key", lambda: {(): len(SCHEDULER)})
+
+class Mutes:
+    """Действующие муты: uid -> muted_until. Проверка на каждом сообщении — один
+    поиск в словаре; снятие по истечении делает планировщик (с уведомлением и записью)."""
+
+    def __init__(self):
+        self.until = {}
+
+    def load(self):
+        """При старте: расписать действующие муты, стереть давно истёкшие (только своих пользователей)"""
+        now = time.time()
+        for uid, until in STORE.muted_users():
+            if not owns(uid):
+                continue
+            if until > now:
+                self.changed(uid, until)
+            else:
+                record("user_set", uid=uid, field="muted_until", value=0)
+
+    def reload(self):
+        """WORKERS > 1: мут мог поставить или снять другой процесс — переносим только отличия"""
+        now = time.time()
+        current = {uid: until for uid, until in STORE.muted_users() if until > now and owns(uid)}
+        for uid in [uid for uid in self.until if uid not in current]:
+            self.changed(uid, 0)
+        for uid, until in current.items():
+            if self.until.get(uid) != until:
+                self.changed(uid, until)
+
+    def changed(self, uid, until):
+        # вызывается из record() при любой записи muted_until
+        if not owns(uid):
+            return
+        if until and until > time.time():
+            self.until[uid] = until
+            SCHEDULER.at(until, self.expire, uid, key=("unmute", uid))
+        else:
+            self.until.pop(uid, None)
+            SCHEDULER.cancel(("unmute", uid))
 
-@flask_app.route("/")
-def index():
-    return "✅ Telegram bot is running!"
+    def is_muted(self, uid):
+        until = self.until.get(uid)
+        return until is not None and until > time.time()
 
-# -------------------------
-# Файл данных
-# -------------------------
-DATA_FILE = "data.json"
+    async def expire(self, uid):
+        record("user_set", uid=uid, field="muted_until", value=0)
+        try:
+            await send_limited(SCHEDULER.app.bot, int(uid), "🔊 Мут закончился — снова можно писать.")
+        except Exception as e:
+            logger.info(f"Unmute notice to {uid} failed: {e}")
 
-def load_data():
+MUTES = Mutes()
+
+async def launch_broadcast(application, text, chat_id, media=None):
+    """Новая рассылка text (или вложения media с подписью text) всем пользователям;
+    прогресс — отдельным сообщением в chat_id. False — уже идёт другая."""
+    global BROADCAST_LAUNCHING
+    # слот занимаем до первого await: иначе вторая рассылка успеет перезаписать состояние
+    if broadcast_busy():
+        await send_limited(application.bot, chat_id, "⏳ Предыдущая рассылка ещё идёт.")
+        return False
+    BROADCAST_LAUNCHING = True
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        # базовая структура
-        return {
-            "users": {},         # str(user_id) -> {"username": str|None, "anon": int, "muted_until": 0}
-            "admins": [],        # list of "@username"
-            "banned": [],        # list of "@username"
-            "permissions": {},   # "@username" -> {perm: bool, ...}
-            "message_count": 0,
-            "admin_chat_enabled": False
-        }
+        record("set", key="message_count", value=STORE.get("message_count", 0) + 1)
+        progress = await send_limited(application.bot, chat_id, "📢 Рассылка запущена…")
+        record("set", key="broadcast", value={
+            "id": int(time.time() * 1000),
+            "text": text,
+            "media": media,
+            "chat_id": progress.chat_id,
+            "message_id": progress.message_id,
+            "total": STORE.count_users(),
+            "cursor": 0,
+            "sent": 0,
+            "failed": 0
+        })
+    finally:
+        BROADCAST_LAUNCHING = False
+    start_broadcast(application)
+    return True
 
-def save_data():
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(DATA, f, ensure_ascii=False, indent=2)
+def schedule_broadcast(when, text, chat_id, media=None):
+    """Отложенная рассылка хранится в STORE["scheduled_broadcasts"] и переживает перезапуск"""
+    items = STORE.get("scheduled_broadcasts", [])
+    item = {"id": max((i["id"] for i in items), default=0) + 1, "at": when, "text": text, "chat_id": chat_id,
+            "media": media}
+    record("set", key="scheduled_broadcasts", value=items + [item])
+    SCHEDULER.at(when, run_scheduled_broadcast, item["id"], key=("broadcast", item["id"]))
 
-DATA = load_data()
+async def run_scheduled_broadcast(item_id):
+    items = STORE.get("scheduled_broadcasts", [])
+    item = next((i for i in items if i["id"] == item_id), None)
+    if item is None:
+        return
+    if broadcast_busy():
+        SCHEDULER.at(time.time() + SCHEDULED_BROADCAST_RETRY, run_scheduled_broadcast, item_id,
+                     key=("broadcast", item_id))
+        return
+    if await launch_broadcast(SCHEDULER.app, item["text"], item["chat_id"], item.get("media")):
+        items = STORE.get("scheduled_broadcasts", [])
+        record("set", key="scheduled_broadcasts", value=[i for i in items if i["id"] != item_id])
 
-# -------------------------
-# Константы / состояния
-# -------------------------
-STATE_WAIT_ADMIN_USERNAME = "WAIT_ADMIN_USERNAME"
-STATE_WAIT_REMOVE_ADMIN = "WAIT_REMOVE_ADMIN"
-STATE_WAIT_PERMS_USERNAME = "WAIT_PERMS_USERNAME"
-STATE_WAIT_MUTE = "WAIT_MUTE"
-STATE_WAIT_IMPERSONATE = "WAIT_IMPERSONATE"
-STATE_WAIT_BROADCAST = "WAIT_BROADCAST"
-STATE_WAIT_PERM_TOGGLE = "WAIT_PERM_TOGGLE"  # internal message state for toggles (not used for message handler)
-STATE_USER_SEND = "USER_SEND"
+async def periodic_compaction():
+    # JsonStorage сжимает журнал в потоке (он потокобезопасен); соединение SQLite — только в цикле событий
+    if isinstance(STORE, JsonStorage):
+        await asyncio.to_thread(save_data)
+    else:
+        save_data()
 
-# список доступных прав
-ALL_PERMS = ["broadcast", "impersonate", "manage_perms", "stats", "mute", "export", "admin_chat"]
+def start_scheduler(application):
+    SCHEDULER.start(application)
+    MUTES.load()
+    if is_leader():
+        for item in STORE.get("scheduled_broadcasts", []):
+            SCHEDULER.at(item["at"], run_scheduled_broadcast, item["id"], key=("broadcast", item["id"]))
+        if COMPACT_INTERVAL_MIN > 0:
+            SCHEDULER.every(COMPACT_INTERVAL_MIN * 60, periodic_compaction, key="compaction")
+    SCHEDULER.every(FLOOD_IDLE, FLOOD.sweep, key="flood-sweep")
 
 # -------------------------
-# Вспомогательные функции
+# Защита от флуда (анонимные сообщения)
 # -------------------------
-def ensure_user_registered(user):
-    """Добавляем пользователя в DATA['users'] если нет"""
-    uid = str(user.id)
-    if uid not in DATA["users"]:
-        anon = random.randint(1000, 9999)
-        DATA["users"][uid] = {
-            "username": user.username if user.username else None,
-            "anon": anon,
-            "muted_until": 0
-        }
-        save_data()
+# Каждое анонимное сообщение превращается в рассылку всем, поэтому ограничиваем
+# дважды: token bucket на пользователя (FLOOD_RATE сообщений в секунду, запас
+# FLOOD_BURST) и общий бюджет доставок на всех. Кто упирается в лимит
+# FLOOD_STRIKES раз подряд — получает мут через muted_until, каждый следующий
+# вдвое дольше. Бакеты простаивающих дольше FLOOD_IDLE секунд удаляются.
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "0.2"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "3"))
+FLOOD_STRIKES = int(os.getenv("FLOOD_STRIKES", "5"))
+FLOOD_MUTE_MIN = int(os.getenv("FLOOD_MUTE_MIN", "10"))
+FLOOD_MUTE_MAX_MIN = 24 * 60
+FLOOD_IDLE = int(os.getenv("FLOOD_IDLE", "3600"))
+# доставок в секунду на всю пересылку (по умолчанию — весь глобальный лимит, делится между
+# процессами) и запас в секундах
+SEND_BUDGET_RATE = float(os.getenv("SEND_BUDGET_RATE", str(TG_GLOBAL_RATE))) / WORKERS
+SEND_BUDGET_WINDOW = int(os.getenv("SEND_BUDGET_WINDOW", "60"))
 
-def get_anon_display(uid):
-    """возвращает 'Аноним#1234' для user_id строкой"""
-    info = DATA["users"].get(str(uid))
-    if not info:
-        return "Аноним"
-    return f"Аноним#{info['anon']}"
+class FloodBucket:
+    __slots__ = ("tokens", "updated", "strikes", "mutes", "muted_until")
 
-def is_banned_username(username):
-    if not username:
-        return False
-    return username.startswith("@") and username in DATA["banned"]
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+        self.strikes = 0   # отказов подряд
+        self.mutes = 0     # автомутов (для удвоения срока)
+        self.muted_until = 0.0  # monotonic конец последнего автомута
 
-def is_admin_username(username):
-    if not username:
-        return False
-    return username.startswith("@") and username in DATA["admins"]
+class FloodControl:
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST, strikes=FLOOD_STRIKES, idle=FLOOD_IDLE):
+        self.rate = rate
+        self.burst = burst
+        self.strikes = strikes
+        self.idle = idle
+        self.buckets = {}  # uid -> FloodBucket
 
-def username_of_user_id(uid):
-    info = DATA["users"].get(str(uid))
-    return info.get("username") if info else None
+    def check(self, uid):
+        """(можно ли отправить, текст ответа или None — на повторные отказы не отвечаем)"""
+        now = time.monotonic()
+        b = self.buckets.get(uid)
+        if b is None:
+            b = self.buckets[uid] = FloodBucket(self.burst, now)
+        else:
+            b.tokens = min(self.burst, b.tokens + (now - b.updated) * self.rate)
+            b.updated = now
+        if b.tokens >= 1:
+            b.tokens -= 1
+            b.strikes = 0
+            return True, None
+        b.strikes += 1
+        if b.strikes < self.strikes:
+            if METRICS_ENABLED:
+                METRICS.inc("bot_flood_rejected_total", (("reason", "user"),))
+            return False, ("🐢 Слишком часто. Подождите немного." if b.strikes == 1 else None)
+        b.strikes = 0
+        minutes = min(FLOOD_MUTE_MAX_MIN, FLOOD_MUTE_MIN << b.mutes)
+        b.mutes += 1
+        b.muted_until = now + minutes * 60
+        record("user_set", uid=uid, field="muted_until", value=int(time.time()) + minutes * 60)
+        logger.info(f"Flood: user {uid} muted for {minutes} min")
+        if METRICS_ENABLED:
+            METRICS.inc("bot_flood_mutes_total")
+        return False, f"⏱️ Слишком много сообщений — мут на {minutes} мин."
 
-def check_permission(username, perm):
-    """username like '@mellfreezy'"""
-    perms = DATA["permissions"].get(username, {})
-    return perms.get(perm, False)
+    def sweep(self):
+        # замьюченный не доходит до check(), и updated у него стоит: счёт простоя — с конца мута,
+        # иначе после мута дольше idle удвоение начиналось бы заново
+        cutoff = time.monotonic() - self.idle
+        self.buckets = {uid: b for uid, b in self.buckets.items() if max(b.updated, b.muted_until) > cutoff}
 
-def init_admin_if_none(admin_username):
-    """Если нет ни одного админа, добавляем заданного (используется при первом старте)"""
-    if admin_username not in DATA["admins"]:
-        DATA["admins"].append(admin_username)
-    if admin_username not in DATA["permissions"]:
-        # по умолчанию даём все права основателю
-        DATA["permissions"][admin_username] = {p: True for p in ALL_PERMS}
-    save_data()
+class SendBudget:
+    """Общий бюджет доставок: rate в секунду, копится до rate * window.
+    Сообщение пропускается, пока бюджет положителен, и списывает всю свою стоимость
+    (число получателей) — бюджет может уйти в минус, дальше ждём восстановления."""
 
-# -------------------------
-# UI helpers
-# -------------------------
-def perms_to_keyboard_for_user(target_username):
-    """Возвращает InlineKeyboard с кнопками для переключения прав для target_username"""
-    perms = DATA["permissions"].get(target_username, {p: False for p in ALL_PERMS})
-    rows = []
-    for p in ALL_PERMS:
-        mark = "✅" if perms.get(p, False) else "❌"
-        # callback пример: "TOGGLE|@user|perm"
-        rows.append([InlineKeyboardButton(f"{mark} {p}", callback_data=f"TOGGLE|{target_username}|{p}")])
-    # кнопка назад
-    rows.append([InlineKeyboardButton("Назад", callback_data="ADMIN_PANEL")])
-    return InlineKeyboardMarkup(rows)
+    def __init__(self, rate=SEND_BUDGET_RATE, window=SEND_BUDGET_WINDOW):
+        self.rate = rate
+        self.capacity = rate * window
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
 
-def admin_panel_keyboard():
-    kb = [
-        [InlineKeyboardButton("👥 Пользователи", callback_data="SHOW_USERS")],
-        [InlineKeyboardButton("🚫 Забаненные", callback_data="SHOW_BANNED")],
-        [InlineKeyboardButton("🧑‍💼 Администраторы", callback_data="SHOW_ADMINS")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="SHOW_STATS")],
-        [InlineKeyboardButton("➕ Добавить админа", callback_data="ADD_ADMIN"),
-         InlineKeyboardButton("➖ Удалить админа", callback_data="REMOVE_ADMIN")],
-        [InlineKeyboardButton("⚙️ Установить разрешения", callback_data="SET_PERMS"),
-         InlineKeyboardButton("⏱️ Тайм-аут / Мут", callback_data="MUTE_USER")],
-        [InlineKeyboardButton("📤 Экспорт данных", callback_data="EXPORT_DATA"),
-         InlineKeyboardButton("📢 Рассылка", callback_data="BROADCAST")],
-        [InlineKeyboardButton("🧑‍💬 Писать от имени", callback_data="IMPERSONATE"),
-         InlineKeyboardButton("💬 Режим только админов", callback_data="TOGGLE_ADMIN_CHAT")],
-    ]
-    return InlineKeyboardMarkup(kb)
+    def try_spend(self, cost):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens <= 0:
+            if METRICS_ENABLED:
+                METRICS.inc("bot_flood_rejected_total", (("reason", "budget"),))
+            return False
+        self.tokens -= cost
+        return True
+
+FLOOD = FloodControl()
+SEND_BUDGET = SendBudget()
+METRICS.define("bot_flood_rejected_total", "counter", "Anonymous messages rejected, by reason (user, budget)")
+METRICS.define("bot_flood_mutes_total", "counter", "Automatic flood mutes")
+METRICS.define("bot_flood_buckets", "gauge", "Per-user flood buckets in memory", lambda: {(): len(FLOOD.buckets)})
+METRICS.define("bot_send_budget", "gauge", "Remaining fan-out delivery budget", lambda: {(): SEND_BUDGET.tokens})
 
 # -------------------------
 # Хендлеры команд
@@ -181,7 +2843,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uname = f"@{user.username}" if user.username else None
-    if not uname or uname not in DATA["admins"]:
+    if not is_admin_username(uname):
         await update.message.reply_text("⛔ У тебя нет доступа в админ-панель.")
         return
     await update.message.reply_text("🔧 Админ-панель:", reply_markup=admin_panel_keyboard())
@@ -191,7 +2853,7 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user_registered(user)
     uid = str(user.id)
     # проверка мут/бан
-    if DATA["users"][uid].get("muted_until", 0) > time.time():
+    if MUTES.is_muted(uid):
         await update.message.reply_text("⏱️ Вы замьючены и не можете отправлять сообщения.")
         return
     await update.message.reply_text("🗨️ Введите сообщение для отправки (будет разослано другим):")
@@ -200,189 +2862,216 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -------------------------
 # CallbackQuery handler (кнопки)
 # -------------------------
+# callback_data вида "KEY" или "KEY|аргументы". Обработчик выбирается по KEY из
+# таблицы CALLBACK_ROUTES, права проверяются по объявлению маршрута (admin/perm)
+# через закэшированную роль. Для каждого маршрута считаются вызовы, отказы,
+# ошибки и гистограмма длительности (она же bot_callback_seconds в /metrics).
+class Route:
+    __slots__ = ("name", "handler", "admin", "perm", "denied", "calls", "rejected", "errors", "latency")
+
+    def __init__(self, name, handler, admin, perm, denied):
+        self.name = name
+        self.handler = handler
+        self.admin = admin or perm is not None
+        self.perm = perm
+        self.denied = denied
+        self.calls = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latency = METRICS.histogram("bot_callback_seconds", (("route", name),))
+
+CALLBACK_ROUTES = {}  # KEY -> Route
+
+def callback_route(*keys, admin=False, perm=None, denied="⛔ Нет прав."):
+    """Регистрирует обработчик кнопок handler(query, context, role, arg) для KEY из keys"""
+    def register(handler):
+        route = Route(keys[0], handler, admin, perm, denied)
+        for key in keys:
+            CALLBACK_ROUTES[key] = route
+        return handler
+    return register
+
+def route_stats():
+    """Счётчики маршрутов: name -> Route (без дублей от нескольких KEY)"""
+    return {route.name: route for route in CALLBACK_ROUTES.values()}
+
+def route_counter(attr):
+    return lambda: {(("route", name),): getattr(route, attr) for name, route in route_stats().items()}
+
+METRICS.define("bot_callback_calls_total", "counter", "Callback presses, by route", route_counter("calls"))
+METRICS.define("bot_callback_rejected_total", "counter", "Callback presses denied by permissions", route_counter("rejected"))
+METRICS.define("bot_callback_errors_total", "counter", "Callback route exceptions", route_counter("errors"))
+
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
+    key, _, arg = query.data.partition("|")
+    route = CALLBACK_ROUTES.get(key)
+    if route is None:
+        await query.edit_message_text("❌ Неизвестная команда.")
+        return
     user = query.from_user
-    uname = f"@{user.username}" if user.username else None
-    admin_name = uname
-
-    # Админ-панель главная
-    if data == "ADMIN_PANEL" or data == "OPEN_ADMIN":
-        if not admin_name or admin_name not in DATA["admins"]:
-            await query.edit_message_text("⛔ У тебя нет доступа.")
-            return
-        await query.edit_message_text("🔧 Админ-панель:", reply_markup=admin_panel_keyboard())
+    role = ROLES.get(f"@{user.username}" if user.username else None)
+    route.calls += 1
+    if route.admin and not role.can(route.perm):
+        route.rejected += 1
+        await query.edit_message_text(route.denied)
         return
+    started = time.perf_counter()
+    try:
+        await route.handler(query, context, role, arg)
+    except Exception:
+        route.errors += 1
+        raise
+    finally:
+        route.latency.observe(time.perf_counter() - started)
 
-    # SHOW users
-    if data == "SHOW_USERS":
-        if not admin_name or admin_name not in DATA["admins"]:
-            await query.edit_message_text("⛔ Доступ запрещён.")
-            return
-        lines = []
-        for uid, info in DATA["users"].items():
-            username = f"@{info['username']}" if info.get("username") else "(без username)"
-            if username in DATA["banned"]:
-                lines.append(f"Забанен — {username}")
-            else:
-                lines.append(f"Аноним#{info['anon']} — {username}")
-        text = "👥 Пользователи:\n" + ("\n".join(lines) if lines else "— нет пользователей —")
-        await query.edit_message_text(text)
-        return
+def page_arg(arg):
+    """'3' / '3|@jo' -> (3, '@jo')"""
+    page, _, rest = arg.partition("|")
+    return (int(page) if page.isdigit() else 0), rest
 
-    # SHOW banned
-    if data == "SHOW_BANNED":
-        if not admin_name or admin_name not in DATA["admins"]:
-            await query.edit_message_text("⛔ Доступ запрещён.")
-            return
-        lines = [u for u in DATA["banned"]] if DATA["banned"] else []
-        text = "🚫 Забаненные:\n" + ("\n".join(lines) if lines else "— нет забаненных —")
-        await query.edit_message_text(text)
-        return
+# Админ-панель главная (и кнопка «Назад»)
+@callback_route("ADMIN_PANEL", "OPEN_ADMIN", admin=True, denied="⛔ У тебя нет доступа.")
+async def cb_admin_panel(query, context, role, arg):
+    await query.edit_message_text("🔧 Админ-панель:", reply_markup=admin_panel_keyboard())
 
-    # SHOW admins
-    if data == "SHOW_ADMINS":
-        if not admin_name or admin_name not in DATA["admins"]:
-            await query.edit_message_text("⛔ Доступ запрещён.")
-            return
-        lines = []
-        for a in DATA["admins"]:
-            perms = DATA["permissions"].get(a, {})
-            perms_str = ", ".join(f"{k}:{'✅' if perms.get(k) else '❌'}" for k in ALL_PERMS)
-            lines.append(f"{a} — {perms_str}")
-        text = "🧑‍💼 Администраторы:\n" + ("\n".join(lines) if lines else "— нет админов —")
-        await query.edit_message_text(text)
-        return
+# page counter button
+@callback_route("NOOP")
+async def cb_noop(query, context, role, arg):
+    pass
 
-    # ADD_ADMIN
-    if data == "ADD_ADMIN":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "manage_perms"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        # ждем ввода username
-        context.user_data["await_action"] = STATE_WAIT_ADMIN_USERNAME
-        await query.edit_message_text("Введите @username для добавления в админы:")
-        return
+# SHOW users (постранично) e.g. "USERS|3"
+@callback_route("SHOW_USERS", "USERS", admin=True, denied="⛔ Доступ запрещён.")
+async def cb_users(query, context, role, arg):
+    page, _ = page_arg(arg)
+    text, kb = users_listing(page)
+    await query.edit_message_text(text, reply_markup=kb)
 
-    # REMOVE_ADMIN
-    if data == "REMOVE_ADMIN":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "manage_perms"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        context.user_data["await_action"] = STATE_WAIT_REMOVE_ADMIN
-        await query.edit_message_text("Введите @username для удаления из админов:")
-        return
+# SHOW banned
+@callback_route("SHOW_BANNED", admin=True, denied="⛔ Доступ запрещён.")
+async def cb_banned(query, context, role, arg):
+    lines = STORE.banned()
+    text = "🚫 Забаненные:\n" + ("\n".join(lines) if lines else "— нет забаненных —")
+    await query.edit_message_text(text)
 
-    # SET_PERMS
-    if data == "SET_PERMS":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "manage_perms"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        context.user_data["await_action"] = STATE_WAIT_PERMS_USERNAME
-        await query.edit_message_text("Введите @username для настройки разрешений:")
-        return
+# SHOW admins (постранично, с фильтром по префиксу) e.g. "ADMINS|2|@jo"
+@callback_route("SHOW_ADMINS", "ADMINS", admin=True, denied="⛔ Доступ запрещён.")
+async def cb_admins(query, context, role, arg):
+    page, prefix = page_arg(arg)
+    text, kb = admins_listing(page, prefix)
+    await query.edit_message_text(text, reply_markup=kb)
 
-    # MUTE user
-    if data == "MUTE_USER":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "mute"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        context.user_data["await_action"] = STATE_WAIT_MUTE
-        await query.edit_message_text("Введите в формате: @username minutes (например: @joe 30)")
-        return
+# поиск админов по началу @username
+@callback_route("ADMINS_SEARCH", admin=True, denied="⛔ Доступ запрещён.")
+async def cb_admins_search(query, context, role, arg):
+    context.user_data["await_action"] = STATE_WAIT_ADMIN_SEARCH
+    await query.edit_message_text("🔍 Введите начало @username:")
 
-    # EXPORT DATA
-    if data == "EXPORT_DATA":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "export"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        # отправляем data.json как файл
-        buf = BytesIO()
-        buf.write(json.dumps(DATA, ensure_ascii=False, indent=2).encode("utf-8"))
-        buf.seek(0)
-        await query.message.reply_document(document=InputFile(buf, filename="data.json"))
-        await query.edit_message_text("📤 Экспортирован data.json")
-        return
+# SHOW stats
+@callback_route("SHOW_STATS", perm="stats")
+async def cb_stats(query, context, role, arg):
+    fo = FANOUT.stats()
+    users, dead = STORE.count_users(), STORE.count_inactive()
+    dc = DELIVERY.counts
+    text = (
+        "📊 Статистика:\n"
+        f"Пользователей: {users} (доступны: {users - dead}, недоступны: {dead})\n"
+        f"Админов: {STORE.count_admins()}\n"
+        f"Забаненных: {STORE.count_banned()}\n"
+        f"Рассылок: {STORE.get('message_count', 0)}\n"
+        f"Очередь пересылки: {fo['depth']} (сообщений ждут раскладки: {fo['pending_messages']})\n"
+        f"Доставлено: {fo['delivered']}, ошибок: {fo['failed']}, отписались: {fo['dropped']}\n"
+        f"Задержка доставки: сейчас {fo['lag_last']:.1f}с, средняя {fo['lag_avg']:.1f}с, макс {fo['lag_max']:.1f}с\n"
+        f"Исходы доставок: ✅ {dc['ok']}, 🚫 заблокировали {dc['forbidden']}, ❓ чат не найден {dc['not_found']}, "
+        f"⏳ флуд-лимит {dc['retry_after']}, ⚠️ временные {dc['transient']} (с ошибками подряд: {len(DELIVERY.streaks)})"
+    )
+    await query.edit_message_text(text)
 
-    # BROADCAST
-    if data == "BROADCAST":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "broadcast"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        context.user_data["await_action"] = STATE_WAIT_BROADCAST
-        await query.edit_message_text("✍️ Введи текст для рассылки всем пользователям:")
-        return
+# ADD_ADMIN / REMOVE_ADMIN / SET_PERMS / MUTE_USER / BROADCAST / IMPERSONATE — ждём ввода
+PROMPTS = {
+    "ADD_ADMIN": ("manage_perms", STATE_WAIT_ADMIN_USERNAME, "Введите @username для добавления в админы:"),
+    "REMOVE_ADMIN": ("manage_perms", STATE_WAIT_REMOVE_ADMIN, "Введите @username для удаления из админов:"),
+    "SET_PERMS": ("manage_perms", STATE_WAIT_PERMS_USERNAME, "Введите @username для настройки разрешений:"),
+    "MUTE_USER": ("mute", STATE_WAIT_MUTE, "Введите в формате: @username minutes (например: @joe 30)"),
+    "BROADCAST": ("broadcast", STATE_WAIT_BROADCAST,
+                  "✍️ Введи текст для рассылки всем пользователям — можно с фото, видео или альбомом "
+                  "(или «+30 текст» — отправить через 30 минут):"),
+    "IMPERSONATE": ("impersonate", STATE_WAIT_IMPERSONATE,
+                    "Введите в формате: anon_id текст (например: 1234 Привет всем)"),
+}
 
-    # IMPERSONATE
-    if data == "IMPERSONATE":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "impersonate"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        context.user_data["await_action"] = STATE_WAIT_IMPERSONATE
-        await query.edit_message_text("Введите в формате: anon_id текст (например: 1234 Привет всем)")
-        return
+def prompt_route(state, text):
+    async def handler(query, context, role, arg):
+        context.user_data["await_action"] = state
+        await query.edit_message_text(text)
+    return handler
 
-    # TOGGLE_ADMIN_CHAT
-    if data == "TOGGLE_ADMIN_CHAT":
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "admin_chat"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        DATA["admin_chat_enabled"] = not DATA.get("admin_chat_enabled", False)
-        save_data()
-        await query.edit_message_text(f"💬 Режим только админов: {'ВКЛ' if DATA['admin_chat_enabled'] else 'ВЫКЛ'}")
-        return
+for _key, (_perm, _state, _text) in PROMPTS.items():
+    callback_route(_key, perm=_perm)(prompt_route(_state, _text))
 
-    # TOGGLE perm callback e.g. "TOGGLE|@user|perm"
-    if data.startswith("TOGGLE|"):
-        parts = data.split("|")
-        if len(parts) != 3:
-            await query.answer("Неверный формат.")
-            return
-        target = parts[1]
-        perm = parts[2]
-        if not admin_name or admin_name not in DATA["admins"] or not check_permission(admin_name, "manage_perms"):
-            await query.edit_message_text("⛔ Нет прав.")
-            return
-        # ensure perms dict
-        if target not in DATA["permissions"]:
-            DATA["permissions"][target] = {p: False for p in ALL_PERMS}
-        DATA["permissions"][target][perm] = not DATA["permissions"][target].get(perm, False)
-        save_data()
-        # обновляем сообщение с клавиатурой
-        await query.edit_message_text(f"Настройки для {target}:", reply_markup=perms_to_keyboard_for_user(target))
-        return
+# EXPORT DATA
+@callback_route("EXPORT_DATA", perm="export")
+async def cb_export_menu(query, context, role, arg):
+    await query.edit_message_text("📤 Что выгрузить?", reply_markup=export_keyboard())
 
-    # USER_SEND button pressed by normal user
-    if data == "USER_SEND":
-        # set user state to send
-        context.user_data["state"] = STATE_USER_SEND
-        await query.message.reply_text("🗨️ Введите сообщение для отправки всем (анонимно):")
+# EXPORT callback e.g. "EXPORT|muted|csv"
+@callback_route("EXPORT", perm="export")
+async def cb_export(query, context, role, arg):
+    what, _, fmt = arg.partition("|")
+    if what not in EXPORT_FILTERS or fmt not in EXPORT_FORMATS:
+        await query.answer("Неверный формат.")
         return
+    await query.edit_message_text("⏳ Готовлю экспорт…")
+    files = await asyncio.to_thread(build_export, what, fmt)
+    for filename, f in files:
+        with f:
+            await query.message.reply_document(document=InputFile(f, filename=filename))
+    await query.edit_message_text(f"📤 Экспортировано файлов: {len(files)}")
 
-    # Back to admin panel
-    if data == "ADMIN_PANEL":
-        if not admin_name or admin_name not in DATA["admins"]:
-            await query.edit_message_text("⛔ Нет доступа.")
-            return
-        await query.edit_message_text("🔧 Админ-панель:", reply_markup=admin_panel_keyboard())
+# TOGGLE_ADMIN_CHAT
+@callback_route("TOGGLE_ADMIN_CHAT", perm="admin_chat")
+async def cb_toggle_admin_chat(query, context, role, arg):
+    enabled = not STORE.get("admin_chat_enabled", False)
+    record("set", key="admin_chat_enabled", value=enabled)
+    await query.edit_message_text(f"💬 Режим только админов: {'ВКЛ' if enabled else 'ВЫКЛ'}")
+
+# TOGGLE perm callback e.g. "TOGGLE|@user|perm"
+@callback_route("TOGGLE", perm="manage_perms")
+async def cb_toggle_perm(query, context, role, arg):
+    target, _, perm = arg.partition("|")
+    if not target or perm not in ALL_PERMS:
+        await query.answer("Неверный формат.")
         return
+    current = (STORE.get_perms(target) or {}).get(perm, False)
+    record("perm", username=target, perm=perm, value=not current)
+    # обновляем сообщение с клавиатурой
+    await query.edit_message_text(f"Настройки для {target}:", reply_markup=perms_to_keyboard_for_user(target))
 
-    # fallback
-    await query.edit_message_text("❌ Неизвестная команда.")
+# USER_SEND button pressed by normal user
+@callback_route("USER_SEND")
+async def cb_user_send(query, context, role, arg):
+    context.user_data["state"] = STATE_USER_SEND
+    await query.message.reply_text("🗨️ Введите сообщение для отправки всем (анонимно) — текст, фото, видео, голосовое или альбом:")
 
 # -------------------------
-# Обработка текстовых сообщений (все входящие)
+# Обработка сообщений (текст и вложения)
 # -------------------------
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = str(user.id)
-    text = update.message.text.strip()
+    media = message_media(update.message)
+    text = (update.message.text or update.message.caption or "").strip()
+    group_id = update.message.media_group_id
     ensure_user_registered(user)
+    if group_id and not ALBUMS.add(group_id, media):
+        return  # следующая часть альбома: что с ним делать, решено по первой
 
     # если админ в режиме ожидания action (add/remove/set perms/mute/broadcast/impersonate)
     action = context.user_data.get("await_action")
+    if media and action not in (None, STATE_WAIT_BROADCAST):
+        await update.message.reply_text("Здесь нужен текст, а не вложение.")
+        return
 
     # ---- ADD ADMIN ----
     if action == STATE_WAIT_ADMIN_USERNAME:
@@ -391,15 +3080,16 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not username.startswith("@"):
             await update.message.reply_text("Укажи корректный @username.")
             return
-        if username in DATA["admins"]:
+        if is_admin_username(username):
             await update.message.reply_text("Пользователь уже админ.")
             return
-        DATA["admins"].append(username)
+        record("admin_add", username=username)
         # дать стандартные права (по желанию)
-        DATA["permissions"][username] = {p: False for p in ALL_PERMS}
-        DATA["permissions"][username]["manage_perms"] = True
-        DATA["permissions"][username]["stats"] = True
-        save_data()
+        perms = {p: False for p in ALL_PERMS}
+        perms["manage_perms"] = True
+        perms["stats"] = True
+        record("perms", username=username, perms=perms)
+        flush_data()
         await update.message.reply_text(f"✅ {username} добавлен как админ.")
         return
 
@@ -410,12 +3100,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not username.startswith("@"):
             await update.message.reply_text("Укажи корректный @username.")
             return
-        if username not in DATA["admins"]:
+        if not is_admin_username(username):
             await update.message.reply_text("Такого админа нет.")
             return
-        DATA["admins"].remove(username)
-        DATA["permissions"].pop(username, None)
-        save_data()
+        record("admin_del", username=username)
+        record("perms_del", username=username)
+        flush_data()
         await update.message.reply_text(f"✅ {username} удалён из админов.")
         return
 
@@ -427,9 +3117,8 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Укажи корректный @username.")
             return
         # ensure entry
-        if username not in DATA["permissions"]:
-            DATA["permissions"][username] = {p: False for p in ALL_PERMS}
-        save_data()
+        if STORE.get_perms(username) is None:
+            record("perms", username=username, perms={p: False for p in ALL_PERMS})
         # отправляем клавиатуру с правами
         await update.message.reply_text(f"Настройки для {username}:", reply_markup=perms_to_keyboard_for_user(username))
         return
@@ -447,51 +3136,636 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             await update.message.reply_text("Укажи число минут.")
             return
-        # find user id by username
-        target_uid = None
-        for uid_k, info in DATA["users"].items():
-            if info.get("username") and f"@{info['username']}" == username:
-                target_uid = uid_k
-                break
+        target_uid = user_id_by_username(username)
         if not target_uid:
             await update.message.reply_text("Пользователь не найден.")
             return
-        DATA["users"][target_uid]["muted_until"] = int(time.time()) + minutes*60
-        save_data()
+        record("user_set", uid=target_uid, field="muted_until", value=int(time.time()) + minutes*60)
         await update.message.reply_text(f"⏱️ {username} замьючен на {minutes} минут.")
         return
 
+    # ---- поиск админов по префиксу ----
+    if action == STATE_WAIT_ADMIN_SEARCH:
+        context.user_data.pop("await_action", None)
+        uname = f"@{user.username}" if user.username else None
+        if not is_admin_username(uname):
+            await update.message.reply_text("⛔ Доступ запрещён.")
+            return
+        text_page, kb = admins_listing(0, text.split()[0])
+        await update.message.reply_text(text_page, reply_markup=kb)
+        return
+
     # ---- BROADCAST by admin ----
     if action == STATE_WAIT_BROADCAST:
         context.user_data.pop("await_action", None)
         # убедимся что пользователь админ и имеет право
-        uname = f"@{user.username}" if user.username else None
-        if not uname or uname not in DATA["admins"] or not check_permission(uname, "broadcast"):
+        if not ROLES.get(f"@{user.username}" if user.username else None).can("broadcast"):
             await update.message.reply_text("⛔ Нет прав.")
             return
-        text_to_send = text
-        # рассылаем всем не забаненным
-        DATA["message_count"] = DATA.get("message_count", 0) + 1
-        save_data()
-        for uid_k, info in DATA["users"].items():
-            username_k = f"@{info['username']}" if info.get("username") else None
-            if username_k in DATA["banned"]:
-                continue
-            try:
-                await context.bot.send_message(chat_id=int(uid_k), text=f"📢 Рассылка:\n\n{text_to_send}")
-            except Exception as e:
-                logger.warning(f"Broadcast failed for {uid_k}: {e}")
-        await update.message.reply_text("✅ Рассылка завершена.")
+        # "+30 текст" — отложить на 30 минут
+        delay, _, rest = text.partition(" ")
+        if delay.startswith("+") and delay[1:].isdigit() and (rest.strip() or media):
+            when, rest = time.time() + int(delay[1:]) * 60, rest.strip()
+            await ALBUMS.deliver(group_id, rest, media,
+                                 lambda _, m: schedule_broadcast(when, rest, update.effective_chat.id, m))
+            await update.message.reply_text(f"🕒 Рассылка запланирована через {int(delay[1:])} мин.")
+            return
+        if broadcast_busy():
+            await update.message.reply_text("⏳ Предыдущая рассылка ещё идёт.")
+            return
+        # рассылаем всем не забаненным в фоне, прогресс — в отдельном сообщении
+        await ALBUMS.deliver(group_id, text, media,
+                             lambda t, m: launch_broadcast(context.application, t, update.effective_chat.id, m))
         return
 
     # ---- IMPERSONATE (format: anon_id текст...) ----
     if action == STATE_WAIT_IMPERSONATE:
         context.user_data.pop("await_action", None)
-        uname = f"@{user.username}" if user.username else None
-        if not uname or uname not in DATA["admins"] or not check_permission(uname, "impersonate"):
+        if not ROLES.get(f"@{user.username}" if user.username else None).can("impersonate"):
             await update.message.reply_text("⛔ Нет прав.")
             return
         parts = text.split(maxsplit=1)
         if len(parts) < 2:
             await update.message.reply_text("Формат: anon_id текст (например: 1234 Привет всем)")
-           
+            return
+        try:
+            anon = int(parts[0])
+        except ValueError:
+            await update.message.reply_text("anon_id должен быть числом.")
+            return
+        target_uid = user_id_by_anon(anon)
+        if not target_uid:
+            await update.message.reply_text("Аноним с таким номером не найден.")
+            return
+        FANOUT.publish(target_uid, parts[1])
+        await update.message.reply_text(f"✅ Отправлено от имени {get_anon_display(target_uid)}.")
+        return
+
+    # ---- Анонимное сообщение всем ----
+    if context.user_data.get("state") == STATE_USER_SEND:
+        if MUTES.is_muted(uid):
+            await update.message.reply_text("⏱️ Вы замьючены и не можете отправлять сообщения.")
+            return
+        uname = f"@{user.username}" if user.username else None
+        if is_banned_username(uname):
+            await update.message.reply_text("🚫 Вы забанены.")
+            return
+        if STORE.get("admin_chat_enabled") and not is_admin_username(uname):
+            await update.message.reply_text("💬 Сейчас писать могут только админы.")
+            return
+        allowed, notice = FLOOD.check(uid)
+        if not allowed:
+            if notice:
+                await update.message.reply_text(notice)
+            return
+        if not SEND_BUDGET.try_spend(max(1, STORE.count_users() - 1)):
+            await update.message.reply_text("⏳ Бот сейчас занят рассылкой, попробуйте через минуту.")
+            return
+        await ALBUMS.deliver(group_id, text, media, lambda t, m: FANOUT.publish(uid, t, m))
+        await update.message.reply_text("✅ Отправлено.")
+        return
+
+# -------------------------
+# Состояние диалогов (persistence)
+# -------------------------
+# await_action из context.user_data (админ посреди ввода) хранится в STORE записями
+# "user_state", поэтому переживает перезапуск. PTB сохраняет изменённые user_data раз в
+# STATE_PERSIST_INTERVAL секунд и при остановке. state=USER_SEND не сохраняем: его не
+# снимают, и запись осталась бы навсегда у каждого, кто хоть раз писал (после
+# перезапуска достаточно снова нажать /send).
+STATE_PERSIST_INTERVAL = float(os.getenv("STATE_PERSIST_INTERVAL", "2"))
+PERSISTED_STATE_KEYS = ("await_action",)
+
+def persisted_state(data):
+    return {k: data[k] for k in PERSISTED_STATE_KEYS if k in data}
+
+class StorePersistence(BasePersistence):
+    def __init__(self):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=STATE_PERSIST_INTERVAL)
+        self._saved = {}  # uid -> последнее записанное состояние (не пишем то же самое)
+
+    async def get_user_data(self):
+        data = {}
+        for uid, state in STORE.user_states():
+            if not owns(uid):
+                continue
+            kept = persisted_state(state)
+            if kept != state:
+                # записи прежних версий (state=USER_SEND) — стираем
+                record("user_state", uid=uid, data=kept or None)
+            if kept:
+                self._saved[uid] = kept
+                data[int(uid)] = dict(kept)
+        return data
+
+    async def update_user_data(self, user_id, data):
+        uid = str(user_id)
+        state = persisted_state(data)
+        if self._saved.get(uid, {}) == state:
+            return
+        record("user_state", uid=uid, data=state or None)
+        if state:
+            self._saved[uid] = state
+        else:
+            self._saved.pop(uid, None)
+
+    async def drop_user_data(self, user_id):
+        self._saved.pop(str(user_id), None)
+        record("user_state", uid=str(user_id), data=None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def flush(self):
+        flush_data()
+
+    # chat_data / bot_data / callback_data / ConversationHandler не используются
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# -------------------------
+# Запуск
+# -------------------------
+# BOT_MODE=polling (по умолчанию) — getUpdates; BOT_MODE=webhook — Telegram шлёт
+# обновления на WEBHOOK_URL + WEBHOOK_PATH, их принимает тот же HTTP-сервер (Flask).
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8"))  # обновлений в обработке одновременно
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://my-bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# роли берутся из from.username обновления, поэтому без секрета поддельный POST = права админа:
+# если WEBHOOK_SECRET не задан, генерируем случайный — set_webhook передаёт его Telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # другой Bot API сервер (локальный / tools/fake_telegram.py)
+
+# приложение и его цикл событий — для передачи обновлений из потока Flask
+WEBHOOK_APP = None
+WEBHOOK_LOOP = None
+SUPERVISOR = None  # главный процесс при WORKERS > 1 (раздаёт обновления воркерам)
+
+@http_route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    from flask import request
+    # SUPERVISOR есть и в polling-режиме: без проверки BOT_MODE маршрут был бы открыт
+    if BOT_MODE != "webhook" or (WEBHOOK_APP is None and SUPERVISOR is None):
+        return "webhook mode is off", 404
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return "forbidden", 403
+    payload = request.get_json(silent=True)
+    if not payload:
+        return "bad request", 400
+    if SUPERVISOR is not None:
+        # WORKERS > 1: разбирать будет воркер
+        SUPERVISOR.route(payload)
+        return "", 200
+    try:
+        update = Update.de_json(payload, WEBHOOK_APP.bot)
+    except Exception as e:
+        logger.warning(f"Bad webhook payload: {e}")
+        return "bad request", 400
+    # не ждём обработки: Telegram нужен быстрый 200
+    asyncio.run_coroutine_threadsafe(WEBHOOK_APP.update_queue.put(update), WEBHOOK_LOOP)
+    return "", 200
+
+@http_route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return "metrics are disabled", 404
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+LOOP_STALL_SECONDS = 10.0  # цикл событий не отвечает дольше — /healthz отдаёт 503
+
+@http_route("/healthz")
+def healthz():
+    now = time.monotonic()
+    beat, last_update = HEALTH["loop_beat"], HEALTH["last_update"]
+    if beat is None:
+        status = "starting"
+    elif now - beat > LOOP_STALL_SECONDS:
+        status = "stalled"
+    else:
+        status = "ok"
+    fo = FANOUT.stats()
+    body = {
+        "status": status,
+        "mode": BOT_MODE,
+        "storage": STORAGE_BACKEND,
+        "uptime_s": round(now - HEALTH["started"], 1),
+        "startup_s": round(sum(seconds for _, seconds in STARTUP_PHASES), 2),
+        "loop_lag_s": round(HEALTH["loop_lag"], 4),
+        "loop_beat_age_s": round(now - beat, 1) if beat is not None else None,
+        "last_update_age_s": round(now - last_update, 1) if last_update is not None else None,
+        "fanout_depth": fo["depth"],
+        "fanout_pending_messages": fo["pending_messages"],
+        "broadcast_remaining": BROADCAST_JOB.remaining if broadcast_running() else 0,
+    }
+    if WORKERS > 1:
+        body["worker"] = WORKER_ID
+        if SUPERVISOR is not None:
+            body["worker"] = "front"
+            body["workers_alive"] = SUPERVISOR.alive()
+    return body, (503 if status == "stalled" else 200)
+
+def make_flask_app():
+    from flask import Flask
+    app = Flask(__name__)
+    for path, view, methods in HTTP_ROUTES:
+        app.add_url_rule(path, view_func=view, methods=methods)
+    return app
+
+def run_flask(port=None):
+    port = port or int(os.getenv("PORT", "5000"))
+    make_flask_app().run(host="0.0.0.0", port=port, threaded=True)
+
+async def storage_committer():
+    # для sqlite: коммит накопленной пачки изменений раз в JOURNAL_FLUSH_MS
+    while True:
+        await asyncio.sleep(JOURNAL_FLUSH_MS / 1000)
+        try:
+            STORE.commit_pending()
+        except Exception as e:
+            # например, "database is locked" — пачка останется и уйдёт следующим коммитом
+            logger.error(f"Storage commit failed: {e!r}")
+
+# ---- несколько процессов ----
+SHARED_POLL_MS = int(os.getenv("SHARED_POLL_MS", "500"))  # как часто воркер смотрит изменения других
+OUTBOX_KEEP = 3600  # секунд храним разосланные сообщения общей очереди
+POLL_TIMEOUT = 30   # long polling главного процесса, секунд
+POLL_BACKOFF_MAX = 60  # потолок паузы между неудачными getUpdates, секунд
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно (до max_concurrent_updates),
+    одного пользователя — строго по очереди, в порядке поступления.
+    Очередное обновление занятого пользователя не ждёт со взятым слотом (слоты общие —
+    один пользователь с очередью занял бы их все), а кладётся в его очередь: её
+    дорабатывает тот, кто уже обрабатывает этого пользователя, в своём слоте."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}  # user_id -> deque корутин; есть, пока пользователя кто-то обрабатывает
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        pending = self._queues.get(user.id)
+        if pending is not None:
+            pending.append(coroutine)
+            return
+        pending = self._queues[user.id] = deque([coroutine])
+        try:
+            while pending:
+                try:
+                    await pending[0]
+                except Exception as e:
+                    logger.error(f"Update of user {user.id} failed: {e}")
+                finally:
+                    pending.popleft()
+        finally:
+            del self._queues[user.id]
+            for coro in pending:
+                coro.close()  # остановка посреди очереди
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def update_owner(payload):
+    """Номер воркера для обновления (JSON Bot API): по id отправителя"""
+    for value in payload.values():
+        if isinstance(value, dict):
+            who = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(who, dict) and "id" in who:
+                return worker_for(who["id"])
+    return 0
+
+async def shared_state_watcher(application):
+    """WORKERS > 1: подхватывает изменения, сделанные другими процессами"""
+    epochs = STORE.epochs()
+    last_id = STORE.outbox_last_id()
+    while True:
+        await asyncio.sleep(SHARED_POLL_MS / 1000)
+        try:
+            # своя открытая транзакция видит снимок на момент её начала
+            STORE.commit_pending()
+            current = STORE.epochs()
+            if current != epochs:
+                changed = {cache for cache, n in current.items() if epochs.get(cache) != n}
+                if "roles" in changed:
+                    ROLES.invalidate()
+                if "listings" in changed:
+                    LISTINGS.bump()
+                if "mutes" in changed:
+                    MUTES.reload()
+                # только после сброса кэшей: если он упал, следующий круг повторит его
+                epochs = current
+            for row_id, sender, body, created in STORE.outbox_since(last_id):
+                last_id = row_id
+                FANOUT.enqueue(FanoutMessage(sender, body, time.monotonic() - max(0.0, time.time() - created)))
+            if STORE.get("broadcast") and not broadcast_running():
+                start_broadcast(application)
+        except Exception as e:
+            logger.error(f"Shared state sync failed: {e!r}", exc_info=e)
+
+def trim_outbox():
+    STORE.outbox_trim(time.time() - OUTBOX_KEEP)
+
+async def post_init(application):
+    spawn(storage_committer(), "storage-committer")
+    spawn(loop_monitor(), "loop-monitor")
+    start_scheduler(application)
+    METRICS.define("bot_update_queue_depth", "gauge", "Updates waiting in the application queue",
+                   lambda: {(): application.update_queue.qsize()})
+    FANOUT.start(application.bot)
+    if WORKERS > 1:
+        spawn(shared_state_watcher(application), "shared-state")
+        if is_leader():
+            SCHEDULER.every(60, trim_outbox, key="outbox-trim")
+    # продолжаем рассылку, прерванную перезапуском
+    if STORE.get("broadcast"):
+        logger.info("Resuming interrupted broadcast")
+        start_broadcast(application)
+    startup_phase("initialize")
+    log_startup()
+
+async def post_stop(application):
+    await stop_background()
+
+async def post_shutdown(application):
+    save_data()
+
+def build_application(webhook=False):
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .persistence(StorePersistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if METRICS_ENABLED:
+        builder = builder.request(MeteredRequest())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if webhook:
+        # обновления приходят через Flask (или от главного процесса), getUpdates не нужен
+        builder = builder.updater(None)
+    application = builder.build()
+    if METRICS_ENABLED:
+        application.add_handler(TypeHandler(Update, count_update), group=-1)
+    application.add_handler(CommandHandler("start", metered("start", start)))
+    application.add_handler(CommandHandler("admin", metered("admin", admin_command)))
+    application.add_handler(CommandHandler("send", metered("send", send_command)))
+    application.add_handler(CallbackQueryHandler(metered("callback", callback_query_handler)))
+    application.add_handler(MessageHandler((filters.TEXT | MEDIA_FILTER) & ~filters.COMMAND, metered("message", message_handler)))
+    return application
+
+def make_bot():
+    if TELEGRAM_API_URL:
+        return Bot(TOKEN, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+    return Bot(TOKEN)
+
+async def set_webhook(bot):
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+def stop_event():
+    """Event, который выставляют SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_without_updater(application, serve):
+    """Жизненный цикл Application без Updater: serve() работает до остановки"""
+    await application.initialize()
+    # без Updater post_init сам не вызывается
+    await post_init(application)
+    await application.start()
+    try:
+        await serve()
+    finally:
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+async def run_webhook(application):
+    """Webhook-режим: Application без Updater, обновления кладёт в update_queue маршрут Flask"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    stop = stop_event()
+
+    async def serve():
+        global WEBHOOK_APP, WEBHOOK_LOOP
+        WEBHOOK_APP, WEBHOOK_LOOP = application, asyncio.get_running_loop()
+        try:
+            await set_webhook(application.bot)
+            await stop.wait()
+        finally:
+            WEBHOOK_APP = None
+    await run_without_updater(application, serve)
+
+async def run_worker(application, inbox):
+    """Воркер: обновления приходят от главного процесса через inbox (None — остановка)"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    def pump():
+        while True:
+            payload = inbox.get()
+            if payload is None:
+                break
+            try:
+                update = Update.de_json(payload, application.bot)
+            except Exception as e:
+                logger.warning(f"Bad update from front: {e}")
+                continue
+            asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+        loop.call_soon_threadsafe(stop.set)
+
+    async def serve():
+        threading.Thread(target=pump, name="inbox", daemon=True).start()
+        await stop.wait()
+    await run_without_updater(application, serve)
+
+def worker_main(inbox):
+    """Точка входа процесса-воркера; bot.py импортирован заново с WORKER_ID в окружении"""
+    # Ctrl+C получает вся группа процессов — останавливает воркеры главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # /metrics и /healthz воркера — на PORT + 1 + WORKER_ID
+    port = int(os.getenv("PORT", "5000")) + 1 + WORKER_ID
+    threading.Thread(target=run_flask, args=(port,), name="flask", daemon=True).start()
+    logger.info(f"Worker {WORKER_ID} started")
+    application = build_application(webhook=True)
+    startup_phase("application")
+    asyncio.run(run_worker(application, inbox))
+
+class Supervisor:
+    """Главный процесс при WORKERS > 1: запускает воркеры, раздаёт им обновления, поднимает упавшие"""
+
+    def __init__(self, count=WORKERS):
+        import multiprocessing
+        self.ctx = multiprocessing.get_context("spawn")
+        self.inboxes = [self.ctx.Queue() for _ in range(count)]
+        self.procs = [None] * count
+
+    def start_worker(self, i):
+        # spawn: дочерний процесс импортирует bot.py заново и читает WORKER_ID из окружения
+        os.environ["WORKER_ID"] = str(i)
+        try:
+            proc = self.ctx.Process(target=worker_main, args=(self.inboxes[i],), name=f"bot-worker-{i}")
+            proc.start()
+        finally:
+            os.environ.pop("WORKER_ID", None)
+        self.procs[i] = proc
+
+    def start(self):
+        for i in range(len(self.procs)):
+            self.start_worker(i)
+
+    def check(self):
+        for i, proc in enumerate(self.procs):
+            if not proc.is_alive():
+                logger.error(f"Worker {i} exited with code {proc.exitcode}, restarting")
+                self.start_worker(i)
+
+    def alive(self):
+        return sum(1 for proc in self.procs if proc.is_alive())
+
+    def route(self, payload):
+        self.inboxes[update_owner(payload)].put(payload)
+
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for proc in self.procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+
+async def run_front(supervisor):
+    """Главный процесс: getUpdates (или webhook через Flask) и раздача обновлений воркерам"""
+    stop = stop_event()
+    fatal = []
+    spawn(loop_monitor(), "loop-monitor")
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(5)
+            supervisor.check()
+
+    async def poll(bot):
+        await bot.delete_webhook()
+        offset = 0
+        backoff = 1
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+            except InvalidToken as e:
+                # повторять бессмысленно — останавливаем процесс, main() завершится с ошибкой
+                logger.critical(f"getUpdates: invalid token: {e}")
+                fatal.append(e)
+                stop.set()
+                return
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"getUpdates flood limit, retry after {delay}s")
+                await asyncio.sleep(delay)
+                continue
+            except TelegramError as e:
+                # NetworkError/TimedOut, Conflict (второй экземпляр бота на том же токене) и прочее
+                log = logger.error if isinstance(e, Conflict) else logger.warning
+                log(f"getUpdates failed: {e!r}, retry in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, POLL_BACKOFF_MAX)
+                continue
+            backoff = 1
+            for update in updates:
+                offset = update.update_id + 1
+                supervisor.route(update.to_dict())
+
+    async with make_bot() as bot:
+        startup_phase("initialize")
+        log_startup()
+        spawn(watch_workers(), "watch-workers")
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+            await set_webhook(bot)
+        else:
+            spawn(poll(bot), "front-poll")
+        await stop.wait()
+        await stop_background()
+    supervisor.stop()
+    if fatal:
+        raise fatal[0]
+
+def main():
+    global SUPERVISOR
+    admin = os.getenv("ADMIN_USERNAME", "").strip()
+    if admin:
+        # админы хранятся как "@username" — иначе is_admin_username() его не узнает
+        if not admin.startswith("@"):
+            admin = "@" + admin
+        init_admin_if_none(admin)
+    webhook = BOT_MODE == "webhook"
+    if WORKERS > 1:
+        SUPERVISOR = Supervisor()
+        SUPERVISOR.start()
+        threading.Thread(target=run_flask, name="flask", daemon=True).start()
+        asyncio.run(run_front(SUPERVISOR))
+        return
+    application = build_application(webhook)
+    startup_phase("application")
+    threading.Thread(target=run_flask, name="flask", daemon=True).start()
+    if webhook:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("YOUR_BOT_TOKEN", "123456:test")
+os.environ["STORAGE_BACKEND"] = "json"
+os.environ["WORKERS"] = "1"
+# bot.py при импорте открывает хранилище в текущей папке — пусть это будет временная
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Пустая текущая папка: data.json, журнал и снимки теста пишутся в неё"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,55 @@
+# tests/test_broadcast.py
+"""Запуск рассылки: вторая, пришедшая во время await первой, не затирает её."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def launch(monkeypatch):
+    """launch_broadcast без Telegram: ответы копятся в sent, запуски задачи — в started"""
+    sent, started = [], []
+
+    async def send(bot_, chat_id, text, **kwargs):
+        await asyncio.sleep(0.01)  # тот самый await между проверкой и записью состояния
+        sent.append((chat_id, text))
+        return SimpleNamespace(chat_id=chat_id, message_id=len(sent))
+
+    monkeypatch.setattr(bot, "send_limited", send)
+    monkeypatch.setattr(bot, "start_broadcast", lambda application: started.append(bot.STORE.get("broadcast")))
+    app = SimpleNamespace(bot=None)
+    yield lambda text, chat_id: bot.launch_broadcast(app, text, chat_id), sent, started
+    bot.record("set", key="broadcast", value=None)
+
+def test_concurrent_launch_keeps_first(launch):
+    launch_broadcast, sent, started = launch
+
+    async def main():
+        return await asyncio.gather(launch_broadcast("first", 100), launch_broadcast("second", 101))
+
+    assert asyncio.run(main()) == [True, False]
+    assert (101, "⏳ Предыдущая рассылка ещё идёт.") in sent
+    assert [state["text"] for state in started] == ["first"]
+    assert bot.STORE.get("broadcast")["chat_id"] == 100
+    assert not bot.BROADCAST_LAUNCHING
+
+def test_stored_broadcast_blocks_launch(launch):
+    launch_broadcast, sent, started = launch
+    assert asyncio.run(launch_broadcast("first", 100))
+    # задача рассылки не запущена (start_broadcast подменён), но состояние сохранено —
+    # например, его ведёт другой воркер
+    assert not asyncio.run(launch_broadcast("second", 100))
+    assert len(started) == 1
+
+def test_failed_launch_frees_slot(launch, monkeypatch):
+    launch_broadcast, sent, started = launch
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(bot, "send_limited", broken)
+    with pytest.raises(RuntimeError):
+        asyncio.run(launch_broadcast("first", 100))
+    assert not bot.broadcast_busy()
@@ -0,0 +1,72 @@
+# tests/test_callbacks.py
+"""Кнопки: таблица CALLBACK_ROUTES, проверка прав и сброс кэша ролей."""
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+class FakeQuery:
+    def __init__(self, data, username):
+        self.data = data
+        self.from_user = SimpleNamespace(username=username)
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+def press(data, username, user_data=None):
+    query = FakeQuery(data, username)
+    context = SimpleNamespace(user_data={} if user_data is None else user_data)
+    asyncio.run(bot.callback_query_handler(SimpleNamespace(callback_query=query), context))
+    return query.edits
+
+def test_every_panel_button_has_route():
+    keyboard = bot.admin_panel_keyboard().inline_keyboard
+    keys = [button.callback_data.partition("|")[0] for row in keyboard for button in row]
+    assert [key for key in keys if key not in bot.CALLBACK_ROUTES] == []
+    # синонимы ведут в один маршрут, и счётчики у них общие
+    assert bot.CALLBACK_ROUTES["USERS"] is bot.CALLBACK_ROUTES["SHOW_USERS"]
+    assert "USERS" not in bot.route_stats()
+
+def test_unknown_key():
+    assert press("NO_SUCH_BUTTON", "nobody") == ["❌ Неизвестная команда."]
+
+def test_admin_route_denies_non_admin():
+    route = bot.CALLBACK_ROUTES["SHOW_BANNED"]
+    rejected = route.rejected
+    assert press("SHOW_BANNED", "stranger") == ["⛔ Доступ запрещён."]
+    assert press("SHOW_BANNED", None) == ["⛔ Доступ запрещён."]
+    assert route.rejected == rejected + 2
+
+def test_perm_route_follows_role_changes():
+    username = "@cb_moderator"
+    bot.ROLES.get(username)  # роль «не админ» оседает в кэше
+    assert press("MUTE_USER", "cb_moderator") == ["⛔ Нет прав."]
+
+    bot.record("admin_add", username=username)
+    bot.record("perms", username=username, perms={p: p == "mute" for p in bot.ALL_PERMS})
+    user_data = {}
+    assert press("MUTE_USER", "cb_moderator", user_data) == [bot.PROMPTS["MUTE_USER"][2]]
+    assert user_data["await_action"] == bot.STATE_WAIT_MUTE
+    assert press("BROADCAST", "cb_moderator") == ["⛔ Нет прав."]
+
+    bot.record("perm", username=username, perm="mute", value=False)
+    assert press("MUTE_USER", "cb_moderator") == ["⛔ Нет прав."]
+    bot.record("perm", username=username, perm="mute", value=True)
+    bot.record("admin_del", username=username)
+    assert not bot.ROLES.get(username).is_admin
+
+def test_role_cache_evicts_oldest(monkeypatch):
+    roles = bot.RoleCache(size=2)
+    looked_up = []
+    monkeypatch.setattr(bot.STORE, "get_perms", lambda username: looked_up.append(username))
+    for username in ("@a", "@b", "@a", "@c", "@a", "@b"):
+        roles.get(username)
+    # @a свежий после повторного обращения, вытесняется @b, потом @c
+    assert looked_up == ["@a", "@b", "@c", "@b"]
+    roles.invalidate("@a")
+    roles.get("@a")
+    assert looked_up[-1] == "@a"
@@ -0,0 +1,48 @@
+# tests/test_delivery.py
+"""Учёт доставки: исходы ошибок, серии неудач, пометка мёртвых чатов."""
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import bot
+
+def test_classify_delivery_error():
+    classify = bot.classify_delivery_error
+    assert classify(Forbidden("Forbidden: bot was blocked by the user")) == "forbidden"
+    assert classify(Forbidden("Forbidden: user is deactivated")) == "forbidden"
+    assert classify(BadRequest("Chat not found")) == "not_found"
+    assert classify(BadRequest("Bad Request: PEER_ID_INVALID")) == "not_found"
+    assert classify(RetryAfter(5)) == "retry_after"
+    # остальные BadRequest — не повод считать чат мёртвым
+    assert classify(BadRequest("Message is too long")) == "transient"
+    assert classify(TimedOut()) == "transient"
+    assert classify(NetworkError("connection reset")) == "transient"
+    assert classify(RuntimeError("boom")) == "transient"
+
+def test_success_resets_streak(monkeypatch):
+    monkeypatch.setattr(bot, "DELIVERY_NOT_FOUND_STREAK", 2)
+    tracker = bot.DeliveryTracker()
+    monkeypatch.setattr(tracker, "mark_dead", lambda uid, e: None)
+    assert not tracker.failure("1", BadRequest("Chat not found"))
+    tracker.success("1")
+    # после успеха серия начинается заново
+    assert not tracker.failure("1", BadRequest("Chat not found"))
+    assert tracker.counts["ok"] == 1 and tracker.counts["not_found"] == 2
+
+def test_streaks_are_capped(monkeypatch):
+    monkeypatch.setattr(bot, "DELIVERY_STREAKS_MAX", 3)
+    tracker = bot.DeliveryTracker()
+    for uid in ("1", "2", "3"):
+        tracker.failure(uid, TimedOut())
+    tracker.failure("1", TimedOut())   # "1" снова свежий
+    tracker.failure("4", TimedOut())
+    assert dict(tracker.streaks) == {"3": 1, "1": 2, "4": 1}
+
+def test_streak_dropped_when_marked_dead(monkeypatch):
+    monkeypatch.setattr(bot, "DELIVERY_NOT_FOUND_STREAK", 2)
+    dead = []
+    tracker = bot.DeliveryTracker()
+    monkeypatch.setattr(tracker, "mark_dead", lambda uid, e: dead.append(uid))
+    assert not tracker.failure("1", BadRequest("Chat not found"))
+    assert tracker.failure("1", BadRequest("Chat not found"))
+    assert tracker.failure("2", Forbidden("bot was blocked by the user"))
+    assert dead == ["1", "2"]
+    assert not tracker.streaks
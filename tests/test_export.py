@@ -0,0 +1,60 @@
+# tests/test_export.py
+"""Экспорт: деление на части, формат каждой части."""
+import csv
+import gzip
+import io
+import json
+
+import bot
+
+def user_rows(n):
+    return [{"type": "user", "uid": str(uid), "username": f"user{uid}", "anon": 1000 + uid,
+             "muted_until": 0, "active": True} for uid in range(n)]
+
+ROWS = user_rows(2000)
+
+def write_all(fmt, rows=ROWS, limit=4096):
+    writer = bot.ExportWriter(fmt, "export", limit=limit)
+    for row in rows:
+        writer.write(row)
+    return [(name, f.read()) for name, f in writer.close()]
+
+def read_part(fmt, content):
+    if fmt.endswith(".gz"):
+        content = gzip.decompress(content)
+    text = content.decode("utf-8")
+    if fmt.startswith("csv"):
+        return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+    return [json.loads(line) for line in text.splitlines()]
+
+def test_jsonl_split_into_parts():
+    parts = write_all("jsonl")
+    assert len(parts) > 1
+    assert [name for name, _ in parts] == [f"export.part{i}.jsonl" for i in range(1, len(parts) + 1)]
+    rows = []
+    for _, content in parts:
+        # каждая часть — целые строки, читается сама по себе
+        assert content.endswith(b"\n")
+        rows += read_part("jsonl", content)
+    assert rows == ROWS
+
+def test_csv_gz_parts_are_complete_files():
+    # сжатый размер растёт блоками компрессора — строк нужно больше, чтобы дойти до второй части
+    expected = user_rows(20000)
+    parts = write_all("csv.gz", expected, limit=1024)
+    assert len(parts) > 1
+    rows = []
+    for name, content in parts:
+        assert name.endswith(".csv.gz")
+        rows += read_part("csv.gz", content)
+    assert [row["uid"] for row in rows] == [row["uid"] for row in expected]
+    assert rows[0]["username"] == "user0" and rows[0]["active"] == "True"
+
+def test_single_part_has_no_suffix():
+    parts = write_all("csv", ROWS[:3])
+    assert [name for name, _ in parts] == ["export.csv"]
+    assert len(read_part("csv", parts[0][1])) == 3
+
+def test_empty_export_still_has_file():
+    parts = write_all("jsonl", [])
+    assert parts == [("export.jsonl", b"")]
@@ -0,0 +1,58 @@
+# tests/test_fanout.py
+"""Пересылка: обрезка текста по меркам Telegram, порядок сообщений у каждого получателя."""
+import asyncio
+import random
+
+import bot
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def test_clip_text_short_text_untouched():
+    assert bot.clip_text("привет", 10) == "привет"
+    assert bot.clip_text("😀" * 5, 10) == "😀" * 5
+
+def test_clip_text_counts_utf16_units():
+    # эмодзи — две единицы: в 5 помещаются только два, половинку не оставляем
+    assert bot.clip_text("😀" * 3, 5) == "😀😀"
+    assert bot.clip_text("a😀b", 2) == "a"
+    text = "ж" * 5000
+    assert bot.clip_text(text, bot.TG_MESSAGE_LIMIT) == "ж" * bot.TG_MESSAGE_LIMIT
+
+def test_caption_clipped_to_limit():
+    media = {"type": "album", "items": [{"type": "photo", "file_id": "a"}, {"type": "photo", "file_id": "b"}]}
+    clipped = bot.with_caption(media, "💬" * 2000)
+    assert utf16_len(clipped["items"][0]["caption"]) == bot.CAPTION_LIMIT
+    assert "caption" not in media["items"][0]
+
+def test_fanout_keeps_order_per_recipient(monkeypatch):
+    received = {}
+
+    async def send(chat_id, call):
+        # разные задержки: воркеры обгоняют друг друга
+        await asyncio.sleep(random.random() / 100)
+        received.setdefault(chat_id, []).append(call[1]["text"])
+
+    class FakeBot:
+        async def send_message(self, **kwargs):
+            pass
+
+    recipients = [str(uid) for uid in range(100, 110)]
+    monkeypatch.setattr(bot, "send_resolved", send)
+
+    async def main():
+        fanout = bot.Fanout(workers=4)
+        fanout.recipients = lambda sender: [uid for uid in recipients if uid != sender]
+        for i in range(20):
+            fanout.enqueue(bot.FanoutMessage("100", f"m{i}"))
+        fanout.start(FakeBot())
+        while fanout.delivered < 20 * 9:
+            await asyncio.sleep(0.01)
+        await bot.stop_background()
+        return fanout
+
+    fanout = asyncio.run(asyncio.wait_for(main(), 10))
+    assert set(received) == {int(uid) for uid in recipients[1:]}
+    for texts in received.values():
+        assert texts == [f"m{i}" for i in range(20)]
+    assert fanout.depth == 0
@@ -0,0 +1,74 @@
+# tests/test_flood.py
+"""Защита от флуда: удвоение автомута, чистка бакетов."""
+import pytest
+
+import bot
+
+class Clock:
+    """Подменяет модуль time в bot: время двигает тест"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot, "time", clock)
+    return clock
+
+def flood():
+    # одно сообщение в секунду без запаса, мут со второго отказа подряд
+    return bot.FloodControl(rate=1, burst=1, strikes=2, idle=100)
+
+def hit_limit(control, uid):
+    """Шлёт, пока не получит мут; возвращает его текст"""
+    while True:
+        ok, reply = control.check(uid)
+        if not ok and reply and "мут" in reply:
+            return reply
+
+def test_first_refusal_warns_then_silent(clock):
+    control = bot.FloodControl(rate=1, burst=1, strikes=3, idle=100)
+    assert control.check("1") == (True, None)
+    assert control.check("1") == (False, "🐢 Слишком часто. Подождите немного.")
+    assert control.check("1") == (False, None)
+    clock.now += 1
+    assert control.check("1") == (True, None)
+
+def test_mute_doubles_and_caps(clock):
+    control = flood()
+    minutes = bot.FLOOD_MUTE_MIN
+    assert hit_limit(control, "1") == f"⏱️ Слишком много сообщений — мут на {minutes} мин."
+    assert hit_limit(control, "1") == f"⏱️ Слишком много сообщений — мут на {minutes * 2} мин."
+    control.buckets["1"].mutes = 30
+    assert hit_limit(control, "1") == f"⏱️ Слишком много сообщений — мут на {bot.FLOOD_MUTE_MAX_MIN} мин."
+
+def test_sweep_drops_idle_buckets(clock):
+    control = flood()
+    control.check("1")
+    clock.now += 99
+    control.sweep()
+    assert "1" in control.buckets
+    clock.now += 2
+    control.sweep()
+    assert "1" not in control.buckets
+
+def test_sweep_keeps_muted_until_mute_ends(clock):
+    control = flood()
+    hit_limit(control, "1")
+    control.check("2")
+    mute = bot.FLOOD_MUTE_MIN * 60
+    # мут длиннее idle: бакет нужен, чтобы следующий мут вышел вдвое дольше
+    clock.now += mute
+    control.sweep()
+    assert list(control.buckets) == ["1"]
+    assert hit_limit(control, "1").endswith(f"мут на {bot.FLOOD_MUTE_MIN * 2} мин.")
+    clock.now += 2 * mute + 101
+    control.sweep()
+    assert not control.buckets
@@ -0,0 +1,106 @@
+# tests/test_journal.py
+"""Журнал изменений: проигрывание поверх снимка, падение посреди сжатия."""
+import json
+import os
+
+import bot
+
+def user(uid, anon, username=None, **extra):
+    return {"op": "user", "uid": uid, "info": {"username": username, "anon": anon, "muted_until": 0, **extra}}
+
+def write_journal(path, records, tail=""):
+    with open(path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        f.write(tail)
+
+def state(data):
+    """data для сравнения: пользователи — обычным dict"""
+    return {**data, "users": data["users"].to_dict()}
+
+def snapshot_with(records):
+    data = bot.read_snapshot()
+    for rec in records:
+        bot.apply_record(data, rec)
+    bot.write_snapshot(data)
+    return data
+
+SNAPSHOT = [user("1", 1111, "alice"), user("2", 2222, "bob"), {"op": "admin_add", "username": "@alice"}]
+OLD = [user("3", 3333, "carol"), {"op": "user_set", "uid": "1", "field": "muted_until", "value": 99},
+       {"op": "ban_add", "username": "@bob"}]
+CURRENT = [user("4", 4444), {"op": "user_set", "uid": "3", "field": "username", "value": "caroline"},
+           {"op": "ban_del", "username": "@bob"}, {"op": "set", "key": "message_count", "value": 7}]
+
+def expected(*parts):
+    data = bot.empty_data()
+    data["users"] = bot.UserTable()
+    for records in parts:
+        for rec in records:
+            bot.apply_record(data, rec)
+    return state(data)
+
+def test_replay_over_snapshot(workdir):
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL, OLD + CURRENT)
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD, CURRENT)
+
+def test_replay_skips_torn_tail(workdir):
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL, OLD, tail='{"op": "user", "uid": "9", "in')
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD)
+
+def test_old_journal_after_crash_before_snapshot(workdir):
+    # упали после переименования в .old, но до записи нового снимка
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL + ".old", OLD)
+    write_journal(bot.DATA_JOURNAL, CURRENT)
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD, CURRENT)
+
+def test_old_journal_after_crash_before_remove(workdir):
+    # снимок уже содержит .old, а сам .old удалить не успели: повтор безвреден
+    snapshot_with(SNAPSHOT + OLD)
+    write_journal(bot.DATA_JOURNAL + ".old", OLD)
+    write_journal(bot.DATA_JOURNAL, CURRENT)
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD, CURRENT)
+
+def test_journal_finishes_interrupted_compaction(workdir):
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL + ".old", OLD)
+    write_journal(bot.DATA_JOURNAL, CURRENT)
+    journal = bot.Journal(path=bot.DATA_JOURNAL, snapshot_path=bot.DATA_FILE)
+    journal._compactor.join()
+    journal.close()
+    assert not (workdir / (bot.DATA_JOURNAL + ".old")).exists()
+    assert state(bot.read_snapshot()) == expected(SNAPSHOT, OLD)
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD, CURRENT)
+
+def test_compact_folds_everything_into_snapshot(workdir):
+    snapshot_with(SNAPSHOT)
+    journal = bot.Journal(path=bot.DATA_JOURNAL, snapshot_path=bot.DATA_FILE)
+    for rec in OLD + CURRENT:
+        journal.append(rec)
+    journal.compact()
+    journal.close()
+    assert (workdir / bot.DATA_JOURNAL).stat().st_size == 0
+    assert state(bot.read_snapshot()) == expected(SNAPSHOT, OLD, CURRENT)
+
+def test_journal_repairs_torn_tail(workdir):
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL, OLD, tail='{"op": "user", "uid": "9", "in')
+    journal = bot.Journal()
+    journal.append({"op": "admin_add", "username": "@boss"})
+    journal.close()
+    assert state(bot.load_data()) == expected(SNAPSHOT, OLD, [{"op": "admin_add", "username": "@boss"}])
+
+def test_journal_counts_records_on_disk(workdir):
+    snapshot_with(SNAPSHOT)
+    write_journal(bot.DATA_JOURNAL, OLD + CURRENT)
+    journal = bot.Journal(compact_every=len(OLD + CURRENT) + 1)
+    assert journal.records == len(OLD + CURRENT)
+    # одной новой записи хватает, чтобы сжать журнал, набранный прошлыми запусками
+    journal.append({"op": "admin_add", "username": "@boss"})
+    journal.flush()
+    journal._compactor.join()
+    journal.close()
+    assert not os.path.exists(bot.DATA_JOURNAL + ".old")
+    assert state(bot.read_snapshot()) == expected(SNAPSHOT, OLD, CURRENT, [{"op": "admin_add", "username": "@boss"}])
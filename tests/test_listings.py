@@ -0,0 +1,31 @@
+# tests/test_listings.py
+"""Поиск по админам: префикс в callback_data укладывается в лимит Telegram."""
+import bot
+
+CALLBACK_DATA_LIMIT = 64  # байт UTF-8
+
+def callback_data(keyboard):
+    return [button.callback_data for row in keyboard.inline_keyboard for button in row if button.callback_data]
+
+def test_search_prefix_cut_by_bytes_on_char_boundary():
+    text, keyboard = bot.admins_listing(0, "ж" * 40 + "😀")
+    prefix = "@" + "ж" * ((bot.ADMIN_SEARCH_BYTES - 1) // 2)
+    assert len(prefix.encode()) <= bot.ADMIN_SEARCH_BYTES
+    assert text.startswith(f"🧑‍💼 Администраторы ({prefix}…)")
+    assert all(len(data.encode()) <= CALLBACK_DATA_LIMIT for data in callback_data(keyboard))
+
+def test_search_pager_fits_callback_limit():
+    stem = "@" + "q" * 40
+    for i in range(bot.ADMINS_PAGE_SIZE + 5):
+        bot.record("admin_add", username=f"{stem}{i}")
+    try:
+        text, keyboard = bot.admins_listing(0, stem[1:] + "|")
+        data = callback_data(keyboard)
+        pages = [d for d in data if d.startswith("ADMINS|")]
+        # вторая страница есть, и её кнопка несёт урезанный префикс без "|"
+        assert pages and all(d.startswith("ADMINS|1|" + stem[:bot.ADMIN_SEARCH_BYTES]) for d in pages)
+        assert all(len(d.encode()) <= CALLBACK_DATA_LIMIT for d in data)
+        assert text.count(stem) == bot.ADMINS_PAGE_SIZE
+    finally:
+        for i in range(bot.ADMINS_PAGE_SIZE + 5):
+            bot.record("admin_del", username=f"{stem}{i}")
@@ -0,0 +1,57 @@
+# tests/test_migration.py
+"""Перенос data.json в SQLite: повторы anon, откат упавшего переноса."""
+import json
+
+import pytest
+
+import bot
+
+def write_data(users, admins=()):
+    data = bot.empty_data()
+    data["users"] = {uid: {"username": name, "anon": anon, "muted_until": 0} for uid, name, anon in users}
+    data["admins"] = list(admins)
+    with open(bot.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+USERS = [("1", "alice", 1234), ("2", "bob", 1234), ("3", "carol", 5678), ("4", "dave", 5678)]
+
+def check_migrated(store):
+    assert {uid for uid, _ in store.iter_users()} == {"1", "2", "3", "4"}
+    anons = [info["anon"] for _, info in store.iter_users()]
+    assert len(set(anons)) == len(anons)
+    # у первого владельца номер остаётся прежним
+    assert store.get_user("1")["anon"] == 1234
+    assert store.get_user("3")["anon"] == 5678
+    assert store.admins() == ["@alice"]
+
+def test_duplicate_anons_get_new_ids(workdir):
+    write_data(USERS, admins=["@alice"])
+    store = bot.SqliteStorage(str(workdir / "test.sqlite3"))
+    check_migrated(store)
+    assert store.get("migrated") is not None
+
+def test_failed_migration_retried(workdir, monkeypatch):
+    write_data(USERS, admins=["@alice"])
+    path = str(workdir / "test.sqlite3")
+
+    def broken(store, data, users):
+        store.db.executemany(store.SQL_USER_UPSERT, users)
+        raise RuntimeError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(bot, "migrate_rows", broken)
+        with pytest.raises(RuntimeError):
+            bot.SqliteStorage(path)
+    # файл базы уже есть, но без данных и без отметки — второй запуск переносит заново
+    store = bot.SqliteStorage(path)
+    check_migrated(store)
+
+def test_migrated_once(workdir):
+    write_data(USERS)
+    path = str(workdir / "test.sqlite3")
+    store = bot.SqliteStorage(path)
+    store.apply({"op": "user_set", "uid": "4", "field": "username", "value": "david"})
+    store.commit_pending(force=True)
+    store.db.close()
+    # data.json никуда не делся, но перенос уже отмечен — изменения в базе не затираются
+    assert bot.SqliteStorage(path).get_user("4")["username"] == "david"
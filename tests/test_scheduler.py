@@ -0,0 +1,61 @@
+# tests/test_scheduler.py
+"""Планировщик: замена и отмена по ключу, пересборка кучи."""
+import asyncio
+import time
+
+import bot
+
+def run_scheduler(setup, wait=0.2):
+    """setup(scheduler) внутри цикла событий, потом ждём срабатываний"""
+    async def main():
+        scheduler = bot.Scheduler()
+        scheduler.start(None)
+        setup(scheduler)
+        await asyncio.sleep(wait)
+        await bot.stop_background()
+        return scheduler
+    return asyncio.run(main())
+
+def test_key_replaces_previous_job():
+    fired = []
+    def setup(s):
+        now = time.time()
+        s.at(now + 0.05, fired.append, "old", key="k")
+        s.at(now + 0.1, fired.append, "new", key="k")
+        s.at(now + 0.02, fired.append, "plain")
+    scheduler = run_scheduler(setup)
+    assert fired == ["plain", "new"]
+    assert len(scheduler) == 0
+
+def test_cancel():
+    fired = []
+    def setup(s):
+        s.at(time.time() + 0.05, fired.append, "job", key="k")
+        s.cancel("k")
+        s.cancel("missing")
+    run_scheduler(setup)
+    assert fired == []
+
+def test_failing_job_does_not_stop_others():
+    fired = []
+    async def boom():
+        raise RuntimeError("boom")
+    def setup(s):
+        now = time.time()
+        s.at(now + 0.01, lambda: 1 / 0)
+        s.at(now + 0.02, boom)
+        s.at(now + 0.05, fired.append, "after")
+    run_scheduler(setup)
+    assert fired == ["after"]
+
+def test_compaction_drops_stale_entries(monkeypatch):
+    monkeypatch.setattr(bot, "SCHEDULER_COMPACT_MIN", 10)
+    scheduler = bot.Scheduler()
+    later = time.time() + 3600
+    scheduler.at(later, print)
+    for i in range(100):
+        scheduler.at(later + i, print, i, key="mute")
+    # без пересборки в куче лежали бы все 101 запись
+    assert len(scheduler._heap) <= 2 * 10 + 2
+    live = [e for e in scheduler._heap if e[2] is None or scheduler._keys.get(e[2]) == e[1]]
+    assert sorted(e[4] for e in live) == [(), (99,)]
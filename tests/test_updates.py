@@ -0,0 +1,63 @@
+# tests/test_updates.py
+"""PerUserUpdateProcessor: порядок обновлений одного пользователя, общие слоты."""
+import asyncio
+
+from telegram import Update
+
+import bot
+
+def update(update_id, user_id):
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"}, "text": "hi"}}, None)
+
+def run_updates(processor, jobs):
+    """jobs: [(update, корутина)] — подаются по порядку, как их раздаёт Application"""
+    async def main():
+        await asyncio.gather(*(processor.process_update(u, coro) for u, coro in jobs))
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+def test_same_user_in_order_one_at_a_time():
+    done, active = [], {}
+
+    async def handle(user_id, n, delay):
+        active[user_id] = active.get(user_id, 0) + 1
+        assert active[user_id] == 1
+        await asyncio.sleep(delay)
+        active[user_id] -= 1
+        done.append((user_id, n))
+
+    processor = bot.PerUserUpdateProcessor(8)
+    jobs = [(update(i, 1 + i % 2), handle(1 + i % 2, i, (7 - i % 7) / 1000)) for i in range(20)]
+    run_updates(processor, jobs)
+    for user_id in (1, 2):
+        assert [n for u, n in done if u == user_id] == [i for i in range(20) if 1 + i % 2 == user_id]
+    assert processor._queues == {}
+
+def test_busy_user_does_not_hold_slots():
+    # два слота, у первого пользователя длинная очередь: второй не должен её ждать
+    done = []
+
+    async def handle(name, delay):
+        await asyncio.sleep(delay)
+        done.append(name)
+
+    processor = bot.PerUserUpdateProcessor(2)
+    jobs = [(update(i, 1), handle(f"busy{i}", 0.02)) for i in range(10)]
+    jobs.append((update(10, 2), handle("other", 0)))
+    run_updates(processor, jobs)
+    assert done.index("other") < 3
+    assert done[-1] == "busy9"
+
+def test_failed_update_does_not_stop_queue():
+    done = []
+
+    async def handle(n):
+        await asyncio.sleep(0)
+        if n == 1:
+            raise RuntimeError("boom")
+        done.append(n)
+
+    processor = bot.PerUserUpdateProcessor(4)
+    run_updates(processor, [(update(n, 1), handle(n)) for n in range(4)])
+    assert done == [0, 2, 3]
@@ -0,0 +1,185 @@
+# tests/test_users.py
+"""UserTable (dict-фасад над колонками), data.snap и выдача anon."""
+import json
+import os
+
+import pytest
+
+import bot
+
+def table(*rows):
+    return bot.UserTable.from_items((str(uid), info) for uid, info in rows)
+
+ALICE = {"username": "alice", "anon": 1111, "muted_until": 0}
+BOB = {"username": "bob", "anon": 2222, "muted_until": 500, "active": False}
+CAROL = {"username": None, "anon": None, "muted_until": 0, "note": "vip"}
+
+# -------------------------
+# UserTable
+# -------------------------
+def test_reads_like_dict():
+    users = table((1, ALICE), (2, BOB), (3, CAROL))
+    assert list(users) == ["1", "2", "3"]
+    assert len(users) == 3
+    assert "2" in users and "9" not in users and "x" not in users
+    assert dict(users["1"]) == {**ALICE, "active": True}
+    assert dict(users["2"]) == BOB
+    assert dict(users["3"]) == {**CAROL, "active": True}
+    assert users.get("9") is None
+    with pytest.raises(KeyError):
+        users["x"]
+
+def test_set_replaces_whole_record():
+    users = table((1, CAROL))
+    users["1"] = ALICE
+    assert dict(users["1"]) == {**ALICE, "active": True}  # лишнее поле note ушло
+    users["4"] = {"username": "dave"}
+    assert dict(users["4"]) == {"username": "dave", "anon": None, "muted_until": 0, "active": True}
+    assert list(users) == ["1", "4"]
+
+def test_view_writes_through():
+    users = table((1, ALICE))
+    view = users["1"]
+    view["muted_until"] = 77
+    view["active"] = False
+    view["note"] = "x"
+    assert dict(users["1"]) == {**ALICE, "muted_until": 77, "active": False, "note": "x"}
+    assert users.muted_rows() == [("1", 77)]
+    assert list(users.deliverable()) == []
+    view["muted_until"] = 0
+    view["active"] = True
+    del view["note"]
+    assert dict(users["1"]) == {**ALICE, "active": True}
+    assert users.muted_rows() == []
+    with pytest.raises(KeyError):
+        del view["anon"]
+
+def test_delete_user_keeps_others():
+    users = table((1, ALICE), (2, BOB), (3, CAROL))
+    users.set_banned("3", True)
+    del users["2"]
+    assert list(users) == ["1", "3"]
+    assert dict(users["3"]) == {**CAROL, "active": True}
+    assert users.muted_rows() == []
+    # бан переезжает вместе со сдвинутой строкой
+    assert list(users.deliverable()) == ["1"]
+    with pytest.raises(KeyError):
+        del users["2"]
+
+def test_deliverable_skips_banned_and_inactive():
+    users = table((1, ALICE), (2, BOB), (3, CAROL), (4, {"username": "dave", "anon": 4444}))
+    assert list(users.deliverable()) == ["1", "3", "4"]
+    users.set_banned("4", True)
+    assert list(users.deliverable()) == ["1", "3"]
+    users["2"]["active"] = True
+    users.set_banned("4", False)
+    assert list(users.deliverable()) == ["1", "2", "3", "4"]
+    assert len(users.inactive) == 0
+
+def test_copy_is_independent():
+    users = table((1, ALICE), (2, BOB))
+    users.set_banned("1", True)
+    snapshot = users.copy()
+    users["1"]["username"] = "changed"
+    users["2"]["active"] = True
+    users["3"] = CAROL
+    users.set_banned("1", False)
+    assert list(snapshot) == ["1", "2"]
+    assert snapshot["1"]["username"] == "alice"
+    assert snapshot["2"]["active"] is False
+    assert list(snapshot.deliverable()) == []
+
+def test_from_items_matches_slow_path():
+    rows = [("1", ALICE), ("2", BOB), ("3", CAROL), ("1", {"username": "again", "anon": 5})]
+    fast = bot.UserTable.from_items(rows)
+    slow = bot.UserTable()
+    for uid, info in rows:
+        slow[uid] = info
+    assert fast.to_dict() == slow.to_dict()
+    assert fast.muted_rows() == slow.muted_rows()
+
+def test_scan_and_items_range():
+    users = table((1, ALICE), (2, BOB), (3, CAROL))
+    assert list(users.scan(["username", "anon", "active"])) == [
+        ("1", "alice", 1111, True), ("2", "bob", 2222, False), ("3", None, None, True)]
+    assert [uid for uid, _ in users.items_range(1, 5)] == ["2", "3"]
+
+def test_state_round_trip():
+    users = table((1, ALICE), (2, BOB), (3, CAROL))
+    restored = bot.UserTable.from_state(users.state())
+    assert restored.to_dict() == users.to_dict()
+    assert restored.muted_rows() == users.muted_rows()
+    assert list(restored.deliverable()) == list(users.deliverable())
+
+# -------------------------
+# data.snap
+# -------------------------
+def sample_data():
+    data = bot.empty_data()
+    data["users"] = table((1, ALICE), (2, BOB), (3, CAROL))
+    data["admins"] = ["@alice"]
+    data["banned"] = ["@bob"]
+    data["permissions"] = {"@alice": {p: True for p in bot.ALL_PERMS}}
+    data["user_state"] = {"1": {"await_action": bot.STATE_WAIT_BROADCAST}}
+    data["message_count"] = 3
+    data["broadcast"] = {"text": "привет", "cursor": 1}
+    return data
+
+def test_snap_matches_json(workdir):
+    bot.write_snapshot(sample_data())
+    with open(bot.DATA_FILE, encoding="utf-8") as f:
+        from_json = json.load(f)
+    from_snap = bot.read_binary_snapshot(bot.DATA_FILE)
+    assert from_snap is not None
+    assert {**from_snap, "users": from_snap["users"].to_dict()} == from_json
+
+def test_snap_ignored_when_json_changes(workdir):
+    bot.write_snapshot(sample_data())
+    with open(bot.DATA_FILE, encoding="utf-8") as f:
+        data = json.load(f)
+    data["message_count"] = 42
+    with open(bot.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    assert bot.read_binary_snapshot(bot.DATA_FILE) is None
+    assert bot.read_snapshot()["message_count"] == 42
+
+def test_broken_snap_falls_back_to_json(workdir):
+    bot.write_snapshot(sample_data())
+    stamp = os.stat(bot.DATA_FILE)
+    with open(bot.binary_snapshot_path(bot.DATA_FILE), "wb") as f:
+        f.write(b"\x00garbage")
+    os.utime(bot.DATA_FILE, ns=(stamp.st_atime_ns, stamp.st_mtime_ns))
+    assert bot.read_binary_snapshot(bot.DATA_FILE) is None
+    assert bot.read_snapshot()["users"].to_dict() == sample_data()["users"].to_dict()
+
+# -------------------------
+# anon
+# -------------------------
+ANON_USERS = 12000  # больше половины 4-значных номеров — дальше выдаются 5-значные
+
+def fill(store):
+    for i in range(ANON_USERS):
+        store.apply({"op": "user", "uid": str(i), "info": {"username": None, "anon": store.allocate_anon(),
+                                                          "muted_until": 0}})
+    return [info["anon"] for _, info in store.iter_users()]
+
+def check_anons(anons):
+    assert len(set(anons)) == ANON_USERS
+    assert all(1000 <= a <= 99999 for a in anons)
+    assert sum(a < 10000 for a in anons) == 4500
+
+def test_anon_unique_json(workdir):
+    store = bot.JsonStorage()
+    try:
+        anons = fill(store)
+        assert len(store.index.by_anon) == ANON_USERS
+    finally:
+        store.close()
+    check_anons(anons)
+
+def test_anon_unique_sqlite(workdir):
+    store = bot.SqliteStorage(str(workdir / "test.sqlite3"))
+    try:
+        check_anons(fill(store))
+    finally:
+        store.close()
@@ -0,0 +1,355 @@
+# tools/bench.py
+"""Бенчмарк и нагрузочный прогон bot.py на синтетических данных.
+
+Для каждого размера и бэкенда генерируется data.json, bot.py импортируется в
+отдельном процессе (в нём глобальное состояние) и его хендлеры гоняются через
+Application.process_update против фейкового Bot API (tools/fake_telegram.py)
+с задержкой, 429 RetryAfter и заблокированными чатами.
+
+Для каждого сценария считаются пропускная способность, p50/p99 задержки хендлера
+и байты, записанные на диск на операцию; для прогона — время загрузки и пиковая память.
+
+    python tools/bench.py --sizes 10000,100000 --backends json,sqlite --save baseline.json
+    python tools/bench.py --sizes 10000 --compare baseline.json      # код выхода 1 при регрессии
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_telegram as ft
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 1
+ADMIN = "bench_admin"
+FIRST_USER_ID = 1000000
+FANOUT_TIMEOUT = 120.0  # секунд на доставку fan-out, дальше сценарий помечается timeout
+
+# -------------------------
+# Синтетические данные
+# -------------------------
+def generate_dataset(size, path="data.json", muted_share=0.01, banned_share=0.005, seed=42):
+    """data.json в формате бота: size пользователей, один админ со всеми правами"""
+    rnd = random.Random(seed)
+    anons = rnd.sample(range(1000, 1000 + max(20 * size, 9000)), size)
+    users = {}
+    banned = []
+    now = int(time.time())
+    for i in range(size):
+        uid = FIRST_USER_ID + i
+        users[str(uid)] = {
+            "username": f"u{uid}" if rnd.random() < 0.8 else None,
+            "anon": anons[i],
+            "muted_until": now + 3600 if rnd.random() < muted_share else 0,
+        }
+        if users[str(uid)]["username"] and rnd.random() < banned_share:
+            banned.append(f"@u{uid}")
+    users[str(ADMIN_ID)] = {"username": ADMIN, "anon": 999, "muted_until": 0}
+    data = {
+        "users": users,
+        "admins": [f"@{ADMIN}"],
+        "banned": banned,
+        "permissions": {f"@{ADMIN}": {p: True for p in
+                                      ["broadcast", "impersonate", "manage_perms", "stats", "mute", "export", "admin_chat"]}},
+        "message_count": 0,
+        "admin_chat_enabled": False,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return data
+
+# -------------------------
+# Замеры
+# -------------------------
+def written_bytes():
+    """Байты, записанные процессом (все потоки) — /proc/self/io, иначе 0"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+class Scenario:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.started = None
+        self.seconds = 0.0
+        self.bytes = 0
+        self.extra = {}
+
+    def __enter__(self):
+        self._w0 = written_bytes()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        self.bytes = written_bytes() - self._w0
+
+    async def timed(self, coro):
+        t = time.perf_counter()
+        await coro
+        self.latencies.append(time.perf_counter() - t)
+
+    def result(self):
+        ops = len(self.latencies) or self.extra.get("ops", 0)
+        return {
+            "ops": ops,
+            "seconds": round(self.seconds, 4),
+            "throughput": round(ops / self.seconds, 2) if self.seconds else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 3),
+            "bytes_written_per_op": round(self.bytes / ops, 1) if ops else 0.0,
+            **self.extra,
+        }
+
+# -------------------------
+# Прогон одного размера (в отдельном процессе)
+# -------------------------
+async def drive(bot, size, args):
+    from telegram import Update
+    application = bot.build_application()
+    await application.initialize()
+    await bot.post_init(application)
+    ids = [FIRST_USER_ID + i for i in range(size)]
+    rnd = random.Random(1)
+
+    async def process(update_dict):
+        await application.process_update(Update.de_json(update_dict, application.bot))
+
+    results = {}
+
+    # новые пользователи: /start -> ensure_user_registered + ответ
+    with Scenario("start_new_user") as s:
+        for i in range(args.ops):
+            uid = FIRST_USER_ID + size + i
+            await s.timed(process(ft.make_message_update(uid, "/start", f"new{uid}")))
+        bot.flush_data()
+    results[s.name] = s.result()
+
+    # message_handler: поток «мут» (поиск по @username + запись)
+    with Scenario("mute_flow") as s:
+        for _ in range(args.ops):
+            target = rnd.choice(ids)
+            await process(ft.make_callback_update(ADMIN_ID, "MUTE_USER", ADMIN))
+            await s.timed(process(ft.make_message_update(ADMIN_ID, f"@u{target} 1", ADMIN)))
+        bot.flush_data()
+    results[s.name] = s.result()
+
+    # callback_query_handler: листание списка пользователей и статистика
+    pages = max(1, size // 50)
+    with Scenario("show_users_page") as s:
+        for _ in range(args.ops):
+            await s.timed(process(ft.make_callback_update(ADMIN_ID, f"USERS|{rnd.randrange(pages)}", ADMIN)))
+    results[s.name] = s.result()
+
+    with Scenario("show_stats") as s:
+        for _ in range(min(args.ops, 200)):
+            await s.timed(process(ft.make_callback_update(ADMIN_ID, "SHOW_STATS", ADMIN)))
+    results[s.name] = s.result()
+
+    # save_data: полный снимок (как в post_shutdown — в потоке цикла событий)
+    with Scenario("save_data") as s:
+        t = time.perf_counter()
+        bot.save_data()
+        s.latencies.append(time.perf_counter() - t)
+    results[s.name] = s.result()
+
+    # рассылка на первые broadcast_users пользователей
+    total = min(size, args.broadcast_users)
+    bot.record("set", key="broadcast", value={"text": "bench", "chat_id": ADMIN_ID, "message_id": 1,
+                                              "total": total, "cursor": 0, "sent": 0, "failed": 0})
+    with Scenario("broadcast") as s:
+        bot.start_broadcast(application)
+        await bot.BROADCAST_TASK
+        s.extra["ops"] = total
+    results[s.name] = s.result()
+
+    # fan-out одного анонимного сообщения всем (только на небольших наборах)
+    if size <= args.fanout_max:
+        with Scenario("fanout") as s:
+            before = bot.FANOUT.stats()
+            await s.timed(process(ft.make_message_update(ADMIN_ID, "/send", ADMIN)))
+            t = time.perf_counter()
+            await process(ft.make_message_update(ADMIN_ID, "bench fan-out", ADMIN))
+            s.extra["publish_ms"] = round((time.perf_counter() - t) * 1000, 3)
+            s.latencies.clear()
+            await asyncio.sleep(0.05)
+            deadline = time.monotonic() + FANOUT_TIMEOUT
+            while True:
+                st = bot.FANOUT.stats()
+                if st["depth"] == 0 and st["pending_messages"] == 0:
+                    break
+                if time.monotonic() > deadline:
+                    s.extra["timeout"] = True
+                    break
+                await asyncio.sleep(0.05)
+            done = sum(st[k] - before[k] for k in ("delivered", "failed", "dropped"))
+            s.extra["ops"] = done
+            s.extra["lag_max_s"] = round(st["lag_max"], 3)
+        results[s.name] = s.result()
+
+    await bot.stop_background()
+    await application.shutdown()
+    return results
+
+def run_one(args):
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    generate_dataset(args.size)
+    os.environ.update(
+        YOUR_BOT_TOKEN="123456:bench",
+        TELEGRAM_API_URL=args.api,
+        STORAGE_BACKEND=args.backend,
+        # меряем сам движок, а не лимиты Telegram
+        TG_GLOBAL_RATE="1000000",
+        TG_PER_CHAT_INTERVAL="0",
+    )
+    sys.path.insert(0, ROOT)
+    w0 = written_bytes()
+    t0 = time.perf_counter()
+    import bot
+    load_s = time.perf_counter() - t0
+    logging.getLogger().setLevel(logging.WARNING)
+    result = {
+        "size": args.size,
+        "backend": args.backend,
+        "load_s": round(load_s, 3),
+        "load_bytes_written": written_bytes() - w0,
+        "rss_after_load_mb": round(rss_mb(), 1),
+        "dataset_bytes": os.path.getsize("data.json"),
+    }
+    result["scenarios"] = asyncio.run(drive(bot, args.size, args))
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+
+# -------------------------
+# Сравнение с базовой линией
+# -------------------------
+# метрика -> True, если больше значит лучше
+COMPARED = {"throughput": True, "p50_ms": False, "p99_ms": False, "bytes_written_per_op": False}
+
+def compare(baseline, current, tolerance):
+    """Список регрессий хуже базовой линии больше чем на tolerance (доля)"""
+    base = {(r["size"], r["backend"]): r for r in baseline["runs"]}
+    regressions = []
+    for run in current["runs"]:
+        ref = base.get((run["size"], run["backend"]))
+        if not ref:
+            continue
+        for name, metrics in run["scenarios"].items():
+            ref_metrics = ref["scenarios"].get(name)
+            if not ref_metrics:
+                continue
+            for key, higher_is_better in COMPARED.items():
+                old, new = ref_metrics.get(key), metrics.get(key)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append(f"{run['backend']}/{run['size']}/{name}.{key}: {old} -> {new} ({change:+.0%})")
+        for key in ("load_s", "peak_rss_mb"):
+            old, new = ref.get(key), run.get(key)
+            if old and new and (new - old) / old > tolerance:
+                regressions.append(f"{run['backend']}/{run['size']}/{key}: {old} -> {new} ({(new - old) / old:+.0%})")
+    return regressions
+
+def print_table(report):
+    for run in report["runs"]:
+        print(f"\n== {run['backend']} / {run['size']} users: load {run['load_s']}s, "
+              f"rss {run['rss_after_load_mb']} MB, peak {run['peak_rss_mb']} MB")
+        print(f"{'scenario':<16}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'B/op':>10}")
+        for name, m in run["scenarios"].items():
+            print(f"{name:<16}{m['ops']:>8}{m['throughput']:>12}{m['p50_ms']:>10}{m['p99_ms']:>10}"
+                  f"{m['bytes_written_per_op']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000", help="размеры наборов, например 10000,100000,1000000")
+    parser.add_argument("--backends", default="json", help="json,sqlite")
+    parser.add_argument("--ops", type=int, default=500, help="операций в сценарии")
+    parser.add_argument("--broadcast-users", type=int, default=5000)
+    parser.add_argument("--fanout-max", type=int, default=20000, help="fan-out только на наборах не больше")
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0005)
+    parser.add_argument("--blocked-rate", type=float, default=0.02)
+    parser.add_argument("--save", help="записать результаты (базовую линию) в JSON")
+    parser.add_argument("--compare", help="сравнить с базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    # внутренний режим: один прогон в отдельном процессе
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--api", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        run_one(args)
+        return
+
+    fake = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "fake_telegram.py"), "serve",
+                             "--port", str(port := ft.free_port()),
+                             "--latency-ms", str(args.latency_ms),
+                             "--retry-after-rate", str(args.retry_after_rate),
+                             "--blocked-rate", str(args.blocked_rate)], stdout=subprocess.DEVNULL)
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+              "params": {k: getattr(args, k) for k in ("ops", "broadcast_users", "latency_ms",
+                                                       "retry_after_rate", "blocked_rate")},
+              "runs": []}
+    try:
+        time.sleep(0.5)
+        for backend in args.backends.split(","):
+            for size in (int(s) for s in args.sizes.split(",")):
+                out = tempfile.mktemp(suffix=".json")
+                subprocess.run([sys.executable, __file__, "--run-one", "--size", str(size), "--backend", backend,
+                                "--api", f"http://127.0.0.1:{port}", "--out", out,
+                                "--ops", str(args.ops), "--broadcast-users", str(args.broadcast_users),
+                                "--fanout-max", str(args.fanout_max)], check=True)
+                with open(out) as f:
+                    report["runs"].append(json.load(f))
+                os.remove(out)
+    finally:
+        fake.terminate()
+    print_table(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for r in regressions:
+                print(f"  {r}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+if __name__ == "__main__":
+    main()
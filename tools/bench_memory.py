@@ -0,0 +1,90 @@
+# tools/bench_memory.py
+"""Память на пользователя: прежний dict словарей против UserTable из bot.py.
+
+Для каждого размера генерируется data.json (как в tools/bench.py), и в отдельном
+процессе на каждую раскладку считается, сколько памяти (tracemalloc) остаётся
+занято пользователями после загрузки:
+
+    dict       — {str(uid): {"username": ..., "anon": ..., "muted_until": ...}}, как раньше
+    usertable  — bot.UserTable (колонки array('q'), интернированные username, битовые флаги)
+
+Индексы (username/anon -> uid) одинаковы для обеих раскладок и не входят в замер.
+
+    python tools/bench_memory.py --sizes 100000,1000000
+"""
+import os
+import sys
+import gc
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import ROOT, generate_dataset
+
+LAYOUTS = ("dict", "usertable")
+
+def measure(layout, path):
+    """(байт занято пользователями, секунд на загрузку) для раскладки layout"""
+    os.environ.setdefault("YOUR_BOT_TOKEN", "123456:bench")
+    sys.path.insert(0, ROOT)
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    with open(path, encoding="utf-8") as f:
+        users = json.load(f)["users"]
+    if layout == "usertable":
+        users = bot.UserTable.from_items(users.items())
+    seconds = time.perf_counter() - started
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    assert len(users) > 0
+    return used, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100000", help="размеры наборов, например 100000,1000000")
+    parser.add_argument("--save", help="записать результаты в JSON")
+    # внутренний режим: один замер в отдельном процессе
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--data", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        used, seconds = measure(args.measure, args.data)
+        print(json.dumps({"bytes": used, "seconds": seconds}))
+        return
+
+    runs = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        workdir = tempfile.mkdtemp(prefix="bot-bench-memory-")
+        path = os.path.join(workdir, "data.json")
+        generate_dataset(size, path)
+        run = {"size": size}
+        for layout in LAYOUTS:
+            # свой процесс и своя папка: bot.py при импорте открывает хранилище в текущей папке
+            out = subprocess.run([sys.executable, __file__, "--measure", layout, "--data", path],
+                                 cwd=workdir, check=True, capture_output=True, text=True).stdout
+            run[layout] = json.loads(out.strip().splitlines()[-1])
+        runs.append(run)
+
+    print(f"{'users':>10}{'layout':>12}{'MB':>10}{'B/user':>10}{'load s':>10}")
+    for run in runs:
+        for layout in LAYOUTS:
+            m = run[layout]
+            print(f"{run['size']:>10}{layout:>12}{m['bytes'] / 2 ** 20:>10.1f}"
+                  f"{m['bytes'] / run['size']:>10.0f}{m['seconds']:>10.2f}")
+        print(f"{'':>10}{'ratio':>12}{run['dict']['bytes'] / run['usertable']['bytes']:>10.2f}x")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": runs}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+# tools/fake_telegram.py
+"""Локальный фейковый Telegram Bot API — для офлайн-проверок без настоящего Telegram.
+
+Бот направляется сюда переменной TELEGRAM_API_URL. Сервер отвечает на вызовы
+Bot API правдоподобными объектами, запоминает их и умеет изображать задержку
+сети, 429 RetryAfter и заблокировавших бота пользователей (403).
+
+    python tools/fake_telegram.py serve --port 8081 --latency-ms 30 --retry-after-rate 0.01
+    python tools/fake_telegram.py webhook-check   # bot.py в webhook-режиме против фейка
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+# методы, адресованные конкретному чату: к ним применяются 429 и блокировки
+CHAT_METHODS = {"sendMessage", "copyMessage", "copyMessages", "forwardMessage", "sendPhoto", "sendDocument",
+                "sendVideo", "sendVoice", "sendAudio", "sendAnimation", "sendSticker", "sendMediaGroup",
+                "editMessageText"}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def parse_params(content_type, body):
+    """Параметры запроса PTB: form-urlencoded (значения в JSON), JSON или multipart"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        raw = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                raw[name] = part.get_content()
+            else:
+                raw[name] = f"<file {part.get_filename()}>"
+    else:
+        raw = {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+    params = {}
+    for k, v in raw.items():
+        try:
+            params[k] = json.loads(v)
+        except (ValueError, TypeError):
+            params[k] = v
+    return params
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # по умолчанию backlog = 5: под нагрузкой SYN отбрасываются и connect ждёт секунды
+    request_queue_size = 256
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, retry_after_rate=0.0, retry_after=1,
+                 blocked=(), blocked_rate=0.0, missing=()):
+        self.host = host
+        self.port = port or free_port()
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked = set(int(c) for c in blocked)
+        self.blocked_rate = blocked_rate  # доля chat_id, «заблокировавших» бота (детерминированно)
+        self.missing = set(int(c) for c in missing)  # chat_id, на которые Telegram отвечает chat not found
+        self.calls = []          # [(method, params)]
+        self.counts = {}         # method -> число вызовов
+        self.errors = {}         # "method:code" -> число ошибок
+        self.updates = []        # для getUpdates (polling)
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # --- управление ---
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, как у настоящего api.telegram.org: иначе httpx открывает
+            # новое соединение на каждый вызов и нагрузка упирается в connect
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                fake._handle(self, parse_params(self.headers.get("Content-Type", ""), body))
+
+            def do_GET(self):
+                fake._handle(self, {k: v[0] for k, v in parse_qs(self.path.partition("?")[2]).items()})
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def push_update(self, update):
+        with self._cond:
+            self.updates.append(update)
+            self._cond.notify_all()
+
+    def wait_for(self, predicate, timeout=10.0):
+        """Ждёт вызова, для которого predicate(method, params) истинно; возвращает его или None"""
+        deadline = time.monotonic() + timeout
+        seen = 0
+        with self._cond:
+            while True:
+                for method, params in self.calls[seen:]:
+                    if predicate(method, params):
+                        return method, params
+                seen = len(self.calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    # --- обработка ---
+    def _handle(self, handler, params):
+        method = handler.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+        with self._cond:
+            self.calls.append((method, params))
+            self.counts[method] = self.counts.get(method, 0) + 1
+            self._cond.notify_all()
+        status, payload = self._respond(method, params)
+        if status != 200:
+            with self._lock:
+                key = f"{method}:{status}"
+                self.errors[key] = self.errors.get(key, 0) + 1
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def is_blocked(self, chat_id):
+        if chat_id in self.blocked:
+            return True
+        return bool(self.blocked_rate) and isinstance(chat_id, int) and \
+            (chat_id * 2654435761) % 10000 < self.blocked_rate * 10000
+
+    def _message(self, chat_id, **extra):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def _respond(self, method, params):
+        chat_id = params.get("chat_id")
+        if method in CHAT_METHODS:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                pass
+            if self.is_blocked(chat_id):
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            if chat_id in self.missing:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+            if self.retry_after_rate and random.random() < self.retry_after_rate:
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            timeout = min(float(params.get("timeout") or 0), 1.0)
+            with self._cond:
+                self._cond.wait_for(lambda: any(u["update_id"] >= offset for u in self.updates), timeout)
+                result = [u for u in self.updates if u["update_id"] >= offset]
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "copyMessage":
+            result = {"message_id": self._message(chat_id)["message_id"]}
+        elif method == "copyMessages":
+            result = [{"message_id": self._message(chat_id)["message_id"]} for _ in params.get("message_ids", [])]
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id) for _ in params.get("media", [])]
+        elif method.startswith("send"):
+            result = self._message(chat_id)
+        else:
+            # setWebhook, deleteWebhook, answerCallbackQuery, ...
+            result = True
+        return 200, {"ok": True, "result": result}
+
+# -------------------------
+# Синтетические обновления
+# -------------------------
+_update_id = 0
+
+def make_message_update(user_id, text, username=None):
+    global _update_id
+    _update_id += 1
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    if username:
+        user["username"] = username
+    message = {"message_id": _update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": _update_id, "message": message}
+
+def make_media_update(user_id, kind, file_id, caption=None, media_group_id=None, username=None):
+    """Сообщение с вложением kind (photo, video, voice, document, ...) по готовому file_id"""
+    update = make_message_update(user_id, "", username)
+    message = update["message"]
+    del message["text"]
+    media = {"file_id": file_id, "file_unique_id": f"u{file_id}"}
+    if kind == "photo":
+        message["photo"] = [dict(media, width=90, height=90), dict(media, file_id=f"{file_id}-big", width=1280, height=1280)]
+    elif kind in ("voice", "audio"):
+        message[kind] = dict(media, duration=3)
+    elif kind in ("video", "animation"):
+        message[kind] = dict(media, width=640, height=360, duration=3)
+    else:
+        message[kind] = media
+    if caption:
+        message["caption"] = caption
+    if media_group_id:
+        message["media_group_id"] = media_group_id
+    return update
+
+def make_callback_update(user_id, data, username=None, message_id=1):
+    global _update_id
+    _update_id += 1
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    if username:
+        user["username"] = username
+    message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": BOT_USER, "text": "menu"}
+    return {"update_id": _update_id,
+            "callback_query": {"id": str(_update_id), "from": user, "chat_instance": "1", "data": data,
+                               "message": message}}
+
+def post_update(url, update, secret=None):
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    if secret is not None:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except urllib.error.URLError:
+        return 0
+
+# -------------------------
+# Проверка webhook-режима
+# -------------------------
+def webhook_check(bot_path, timeout=30.0):
+    """Запускает bot.py в webhook-режиме против фейкового API и прогоняет /start и анонимную отправку"""
+    fake = FakeTelegram().start()
+    bot_port = free_port()
+    secret = "fake-secret"
+    workdir = tempfile.mkdtemp(prefix="fake-telegram-")
+    env = dict(os.environ,
+               YOUR_BOT_TOKEN="123456:fake", BOT_MODE="webhook", TELEGRAM_API_URL=fake.url,
+               WEBHOOK_URL=f"http://127.0.0.1:{bot_port}", WEBHOOK_SECRET=secret, PORT=str(bot_port))
+    proc = subprocess.Popen([sys.executable, os.path.abspath(bot_path)], cwd=workdir, env=env)
+    hook = f"http://127.0.0.1:{bot_port}/webhook"
+    failures = []
+
+    def check(name, ok):
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+        if not ok:
+            failures.append(name)
+
+    try:
+        check("setWebhook called", fake.wait_for(lambda m, p: m == "setWebhook", timeout) is not None)
+        # Flask поднимается в отдельном потоке — ждём, пока начнёт отвечать
+        deadline = time.monotonic() + timeout
+        while post_update(hook, {}, secret) == 0 and time.monotonic() < deadline:
+            time.sleep(0.2)
+        check("wrong secret rejected", post_update(hook, make_message_update(1001, "/start", "alice"), "nope") == 403)
+        check("update accepted", post_update(hook, make_message_update(1001, "/start", "alice"), secret) == 200)
+        check("/start answered", fake.wait_for(
+            lambda m, p: m == "sendMessage" and p.get("chat_id") == 1001 and "Привет" in p.get("text", ""), 10) is not None)
+        post_update(hook, make_message_update(1002, "/start", "bob"), secret)
+        post_update(hook, make_message_update(1001, "/send", "alice"), secret)
+        time.sleep(0.5)
+        post_update(hook, make_message_update(1001, "hello from webhook", "alice"), secret)
+        check("anonymous message relayed", fake.wait_for(
+            lambda m, p: m == "sendMessage" and p.get("chat_id") == 1002 and "hello from webhook" in p.get("text", ""),
+            10) is not None)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        fake.stop()
+    check("bot exited cleanly", proc.returncode == 0 or proc.returncode == -15)
+    print(f"calls: {fake.counts}")
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    serve = sub.add_parser("serve", help="запустить фейковый Bot API")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8081)
+    serve.add_argument("--latency-ms", type=float, default=0)
+    serve.add_argument("--retry-after-rate", type=float, default=0)
+    serve.add_argument("--blocked", default="", help="chat_id через запятую")
+    serve.add_argument("--blocked-rate", type=float, default=0, help="доля chat_id, заблокировавших бота")
+    serve.add_argument("--missing", default="", help="chat_id через запятую: chat not found")
+    check = sub.add_parser("webhook-check", help="проверить webhook-режим bot.py офлайн")
+    check.add_argument("--bot", default=os.path.join(os.path.dirname(__file__), "..", "bot.py"))
+    args = parser.parse_args()
+    if args.cmd == "serve":
+        blocked = [c for c in args.blocked.split(",") if c]
+        missing = [c for c in args.missing.split(",") if c]
+        fake = FakeTelegram(args.host, args.port, args.latency_ms / 1000, args.retry_after_rate,
+                            blocked=blocked, blocked_rate=args.blocked_rate, missing=missing).start()
+        print(f"Fake Bot API on {fake.url} (TELEGRAM_API_URL={fake.url})")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            fake.stop()
+    else:
+        sys.exit(0 if webhook_check(args.bot) else 1)
+
+if __name__ == "__main__":
+    main()